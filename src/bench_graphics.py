@@ -0,0 +1,79 @@
+import io
+import os
+import sys
+import time
+
+from PIL import Image
+
+from utils.graphics import DEFAULT_ENCODING, encode
+
+# Encoder settings to compare - the first is the previous hard coded behaviour
+CANDIDATES = {
+    "png level 5": {"format": "png", "compress_level": 5},
+    "png level 1": {"format": "png", "compress_level": 1},
+    "png quantized": {"format": "png", "compress_level": 5, "quantize": True},
+    "webp lossless": {"format": "webp", "lossless": True, "method": 4},
+    "webp lossless fast": {"format": "webp", "lossless": True, "method": 0},
+    "webp lossy q90": {"format": "webp", "lossless": False, "quality": 90},
+    "webp lossy q80": {"format": "webp", "lossless": False, "quality": 80},
+}
+
+# Width of the downscaled preview to benchmark alongside the full size graphics
+PREVIEW_WIDTH = 960
+
+REPEATS = 3
+
+
+# Encode the image REPEATS times, returning the fastest time in ms and the encoded size in KB
+def bench(image, settings):
+    best = None
+    for _ in range(REPEATS):
+        buffer = io.BytesIO()
+        t1 = time.perf_counter()
+        encode(image, buffer, DEFAULT_ENCODING | settings)
+        elapsed = time.perf_counter() - t1
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best * 1000, buffer.tell() / 1024
+
+
+def main():
+    # Benchmark the templates by default, or any images passed as arguments (e.g. rendered
+    # graphics in ../data/graphics)
+    if len(sys.argv) > 1:
+        files = sys.argv[1:]
+    else:
+        files = [
+            f"assets/templates/{f}"
+            for f in sorted(os.listdir("assets/templates"))
+            if f.endswith(".png") and "backing" not in f
+        ]
+
+    print(f"{'image':<32}{'size':<12}{'encoder':<22}{'time (ms)':>12}{'size (KB)':>12}")
+
+    totals = {name: [0, 0] for name in CANDIDATES}
+    for file in files:
+        image = Image.open(file).convert("RGB")
+        height = round(image.height * PREVIEW_WIDTH / image.width)
+        preview = image.resize((PREVIEW_WIDTH, height), Image.Resampling.LANCZOS)
+
+        for img in [image, preview]:
+            for name, settings in CANDIDATES.items():
+                ms, kb = bench(img, settings)
+                if img is image:
+                    totals[name][0] += ms
+                    totals[name][1] += kb
+                print(
+                    f"{os.path.basename(file):<32}{f'{img.width}x{img.height}':<12}{name:<22}"
+                    f"{ms:>12.1f}{kb:>12.1f}"
+                )
+        print()
+
+    print("Totals at full size:")
+    for name, (ms, kb) in totals.items():
+        print(f"\t{name:<22}{ms:>12.1f}ms{kb:>12.1f}KB")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,13 @@
-import os
-import sqlite3
 import json
 
 import logging
 
-from PIL import Image, ImageFont, ImageDraw
+from PIL import ImageDraw
+
+import utils.db as db
+from utils.graphics import get_font, get_logo, get_template, remove_graphic, save_graphic
+from utils.log import setup_logging
+from utils.profiling import profile_calls
 
 with open("../config.json", "r") as read_file:
     config = json.load(read_file)
@@ -17,16 +20,7 @@ MAX_GAMES_1v1 = config["MAX_GAMES_1v1"]
 
 logger = logging.getLogger("script.draw_stats")
 
-# Suppress spammy PIL image editing logs
-logging.getLogger("PIL.PngImagePlugin").setLevel(30)
-
-logging.basicConfig(
-    filename="../logs/rlis.log",
-    encoding="utf-8",
-    datefmt="%Y-%m-%d %H:%M:%S",
-    format="[%(asctime)s] [%(levelname)-8s] %(name)s: %(message)s",
-    level=logging.DEBUG,
-)
+setup_logging()
 
 
 def max_games(mode):
@@ -55,15 +49,11 @@ def draw_data(game_id, data):
         stats_to_draw.pop("assists")
 
     # Delete the stat graphic if it exists
-    try:
-        os.remove(f"../data/graphics/{game_id}.png")
-        logger.debug("Outdated stats graphic removed")
-    except OSError:
-        pass
+    remove_graphic(str(game_id))
 
     # Attempt to load the template file for the relevant mode
     try:
-        image = Image.open(f"assets/templates/stat_template_{data['mode']}.png")
+        image = get_template(f"stat_template_{data['mode']}.png").copy()
         logger.info("Successfully opened template file")
     except FileNotFoundError:
         logger.error("Failed to draw stats as template file does not exist")
@@ -72,13 +62,13 @@ def draw_data(game_id, data):
     image_editable = ImageDraw.Draw(image)
 
     # Draw '<team 1> vs <team 2>'
-    font = ImageFont.truetype("assets/fonts/SourceSansPro-Black.ttf", 96)
+    font = get_font("SourceSansPro-Black.ttf", 96)
     text = f"{data['winning_org']} vs {data['losing_org']}"
     w = font.getlength(text)
     image_editable.text(((1512 - w) / 2, 15), text, (255, 255, 255), font=font)
 
     # Draw '<tier> <mode> - Week <week>'
-    font = ImageFont.truetype("assets/fonts/SourceSansPro-Black.ttf", 64)
+    font = get_font("SourceSansPro-Black.ttf", 64)
     text = f"{data['tier']} {data['mode']}v{data['mode']} — Week {data['week']}"
     w = font.getlength(text)
     image_editable.text(((1512 - w) / 2, 128), text, (167, 167, 167), font=font)
@@ -104,10 +94,10 @@ def draw_data(game_id, data):
         # scale it down incrementally until it fits. For every pt the font size decreases by, draw
         # the text that many pixels lower
         player_name_size = 36
-        font = ImageFont.truetype("assets/fonts/SourceSansPro-Regular.ttf", player_name_size)
+        font = get_font("SourceSansPro-Regular.ttf", player_name_size)
         w = font.getlength(player)
         while w > 140:
-            font = ImageFont.truetype("assets/fonts/SourceSansPro-Regular.ttf", player_name_size)
+            font = get_font("SourceSansPro-Regular.ttf", player_name_size)
             w = font.getlength(player)
             player_name_size -= 2
         image_editable.text(
@@ -124,7 +114,7 @@ def draw_data(game_id, data):
         # j represents the location index of the stat being drawn
         j = 0
         for stat in stats_to_draw:
-            font = ImageFont.truetype("assets/fonts/SourceSansPro-Regular.ttf", 24)
+            font = get_font("SourceSansPro-Regular.ttf", 24)
             # If no stat is stored, draw '?', otherwsie round it to the correct number
             # of decimal places
             if player_stats[stat] is None:
@@ -182,12 +172,12 @@ def draw_data(game_id, data):
 
     logger.info(f"Finished drawing player stats and stat bars, now drawing goals section")
 
-    # Open and paste the org logos
-    logo_left = Image.open(f"assets/logos/{ORGS[data['winning_org']]['logo_file']}")
-    logo_right = Image.open(f"assets/logos/{ORGS[data['losing_org']]['logo_file']}")
+    # Paste the org logos
+    logo_left = get_logo(ORGS[data["winning_org"]]["logo_file"])
+    logo_right = get_logo(ORGS[data["losing_org"]]["logo_file"])
 
-    image.paste(logo_left, (140 * (3 - data["mode"]), 392), mask=logo_left)
-    image.paste(logo_right, (1256 - 140 * (3 - data["mode"]), 392), mask=logo_right)
+    image.alpha_composite(logo_left, (140 * (3 - data["mode"]), 392))
+    image.alpha_composite(logo_right, (1256 - 140 * (3 - data["mode"]), 392))
 
     # The 3v3 template uses a different layout as it's BO5 - adjust the lower section accordingly
     offset_org_names = 0
@@ -197,7 +187,7 @@ def draw_data(game_id, data):
         start_x_adjust -= 73
 
     # Draw the winning org and losing org text (winning org for the series is always on top)
-    font = ImageFont.truetype("assets/fonts/SourceSansPro-SemiBold.ttf", 32)
+    font = get_font("SourceSansPro-SemiBold.ttf", 32)
     text = data["winning_org"].upper()
     w = font.getlength(text)
     image_editable.text(
@@ -228,7 +218,7 @@ def draw_data(game_id, data):
 
     # Draw the goals for each org in each game. If the game was not played (e.g games 4 and 5 in a
     # 3-0), draw '-'
-    font = ImageFont.truetype("assets/fonts/SourceSansPro-Regular.ttf", 32)
+    font = get_font("SourceSansPro-Regular.ttf", 32)
     for i in range(max_games(data["mode"])):
         if i < len(winning_org_goals):
             text_top = str(winning_org_goals[i])
@@ -266,59 +256,28 @@ def draw_data(game_id, data):
             font=font,
         )
 
-    logger.info(f"Finishing drawing graphic, saving {game_id}.png")
+    logger.info(f"Finishing drawing graphic, saving graphic for {game_id}")
 
-    image.save(f"../data/graphics/{game_id}.png", compress_level=5)
+    save_graphic(image.convert("RGB"), "stats", str(game_id))
 
 
-def get_data(game_id):
+# Build the data for a stat graphic from the series row (tier, mode, winning org, losing org,
+# wp1..lp3), the week, the averaged player stat rows, and the game goal rows in order
+def build_data(game_id, series_data, week, all_player_stats, game_stats):
 
     data = {}
 
-    con = sqlite3.connect("../data/rlis_data.db")
-    cur = con.cursor()
-
-    logger.info("Connected to database")
-
-    # Get the series data
-    res = cur.execute(
-        """SELECT L.tier, L.mode, L.winning_org, L.losing_org, 
-        P.wp1, P.wp2, P.wp3, P.lp1, P.lp2, P.lp3 
-        FROM series_log AS L JOIN series_players AS P 
-        ON L.game_id = P.game_id WHERE L.game_id = ?""",
-        (game_id,),
-    )
-
-    series_data = res.fetchone()
-
-    if series_data is None:
-        logger.error("Game id not found")
-        return None
-
     # Store the tier, mode, winning org and losing org
     data["tier"] = series_data[0]
     data["mode"] = series_data[1]
     data["winning_org"] = series_data[2]
     data["losing_org"] = series_data[3]
 
-    # Get the org ids to query the fixtures table
-    winning_org_id = ORGS[series_data[2]]["id"]
-    losing_org_id = ORGS[series_data[3]]["id"]
-
-    # Find the week in which this match took place
-    res = cur.execute(
-        """SELECT week FROM fixtures 
-        WHERE ? IN (org_1, org_2) AND ? IN (org_1, org_2) AND tier = ?""",
-        (winning_org_id, losing_org_id, series_data[0]),
-    )
-
-    week = res.fetchone()
-
     # Make sure the series is fixtured - if it is, store the week
     if week is not None:
-        data["week"] = week[0]
+        data["week"] = week
     else:
-        logger.error("Fixture not found")
+        logger.error(f"Fixture not found for {game_id}")
         return None
 
     # Get the non-none player names
@@ -340,17 +299,6 @@ def get_data(game_id):
     # Store a blank stat template for each losing player as the child of the losing org
     data[series_data[3]] = {}
 
-    # Get the average stats for all the replay guids associated with this game id
-    res = cur.execute(
-        """SELECT name, AVG(score), AVG(goals), AVG(assists), AVG(shots), AVG(saves), 
-        AVG(demos_inflicted), AVG(avg_speed) 
-        FROM player_stats WHERE guid IN (SELECT guid FROM game_stats WHERE game_id = ?) 
-        GROUP BY name ORDER BY AVG(score) DESC""",
-        (game_id,),
-    )
-
-    all_player_stats = res.fetchall()
-
     # Go through each player, and store their stats to the relevant dictionary
     for player in all_player_stats:
         if player[0] in winning_players:
@@ -376,6 +324,63 @@ def get_data(game_id):
         else:
             logger.warning(f"{player[0]} is not a known player for this series")
 
+    # Create lists to store the goals stored in each game
+    data["games"] = {series_data[2]: [], series_data[3]: []}
+
+    # Store the number of goals scored by each org in each game
+    for game in game_stats:
+        data["games"][game[0]].append(game[2])
+        data["games"][game[1]].append(game[3])
+
+    return data
+
+
+def get_data(game_id):
+
+    con = db.get_connection(read_only=True)
+    cur = con.cursor()
+
+    logger.info("Connected to database")
+
+    # Get the series data
+    res = cur.execute(
+        """SELECT L.tier, L.mode, L.winning_org, L.losing_org, 
+        P.wp1, P.wp2, P.wp3, P.lp1, P.lp2, P.lp3 
+        FROM series_log AS L JOIN series_players AS P 
+        ON L.game_id = P.game_id WHERE L.game_id = ?""",
+        (game_id,),
+    )
+
+    series_data = res.fetchone()
+
+    if series_data is None:
+        logger.error("Game id not found")
+        return None
+
+    # Get the org ids to query the fixtures table
+    winning_org_id = ORGS[series_data[2]]["id"]
+    losing_org_id = ORGS[series_data[3]]["id"]
+
+    # Find the week in which this match took place
+    res = cur.execute(
+        """SELECT week FROM fixtures 
+        WHERE ? IN (org_1, org_2) AND ? IN (org_1, org_2) AND tier = ?""",
+        (winning_org_id, losing_org_id, series_data[0]),
+    )
+
+    week = res.fetchone()
+
+    # Get the average stats for all the replay guids associated with this game id
+    res = cur.execute(
+        """SELECT name, AVG(score), AVG(goals), AVG(assists), AVG(shots), AVG(saves), 
+        AVG(demos_inflicted), AVG(avg_speed) 
+        FROM player_stats WHERE guid IN (SELECT guid FROM game_stats WHERE game_id = ?) 
+        GROUP BY name ORDER BY AVG(score) DESC""",
+        (game_id,),
+    )
+
+    all_player_stats = res.fetchall()
+
     # Get the number of goals scored in each game in order, game 1 first
     res = cur.execute(
         """SELECT winning_org, losing_org, winner_goals, loser_goals 
@@ -385,19 +390,80 @@ def get_data(game_id):
 
     game_stats = res.fetchall()
 
-    # Create lists to store the goals stored in each game
-    data["games"] = {series_data[2]: [], series_data[3]: []}
-
-    # Store the number of goals scored by each org in each game
-    for game in game_stats:
-        data["games"][game[0]].append(game[2])
-        data["games"][game[1]].append(game[3])
+    data = build_data(
+        game_id, series_data, week[0] if week is not None else None, all_player_stats, game_stats
+    )
 
-    logger.info(f"Successfully loaded data for {game_id}")
+    if data is not None:
+        logger.info(f"Successfully loaded data for {game_id}")
 
     return data
 
 
+# Get the data for the stat graphics of every series with one query per table, rather than one
+# set of queries per series. Returns {game_id: data}
+def get_all_data():
+
+    con = db.get_connection(read_only=True)
+    cur = con.cursor()
+
+    logger.info("Connected to database")
+
+    res = cur.execute(
+        """SELECT L.game_id, L.tier, L.mode, L.winning_org, L.losing_org, 
+        P.wp1, P.wp2, P.wp3, P.lp1, P.lp2, P.lp3 
+        FROM series_log AS L JOIN series_players AS P 
+        ON L.game_id = P.game_id ORDER BY L.game_id"""
+    )
+    all_series = res.fetchall()
+
+    # Index the week of every fixture by its tier and pair of org ids
+    res = cur.execute("SELECT week, tier, org_1, org_2 FROM fixtures")
+    weeks = {(row[1], frozenset(row[2:4])): row[0] for row in res.fetchall()}
+
+    # Average stats of every player in every series, ordered by average score within each series
+    res = cur.execute(
+        """SELECT S.game_id, P.name, AVG(P.score), AVG(P.goals), AVG(P.assists), AVG(P.shots), 
+        AVG(P.saves), AVG(P.demos_inflicted), AVG(P.avg_speed) 
+        FROM player_stats AS P JOIN game_stats AS S ON P.guid = S.guid 
+        GROUP BY S.game_id, P.name ORDER BY S.game_id, AVG(P.score) DESC"""
+    )
+    player_stats = {}
+    for row in res.fetchall():
+        player_stats.setdefault(row[0], []).append(row[1:])
+
+    # Goals scored in every game, game 1 first within each series
+    res = cur.execute(
+        """SELECT game_id, winning_org, losing_org, winner_goals, loser_goals 
+        FROM game_stats ORDER BY game_id, timestamp ASC"""
+    )
+    game_stats = {}
+    for row in res.fetchall():
+        game_stats.setdefault(row[0], []).append(row[1:])
+
+    all_data = {}
+    for series in all_series:
+        game_id = series[0]
+        week = weeks.get(
+            (series[1], frozenset([ORGS[series[3]]["id"], ORGS[series[4]]["id"]]))
+        )
+        data = build_data(
+            game_id,
+            series[1:],
+            week,
+            player_stats.get(game_id, []),
+            game_stats.get(game_id, []),
+        )
+        if data is not None:
+            all_data[game_id] = data
+
+    logger.info(f"Successfully loaded data for {len(all_data)} series")
+
+    return all_data
+
+
+# Only run by get_stats.py and the ingestion cog's render workers, so profiled with RLIS_PROFILE
+@profile_calls("draw_stats", in_bot=False)
 def draw(game_id):
     data = get_data(game_id)
     if data is not None:
@@ -0,0 +1,288 @@
+import os
+import csv
+import json
+import time
+import logging
+import argparse
+import importlib.util
+import datetime as dt
+
+import utils.db as db
+from utils.log import setup_logging
+
+with open("../config.json", "r") as read_file:
+    config = json.load(read_file)
+
+TIERS = config["TIERS"]
+
+logger = logging.getLogger("script.export_stats")
+
+setup_logging()
+
+EXPORT_DIR = "../data/export"
+
+FORMATS = ["csv", "parquet"]
+
+# Number of rows fetched and written at a time. Parquet files get a row group per chunk
+CHUNK_SIZE = 10000
+
+# Every exported series, with the week of its fixture. The week is found by matching the series'
+# game id (excluding the mode) to the one generated from each fixture, as update_results.py does.
+# Filters on the series are added to the WHERE clause
+SERIES_CTE = """WITH T(tier, tier_id) AS (VALUES {tiers}),
+W AS (
+    SELECT F.tier, F.week,
+    CAST(MAX(F.org_1, F.org_2) || MIN(F.org_1, F.org_2) || T.tier_id AS INTEGER) AS partial_id
+    FROM fixtures AS F JOIN T ON T.tier = F.tier
+),
+S AS (
+    SELECT L.*, W.week FROM series_log AS L
+    LEFT JOIN W ON W.tier = L.tier AND W.partial_id = L.game_id / 10
+    WHERE {where}
+)
+"""
+
+# Analysis tables, each with the query (after SERIES_CTE) producing it and its columns and types
+TABLES = {
+    # One row per series, with its players
+    "series": (
+        """SELECT S.game_id, S.timestamp, S.tier, S.week, S.mode, S.winning_org, S.losing_org,
+        S.games_won_by_loser, S.played_previously, S.replays_stored,
+        P.wp1, P.wp2, P.wp3, P.lp1, P.lp2, P.lp3
+        FROM S LEFT JOIN series_players AS P ON P.game_id = S.game_id
+        ORDER BY S.timestamp, S.game_id""",
+        [
+            ("game_id", "int"),
+            ("timestamp", "int"),
+            ("tier", "str"),
+            ("week", "int"),
+            ("mode", "int"),
+            ("winning_org", "str"),
+            ("losing_org", "str"),
+            ("games_won_by_loser", "int"),
+            ("played_previously", "int"),
+            ("replays_stored", "int"),
+            ("wp1", "str"),
+            ("wp2", "str"),
+            ("wp3", "str"),
+            ("lp1", "str"),
+            ("lp2", "str"),
+            ("lp3", "str"),
+        ],
+    ),
+    # One row per replay, with the series it's part of
+    "games": (
+        """SELECT G.guid, G.url, G.timestamp, G.game_id, S.tier, S.week, S.mode,
+        G.winning_org, G.losing_org, G.duration, G.overtime_duration, G.winner_goals,
+        G.loser_goals, G.time_in_side_winner, G.time_in_side_loser
+        FROM S JOIN game_stats AS G ON G.game_id = S.game_id
+        ORDER BY S.timestamp, S.game_id, G.timestamp""",
+        [
+            ("guid", "str"),
+            ("url", "str"),
+            ("timestamp", "int"),
+            ("game_id", "int"),
+            ("tier", "str"),
+            ("week", "int"),
+            ("mode", "int"),
+            ("winning_org", "str"),
+            ("losing_org", "str"),
+            ("duration", "float"),
+            ("overtime_duration", "float"),
+            ("winner_goals", "int"),
+            ("loser_goals", "int"),
+            ("time_in_side_winner", "float"),
+            ("time_in_side_loser", "float"),
+        ],
+    ),
+    # One row per player per replay, with the org they played for and whether they won the series
+    # (from series_participation, so players not in the series' lineup have neither)
+    "player_games": (
+        """SELECT PS.guid, PS.name, PS.game_id, G.timestamp, S.tier, S.week, S.mode,
+        SP.org, SP.won, PS.duration, PS.goals, PS.assists, PS.saves, PS.shots, PS.score,
+        PS.demos_inflicted, PS.demos_taken, PS.car, PS.boost_while_ss, PS.time_0_boost,
+        PS.avg_speed, PS.dist_travelled
+        FROM S JOIN game_stats AS G ON G.game_id = S.game_id
+        JOIN player_stats AS PS ON PS.guid = G.guid
+        LEFT JOIN series_participation AS SP ON SP.game_id = S.game_id AND SP.player = PS.name
+        ORDER BY S.timestamp, S.game_id, G.timestamp, PS.name""",
+        [
+            ("guid", "str"),
+            ("name", "str"),
+            ("game_id", "int"),
+            ("timestamp", "int"),
+            ("tier", "str"),
+            ("week", "int"),
+            ("mode", "int"),
+            ("org", "str"),
+            ("won", "int"),
+            ("duration", "float"),
+            ("goals", "int"),
+            ("assists", "int"),
+            ("saves", "int"),
+            ("shots", "int"),
+            ("score", "int"),
+            ("demos_inflicted", "int"),
+            ("demos_taken", "int"),
+            ("car", "str"),
+            ("boost_while_ss", "int"),
+            ("time_0_boost", "float"),
+            ("avg_speed", "float"),
+            ("dist_travelled", "int"),
+        ],
+    ),
+}
+
+
+# Build the series CTE for the filters given, returning the SQL and its parameters. since and
+# until are datetimes compared to when each series was reported, until being exclusive
+def series_cte(tiers=None, weeks=None, since=None, until=None):
+    params = [value for tier in TIERS.items() for value in tier]
+
+    conditions = ["1"]
+    if tiers:
+        conditions.append(f"L.tier IN ({', '.join('?' * len(tiers))})")
+        params += tiers
+    if weeks:
+        conditions.append(f"W.week IN ({', '.join('?' * len(weeks))})")
+        params += weeks
+    if since is not None:
+        conditions.append("L.timestamp >= ?")
+        params.append(round(since.timestamp()))
+    if until is not None:
+        conditions.append("L.timestamp < ?")
+        params.append(round(until.timestamp()))
+
+    sql = SERIES_CTE.format(
+        tiers=", ".join(["(?, ?)"] * len(TIERS)), where=" AND ".join(conditions)
+    )
+    return sql, params
+
+
+# Writes the chunks of a table to a CSV file
+class CSVWriter:
+    def __init__(self, path, columns):
+        self.file = open(path, "w", newline="", encoding="utf-8")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow([name for name, _ in columns])
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.file.close()
+
+
+# Writes the chunks of a table to a Parquet file, one row group per chunk. pyarrow is only needed
+# for Parquet exports, so it isn't imported unless one is made
+class ParquetWriter:
+    def __init__(self, path, columns):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        types = {"int": pa.int64(), "float": pa.float64(), "str": pa.string()}
+        self.pa = pa
+        self.names = [name for name, _ in columns]
+        self.schema = pa.schema([(name, types[kind]) for name, kind in columns])
+        self.writer = pq.ParquetWriter(path, self.schema, compression="zstd")
+
+    def write(self, rows):
+        values = {name: list(column) for name, column in zip(self.names, zip(*rows))}
+        self.writer.write_table(self.pa.Table.from_pydict(values, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+WRITERS = {"csv": CSVWriter, "parquet": ParquetWriter}
+
+
+# Stream each table from the database to a file in each format, a chunk at a time. Every table is
+# read in one transaction, so the export is a consistent snapshot. Readers don't block writers in
+# WAL mode, so the bot can keep writing while the export runs. Returns {table: rows written}
+def export(out_dir, formats, tiers=None, weeks=None, since=None, until=None, chunk_size=CHUNK_SIZE):
+    os.makedirs(out_dir, exist_ok=True)
+    cte, params = series_cte(tiers, weeks, since, until)
+
+    con = db.connect(read_only=True)
+    counts = {}
+    try:
+        con.execute("BEGIN")
+
+        for table, (query, columns) in TABLES.items():
+            writers = [
+                WRITERS[fmt](os.path.join(out_dir, f"{table}.{fmt}"), columns) for fmt in formats
+            ]
+            try:
+                cur = con.execute(cte + query, params)
+                counts[table] = 0
+                while rows := cur.fetchmany(chunk_size):
+                    for writer in writers:
+                        writer.write(rows)
+                    counts[table] += len(rows)
+            finally:
+                for writer in writers:
+                    writer.close()
+
+            logger.debug(f"Exported {counts[table]} rows of {table}")
+    finally:
+        con.rollback()
+        con.close()
+
+    return counts
+
+
+def date(value):
+    return dt.datetime.fromisoformat(value)
+
+
+# A chunk size of 0 would make fetchmany return every remaining row at once
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, not {number}")
+    return number
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the season's stats for analysis")
+    parser.add_argument("--out", default=EXPORT_DIR, help="Directory to write the tables to")
+    parser.add_argument(
+        "--format",
+        choices=FORMATS,
+        action="append",
+        help="Only write this format (by default CSV, plus Parquet if pyarrow is installed)",
+    )
+    parser.add_argument("--tier", choices=list(TIERS), action="append", help="Only this tier")
+    parser.add_argument("--week", type=int, action="append", help="Only this week")
+    parser.add_argument(
+        "--since", type=date, help="Only series reported at or after this date (YYYY-MM-DD)"
+    )
+    parser.add_argument("--until", type=date, help="Only series reported before this date")
+    parser.add_argument(
+        "--chunk-size", type=positive_int, default=CHUNK_SIZE, help="Rows written at a time"
+    )
+    args = parser.parse_args()
+
+    has_pyarrow = importlib.util.find_spec("pyarrow") is not None
+    if args.format:
+        formats = args.format
+    else:
+        formats = ["csv", "parquet"] if has_pyarrow else ["csv"]
+    if "parquet" in formats and not has_pyarrow:
+        parser.error("Parquet exports need pyarrow (pip install pyarrow), or use --format csv")
+
+    t1 = time.perf_counter()
+    counts = export(
+        args.out, formats, args.tier, args.week, args.since, args.until, args.chunk_size
+    )
+    elapsed = time.perf_counter() - t1
+
+    for table, count in counts.items():
+        print(f"{count} rows written to {table} ({', '.join(formats)})")
+    print(f"Exported {sum(counts.values())} rows to {args.out} in {elapsed:.3f}s")
+    logger.info(f"Exported {sum(counts.values())} rows in {round(elapsed, 3)}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,8 @@
-import sqlite3
 import datetime as dt
 import utils.ballchasing_api as ballchasing_api
+import utils.db as db
+from utils.log import setup_logging
+from utils.profiling import profile_calls
 from draw_stats import draw
 import json
 import time
@@ -17,14 +19,47 @@ MAX_GAMES_1v1 = config["MAX_GAMES_1v1"]
 
 logger = logging.getLogger("script.get_stats")
 
-logging.basicConfig(
-    filename="../logs/rlis.log",
-    encoding="utf-8",
-    datefmt="%Y-%m-%d %H:%M:%S",
-    format="[%(asctime)s] [%(levelname)-8s] %(name)s: %(message)s",
-    level=logging.DEBUG,
+setup_logging()
+
+# Queries shared with the in-process ingestion cog (ingestion_cog.py)
+STACK_TOP_QUERY = "SELECT * FROM stats_stack ORDER BY priority DESC LIMIT 1"
+
+SERIES_QUERY = """SELECT L.mode, L.games_won_by_loser, L.timestamp, L.played_previously, 
+L.winning_org, L.losing_org, P.wp1, P.wp2, P.wp3, P.lp1, P.lp2, P.lp3 
+FROM series_log AS L LEFT OUTER JOIN series_players AS P ON L.game_id = P.game_id 
+WHERE L.game_id = ?"""
+
+GUIDS_QUERY = "SELECT guid FROM game_stats WHERE game_id = ?"
+
+IDENTITIES_QUERY = "SELECT platform, platform_id, name FROM players"
+
+INSERT_GAME_STATS = "INSERT INTO game_stats VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+
+INSERT_PLAYER_STATS = (
+    "INSERT INTO player_stats VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
 )
 
+# Delete the entry that's been processed (by priority, in case more have been pushed since), then
+# update the number of replays stored and unpublish the series in series log
+POP_STACK_QUERY = "DELETE FROM stats_stack WHERE priority = ?"
+
+UPDATE_SERIES_QUERY = """UPDATE series_log 
+SET replays_stored = (SELECT COUNT(guid) FROM game_stats WHERE game_id = ?),
+published = 0 WHERE game_id = ?"""
+
+# Fill in the stages of a series' timeline (see series_timeline in utils/migrations.py). Only the
+# first time each stage happens is kept, so re-pushing a series doesn't reset its timeline
+TIMELINE_STORED_QUERY = """UPDATE series_timeline 
+SET replays_found = COALESCE(replays_found, ?), stored = COALESCE(stored, ?) 
+WHERE game_id = ?"""
+
+TIMELINE_DRAWN_QUERY = "UPDATE series_timeline SET drawn = COALESCE(drawn, ?) WHERE game_id = ?"
+
+
+# Raised when storing a replay would exceed the maximum number of replays for the series
+class TooManyReplays(Exception):
+    pass
+
 
 # Get the maximum number of replays for a series of a specific mode
 def max_games_for_mode(mode):
@@ -36,7 +71,12 @@ def max_games_for_mode(mode):
         return MAX_GAMES_1v1
 
 
-def determine_winner(cur, game_id, replay_data):
+# The platform and platform id of a player in a replay, in the form stored in the players table
+def player_key(player):
+    return (player["id"]["platform"], str(player["id"]["id"]))
+
+
+def determine_winner(search, replay_data):
     # Try and get the total goals scored by the blue and orange teams
     try:
         blue_goals = replay_data["blue"]["stats"]["core"]["goals"]
@@ -54,63 +94,31 @@ def determine_winner(cur, game_id, replay_data):
 
     # Get the winning and losing player ids from the replay
     if blue_goals > orange_goals:
-        game_winners = {
-            (player["id"]["platform"], player["id"]["id"])
-            for player in replay_data["blue"]["players"]
-        }
-        game_losers = {
-            (player["id"]["platform"], player["id"]["id"])
-            for player in replay_data["orange"]["players"]
-        }
+        game_winners = {player_key(player) for player in replay_data["blue"]["players"]}
+        game_losers = {player_key(player) for player in replay_data["orange"]["players"]}
     else:
-        game_winners = {
-            (player["id"]["platform"], player["id"]["id"])
-            for player in replay_data["orange"]["players"]
-        }
-        game_losers = {
-            (player["id"]["platform"], player["id"]["id"])
-            for player in replay_data["blue"]["players"]
-        }
-
-    # Get the orgs, mode, and player names from the series log
-    res = cur.execute(
-        """SELECT L.winning_org, L.losing_org, L.mode,
-        P.wp1, P.wp2, P.wp3, P.lp1, P.lp2, P.lp3
-        FROM series_log AS L JOIN series_players AS P ON L.game_id = P.game_id
-        WHERE L.game_id = ?""",
-        (game_id,),
-    )
-    data = res.fetchone()
+        game_winners = {player_key(player) for player in replay_data["orange"]["players"]}
+        game_losers = {player_key(player) for player in replay_data["blue"]["players"]}
 
-    # Get the platforms and platform ids of the players on the winning org (for the series)
-    res = cur.execute(
-        """SELECT platform, platform_id FROM players 
-        WHERE name IN(?, ?, ?)""",
-        (data[3], data[4], data[5]),
-    )
-    # This will never fail since the players in series_players must have an entry in players
-    series_winners = set(res.fetchall())
-
-    # Get the platforms and platform ids of the players on the losing org (for the series)
-    res = cur.execute(
-        """SELECT platform, platform_id FROM players 
-        WHERE name IN(?, ?, ?)""",
-        (data[6], data[7], data[8]),
-    )
-    # This will never fail since the players in series_players must have an entry in players
-    series_losers = set(res.fetchall())
+    # Get the platforms and platform ids of the players on the winning and losing orgs (for the
+    # series). These are always known since the players in series_players must be in players
+    series_winners = search["series_winners"]
+    series_losers = search["series_losers"]
 
     # Compare the sets to check if whether the series winners won/lost the game
     # This will always be correct since this function is only called when all the players
     # in the replay are known
     if series_winners == game_winners and series_losers == game_losers:
-        return data[0], data[1]
+        return search["winning_org"], search["losing_org"]
     else:
-        return data[1], data[0]
+        return search["losing_org"], search["winning_org"]
 
 
-# Store game and player stats from a specific match
-def store_stats(cur, match_guid, game_id, winning_org, losing_org, date, replay_data, alt_player):
+# Parse the game and player stats of a specific match into the rows to store, returned as
+# (game_stats row, [player_stats row])
+def parse_stats(
+    match_guid, game_id, winning_org, losing_org, date, replay_data, identities, alt_player
+):
 
     # Parse the date string into a unix timestamp
     timestamp = int(dt.datetime.strptime(date, "%Y-%m-%dT%H:%M:%S%z").timestamp())
@@ -160,38 +168,32 @@ def store_stats(cur, match_guid, game_id, winning_org, losing_org, date, replay_
                 time_in_side_winner = None
                 time_in_side_loser = None
 
-    # Store game stats. Some values may be NULL if they were not included in the response
-    cur.execute(
-        "INSERT INTO game_stats VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-        (
-            match_guid,
-            url,
-            timestamp,
-            game_id,
-            winning_org,
-            losing_org,
-            duration,
-            overtime_duration,
-            winner_goals,
-            loser_goals,
-            time_in_side_winner,
-            time_in_side_loser,
-        ),
+    # Game stats. Some values may be NULL if they were not included in the response
+    game_row = (
+        match_guid,
+        url,
+        timestamp,
+        game_id,
+        winning_org,
+        losing_org,
+        duration,
+        overtime_duration,
+        winner_goals,
+        loser_goals,
+        time_in_side_winner,
+        time_in_side_loser,
     )
 
+    player_rows = []
+
     # Combine the blue and orange lists of players
     all_players = replay_data["blue"]["players"] + replay_data["orange"]["players"]
     for player in all_players:
         # Get the platform and platform id of the player from the response
-        platform = player["id"]["platform"]
-        platform_id = player["id"]["id"]
+        platform, platform_id = player_key(player)
 
         # Get the name of the player from the platform and platform id
-        res = cur.execute(
-            "SELECT name FROM players WHERE platform = ? AND platform_id = ?",
-            (platform, platform_id),
-        )
-        name = res.fetchone()
+        name = identities.get((platform, platform_id))
 
         # If the platform and platform id isn't recognised
         if name is None:
@@ -204,8 +206,6 @@ def store_stats(cur, match_guid, game_id, winning_org, losing_org, date, replay_
                     f"Failed to find {platform}:{platform_id} in players table, skipping"
                 )
                 continue
-        else:
-            name = name[0]
 
         try:
             duration = player["end_time"] - player["start_time"]
@@ -275,9 +275,8 @@ def store_stats(cur, match_guid, game_id, winning_org, losing_org, date, replay_
         except KeyError:
             dist_travelled = None
 
-        # Store player stats. Some values may be NULL if they were not included in the response
-        cur.execute(
-            "INSERT INTO player_stats VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        # Player stats. Some values may be NULL if they were not included in the response
+        player_rows.append(
             (
                 match_guid,
                 name,
@@ -298,97 +297,60 @@ def store_stats(cur, match_guid, game_id, winning_org, losing_org, date, replay_
             ),
         )
 
-    logger.info(f"Finished storing game and player stats for {match_guid}")
-
+    logger.info(f"Finished parsing game and player stats for {match_guid}")
 
-def get(cur, game_id, max_games, existing_guids, start, end, players, alt_player):
+    return game_row, player_rows
 
-    logger.debug(f"Filtering ballchasing between {start} and {end} with {players}")
 
-    ballchasing = ballchasing_api.API(BALLCHASING_KEY)
-
-    # Filter the replays, then get each one in turn
-    filtered_replays = ballchasing.filter(start, end, players)
-    logger.info(f"Filter found {filtered_replays["count"]} replays")
-    for replay in filtered_replays["list"]:
-        time.sleep(1)
-        logger.debug(f"Getting replay with id {replay['id']}")
-        replay_data = ballchasing.get(replay["id"])
+# Work out how to search for the replays of a stats stack entry, given the series (a row of
+# SERIES_QUERY), the replay guids already stored for it, and {(platform, platform id): name} of
+# every player. Returns None if the game id hasn't been reported
+def build_search(entry, series, existing_guids, identities):
+    game_id = entry[1]
 
-        match_guid = replay_data.get("match_guid", None)
-        date = replay_data.get("date", None)
-        # If the guid already exists, skip it
-        if match_guid in existing_guids:
-            logger.info(f"Replay guid already stored, skipping ({match_guid})")
-            continue
-        # If the guid or date are not present, don't store it (these are required attributes)
-        elif match_guid is None or date is None:
-            logger.error(
-                f"match_guild or date field not present - unable to save replay with id {replay['id']}"
-            )
-            continue
-
-        existing_guids.append(match_guid)
-
-        # If the new replay will exceed the max number of replays for the mode, don't store it
-        if len(existing_guids) > max_games:
-            logger.error("Unable to store replay - too many replays in filter")
-            break
-
-        winning_org, losing_org = determine_winner(cur, game_id, replay_data)
-        # If the winning and losing orgs can't be resolved, dont store it
-        if winning_org is None or losing_org is None:
-            logger.error(f"Unable to resolve winning team - not saving {replay['id']}")
-            continue
-
-        logger.info(f"Storing stats for {match_guid}")
-        store_stats(
-            cur, match_guid, game_id, winning_org, losing_org, date, replay_data, alt_player
-        )
-
-
-def from_game_id(cur, game_id, alt_player, start_timestamp=None, end_timestamp=None):
-    # Get the mode, timestamp, played_previously, and players of the game id, and all of the
-    # associated replay guids
-    res = cur.execute(
-        """SELECT 
-            L.mode,
-            L.games_won_by_loser,
-            L.timestamp, 
-            L.played_previously, 
-            S.guid, 
-            P.wp1, P.wp2, P.wp3, 
-            P.lp1, P.lp2, P.lp3 
-        FROM 
-            series_log AS L
-        LEFT OUTER JOIN 
-            game_stats AS S 
-            ON L.game_id = S.game_id
-        LEFT OUTER JOIN 
-            series_players AS P 
-            ON L.game_id = P.game_id 
-        WHERE 
-            L.game_id = ?""",
-        (game_id,),
-    )
-    data = res.fetchall()
-
-    if data == []:
+    if series is None:
         logger.warning(f"Could not find any report of game id {game_id}")
-        return
+        return None
 
-    max_games = max_games_for_mode(data[0][0]) + data[0][1]
+    logger.debug(f"Found {len(existing_guids)} existing replay guids for {game_id}")
 
-    report_timestamp = data[0][2]
-    played_previously = data[0][3]
+    winning_players = set(series[6:9])
+    losing_players = set(series[9:12])
+
+    search = {
+        "priority": entry[0],
+        "game_id": game_id,
+        "max_games": max_games_for_mode(series[0]) + series[1],
+        "existing_guids": list(existing_guids),
+        "identities": identities,
+        "alt_player": (entry[7], (entry[8], entry[9])),
+        "replay_id": None,
+        "winning_org": series[4],
+        "losing_org": series[5],
+        "series_winners": {key for key, name in identities.items() if name in winning_players},
+        "series_losers": {key for key, name in identities.items() if name in losing_players},
+    }
 
-    # Get the replay guids already stored for this series
-    existing_guids = [game[4] for game in data if game[4] is not None]
-    logger.debug(f"Found {len(existing_guids)} existing replay guids for {game_id}")
+    # If a replay id and winning/losing orgs are included, search for that
+    if entry[2] is not None and entry[5] is not None and entry[6] is not None:
+        logger.info("Getting replay from replay id")
+        search["replay_id"] = entry[2]
+        search["winning_org"] = entry[5]
+        search["losing_org"] = entry[6]
+        return search
 
-    player_names = list(data[0][5:11])
+    # If there is no replay id but timestamps are included, search using them
+    if entry[3] is not None and entry[4] is not None:
+        logger.info("Getting replay from game id with specified times")
+        # Get a datetime object of the start and end timestamps
+        start = dt.datetime.fromtimestamp(entry[3], dt.timezone.utc)
+        end = dt.datetime.fromtimestamp(entry[4], dt.timezone.utc)
+    # If only a game id is included, infer times
+    else:
+        logger.info("Getting replay from game id")
+        report_timestamp = series[2]
+        played_previously = series[3]
 
-    if start_timestamp is None or end_timestamp is None:
         # Get a datetime object of the reported unix timestamp
         report_datetime = dt.datetime.fromtimestamp(report_timestamp, dt.timezone.utc)
 
@@ -402,92 +364,133 @@ def from_game_id(cur, game_id, alt_player, start_timestamp=None, end_timestamp=N
             end = report_datetime - dt.timedelta(days=played_previously - 1)
             end = end.replace(hour=0, minute=0, second=0)
             start = end - dt.timedelta(days=1)
-    else:
-        # Get a datetime object of the start and end timestamps
-        start = dt.datetime.fromtimestamp(start_timestamp, dt.timezone.utc)
-        end = dt.datetime.fromtimestamp(end_timestamp, dt.timezone.utc)
 
+    search["start"] = start
+    search["end"] = end
     # Get the platform and platform id of the involved players
-    res = cur.execute(
-        "SELECT platform, platform_id FROM players WHERE name IN(?, ?, ?, ?, ?, ?)", player_names
-    )
-    players = res.fetchall()
-
-    get(cur, game_id, max_games, existing_guids, start, end, players, alt_player)
-
-
-def from_replay_id(cur, game_id, replay_id, winning_org, losing_org, alt_player):
-    res = cur.execute(
-        """SELECT L.mode, L.games_won_by_loser, S.guid 
-        FROM 
-            series_log AS L 
-        LEFT OUTER JOIN 
-            game_stats AS S ON L.game_id = S.game_id 
-        WHERE L.game_id = ?""",
-        (game_id,),
-    )
-
-    data = res.fetchall()
+    search["players"] = list(search["series_winners"] | search["series_losers"])
 
-    if data == []:
-        logger.warning(f"Could not find any report of game id {game_id}")
-        return
-
-    max_games = max_games_for_mode(data[0][0]) + data[0][1]
-
-    # Get the replay guids already stored for this series
-    existing_guids = [guid[2] for guid in data if guid[2] is not None]
-    logger.debug(f"Found {len(existing_guids)} existing replay guids for {game_id}")
+    logger.debug(f"Filtering ballchasing between {start} and {end} with {search['players']}")
 
-    ballchasing = ballchasing_api.API(BALLCHASING_KEY)
+    return search
 
-    # Get the specified replay id, if it doesn't exist this will return {}
-    replay_data = ballchasing.get(replay_id)
 
+# Check a replay fetched from ballchasing and parse its stats, returning the rows to store or None
+# if it should be skipped. Raises TooManyReplays if it would exceed the max replays of the series
+def parse_replay(search, replay_id, replay_data):
     if replay_data == {}:
         logger.warning(f"Replay id {replay_id} not found")
-        return
+        return None
 
     match_guid = replay_data.get("match_guid", None)
     date = replay_data.get("date", None)
     # If the guid already exists, skip it
-    if match_guid in existing_guids:
+    if match_guid in search["existing_guids"]:
         logger.info(f"Replay guid already stored, skipping ({match_guid})")
-        return
+        return None
     # If the guid or date are not present, don't store it (these are required attributes)
     elif match_guid is None or date is None:
         logger.error(
             f"match_guild or date field not present - unable to save replay with id {replay_id}"
         )
-        return
+        return None
 
-    existing_guids.append(match_guid)
+    search["existing_guids"].append(match_guid)
 
     # If the new replay will exceed the max number of replays for the mode, don't store it
-    if len(existing_guids) > max_games:
-        logger.error("Unable to store replay - too many replays in filter")
-        return
+    if len(search["existing_guids"]) > search["max_games"]:
+        raise TooManyReplays()
+
+    # The winner of a replay found by id is given, otherwise it's worked out from the players
+    if search["replay_id"] is not None:
+        winning_org, losing_org = search["winning_org"], search["losing_org"]
+    else:
+        winning_org, losing_org = determine_winner(search, replay_data)
+        # If the winning and losing orgs can't be resolved, dont store it
+        if winning_org is None or losing_org is None:
+            logger.error(f"Unable to resolve winning team - not saving {replay_id}")
+            return None
 
     logger.info(f"Storing stats for {match_guid}")
-    store_stats(cur, match_guid, game_id, winning_org, losing_org, date, replay_data, alt_player)
+    return parse_stats(
+        match_guid,
+        search["game_id"],
+        winning_org,
+        losing_org,
+        date,
+        replay_data,
+        search["identities"],
+        search["alt_player"],
+    )
+
+
+# Get the search for a stats stack entry from the database
+def get_search(cur, entry):
+    series = cur.execute(SERIES_QUERY, (entry[1],)).fetchone()
+    existing_guids = [row[0] for row in cur.execute(GUIDS_QUERY, (entry[1],)).fetchall()]
+    identities = {(row[0], row[1]): row[2] for row in cur.execute(IDENTITIES_QUERY).fetchall()}
+
+    return build_search(entry, series, existing_guids, identities)
+
+
+# Parse a replay fetched for a stats stack entry, adding its rows (if it's to be stored) to those
+# of the entry. Returns False if the series has too many replays, so no more should be fetched.
+# Shared by fetch_replays and the ingestion cog, which only differ in how they call ballchasing
+def add_replay(search, rows, replay_id, replay_data):
+    try:
+        row = parse_replay(search, replay_id, replay_data)
+    except TooManyReplays:
+        logger.error("Unable to store replay - too many replays in filter")
+        return False
+
+    if row is not None:
+        rows.append(row)
+    return True
 
 
+# Fetch and parse the replays of a stats stack entry from ballchasing, returning the rows to store
+def fetch_replays(ballchasing, search):
+    rows = []
+    if search["replay_id"] is not None:
+        # Get the specified replay id, if it doesn't exist this will return {}
+        replay_data = ballchasing.get(search["replay_id"])
+        add_replay(search, rows, search["replay_id"], replay_data)
+        return rows
+
+    # Filter the replays, then get each one in turn
+    filtered_replays = ballchasing.filter(search["start"], search["end"], search["players"])
+    logger.info(f"Filter found {filtered_replays["count"]} replays")
+    for replay in filtered_replays["list"]:
+        time.sleep(1)
+        logger.debug(f"Getting replay with id {replay['id']}")
+        replay_data = ballchasing.get(replay["id"])
+        if not add_replay(search, rows, replay["id"], replay_data):
+            break
+
+    return rows
+
+
+# Store the parsed replays of a stats stack entry, pop it off the stack, and update the series
+# and its timeline. found is when the replays were fetched
+def store_replays(cur, entry, rows, found):
+    for game_row, player_rows in rows:
+        cur.execute(INSERT_GAME_STATS, game_row)
+        cur.executemany(INSERT_PLAYER_STATS, player_rows)
+
+    cur.execute(POP_STACK_QUERY, (entry[0],))
+    cur.execute(UPDATE_SERIES_QUERY, (entry[1], entry[1]))
+    cur.execute(TIMELINE_STORED_QUERY, (found if rows else None, round(time.time()), entry[1]))
+
+
+# Profiled with RLIS_PROFILE=get_stats, see utils/profiling.py. Only run by cron, never in the bot
+@profile_calls("get_stats", in_bot=False)
 def main():
-    con = sqlite3.connect("../data/rlis_data.db")
+    # Foreign keys are enforced on every connection from utils.db
+    con = db.get_connection()
     cur = con.cursor()
 
-    # Enforce referential key constraints for this session (since there may be insertions)
-    cur.execute("PRAGMA foreign_keys = ON")
-
     # Pop the highest priority itme off the stack
-    res = cur.execute(
-        """SELECT * 
-        FROM stats_stack 
-        ORDER BY priority DESC 
-        LIMIT 1"""
-    )
-
-    data = res.fetchone()
+    data = cur.execute(STACK_TOP_QUERY).fetchone()
 
     if data is None:
         logger.debug("No stats on the stack, ending")
@@ -495,38 +498,19 @@ def main():
 
     logger.info(f"Popped entry from stats stack - {data}")
 
-    alt_player = (data[7], (data[8], data[9]))
-
-    # If a replay id and winning/losing orgs are included, search for that
-    if data[2] is not None and data[5] is not None and data[6] is not None:
-        logger.info("Getting replay from replay id")
-        from_replay_id(cur, data[1], data[2], data[5], data[6], alt_player)
-    # If there is no replay id but timestamps are included, search using them
-    elif data[3] is not None and data[4] is not None:
-        logger.info("Getting replay from game id with specified times")
-        from_game_id(cur, data[1], alt_player, start_timestamp=data[3], end_timestamp=data[4])
-    # If only a game id is included, infer times
-    else:
-        logger.info("Getting replay from game id")
-        from_game_id(cur, data[1], alt_player)
-
-    # Delete the item that's been popped off the stack
-    cur.execute(
-        """DELETE FROM stats_stack 
-        WHERE priority = (SELECT MAX(priority) FROM stats_stack)"""
-    )
-
-    # Update the number of replays stored and unpublish series in series log
-    cur.execute(
-        """UPDATE series_log 
-        SET replays_stored = (SELECT COUNT(guid) FROM game_stats WHERE game_id = ?),
-        published = 0 WHERE game_id = ?""",
-        (data[1], data[1]),
-    )
+    # Search ballchasing before writing anything, so that the database isn't locked while waiting
+    # on the API
+    rows = []
+    search = get_search(cur, data)
+    if search is not None:
+        rows = fetch_replays(ballchasing_api.API(BALLCHASING_KEY), search)
 
+    store_replays(cur, data, rows, round(time.time()))
     con.commit()
 
     draw(data[1])
+    cur.execute(TIMELINE_DRAWN_QUERY, (round(time.time()), data[1]))
+    con.commit()
 
 
 if __name__ == "__main__":
@@ -13,6 +13,8 @@ from discord import app_commands
 import asyncio
 import sqlite3
 
+import utils.perf as perf
+
 logger = logging.getLogger("bot.helper")
 
 with open("../config.json", "r") as read_file:
@@ -43,7 +45,8 @@ class Helper(commands.Cog):
         tiers = list(TIERS.keys()) + ["Overall"]
         try:
             t1 = time.time()
-            await asyncio.to_thread(update_s, tiers)
+            with perf.timing("render"):
+                await asyncio.to_thread(update_s, tiers)
             logger.info(
                 f"Successfully updated standings graphics for {len(tiers)} tiers in {round(time.time() - t1, 3)}s"
             )
@@ -60,7 +63,8 @@ class Helper(commands.Cog):
         tiers = list(TIERS.keys())
         try:
             t1 = time.time()
-            await asyncio.to_thread(update_r, tiers, week)
+            with perf.timing("render"):
+                await asyncio.to_thread(update_r, tiers, week)
             logger.info(
                 f"Successfully updated results graphics for {len(tiers)} tiers in {round(time.time() - t1, 3)}s"
             )
@@ -108,6 +112,7 @@ class Helper(commands.Cog):
                 await interaction.response.send_message(
                     f"Game id {game_id} successfully pushed to the stack"
                 )
+                self.bot.dispatch("stats_pushed")
             except sqlite3.IntegrityError:
                 logger.warning("Unable to push to stats stack due to referential integrity error")
                 await interaction.response.send_message("Game id does not exist")
@@ -140,6 +145,9 @@ class Helper(commands.Cog):
                 f"Successfully pushed {len(data)} game ids to the stats stack"
             )
 
+        # Ingest the pushed game ids straight away if stats are ingested in process
+        self.bot.dispatch("stats_pushed")
+
     @app_commands.command(description="Delete a replay by replay id")
     @app_commands.guilds(discord.Object(id=GUILD_ID))
     async def delete_replay(
@@ -188,6 +196,9 @@ class Helper(commands.Cog):
 
             await interaction.response.send_message(f"Successfully deleted {replay_id}")
 
+        # Republish the series with the replay removed
+        self.bot.dispatch("stats_stored", game_id)
+
     @push_to_stats_stack.autocomplete("winning_org")
     @push_to_stats_stack.autocomplete("losing_org")
     async def org_autocomplete(self, interaction: discord.Interaction, current: str):
@@ -202,20 +213,11 @@ class Helper(commands.Cog):
 
     @push_to_stats_stack.autocomplete("p_out")
     async def players_autocomplete(self, interaction: discord.Interaction, current: str):
-        async with self.bot.pool.acquire() as con:
-            res = await con.execute("SELECT name FROM players")
-
-            data = await res.fetchall()
-            players = [player[0] for player in data]
-
+        # Search names by prefix and similarity, ranked towards the tier and orgs of the series
         choices = []
-        matched_players = [p for p in players if p.lower().startswith(current.lower())]
-        for player in matched_players:
-            if len(choices) > 23:
-                logger.debug("Truncating autocomplete choices (players)")
-                break
-            else:
-                choices.append(app_commands.Choice(name=player, value=player))
+        for name, status in self.bot.league.search_players(current, interaction):
+            label = f"{name} (SUB)" if status == "sub" else name
+            choices.append(app_commands.Choice(name=label, value=name))
 
         logger.debug(f"Generated {len(choices)} player choices")
         return choices
@@ -0,0 +1,192 @@
+import logging
+import json
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import discord
+from discord.ext import commands, tasks
+from discord import app_commands
+import asyncio
+
+import get_stats
+from draw_stats import draw
+from utils.ballchasing_api import AsyncAPI
+from utils.profiling import profile_calls
+
+logger = logging.getLogger("bot.ingestion")
+
+with open("../config.json", "r") as read_file:
+    config = json.load(read_file)
+
+GUILD_ID = config["GUILD_ID"]
+BALLCHASING_KEY = config["BALLCHASING_KEY"]
+
+INGESTION = config.get("INGESTION", {})
+
+# Whether the bot drains the stats stack itself instead of get_stats.py being run by cron. The
+# cron job must be disabled when this is on, or both will process the same entries
+IN_PROCESS = INGESTION.get("in_process", False)
+
+# How often to check the stats stack for entries pushed by other processes, in seconds
+POLL_INTERVAL = INGESTION.get("poll_interval", 60)
+
+
+class Ingestion(commands.Cog):
+    def __init__(self, bot):
+        self.bot = bot
+
+        # Set whenever there may be entries on the stats stack, waking the ingester
+        self.ingest_wakeup = asyncio.Event()
+
+        # Stats graphics are drawn in a separate process so that rendering doesn't block the
+        # event loop. Spawned rather than forked, as forking the running bot while one of its
+        # threads (the database pool, the log listener or the event loop) holds a lock could
+        # deadlock the worker. Spawning imports main.py in the worker, which doesn't start the bot
+        self.renderer = ProcessPoolExecutor(
+            max_workers=1, mp_context=multiprocessing.get_context("spawn")
+        )
+
+        self.poll_stats_stack.change_interval(seconds=POLL_INTERVAL)
+        self.poll_stats_stack.start()
+
+    async def cog_load(self):
+        self.ballchasing = AsyncAPI(BALLCHASING_KEY)
+        self.ingester = asyncio.create_task(self.ingest_queue())
+
+    async def cog_unload(self):
+        self.poll_stats_stack.cancel()
+        self.ingester.cancel()
+        await self.ballchasing.close()
+        self.renderer.shutdown(wait=False, cancel_futures=True)
+
+    # Ping ingestion cog
+    @app_commands.command(description="Ping the ingestion cog")
+    @app_commands.guilds(discord.Object(id=GUILD_ID))
+    async def ping_ingestion(self, interaction: discord.Interaction):
+        logger.debug(f"/ping_ingestion used by {interaction.user.id}")
+        await interaction.response.send_message("Pong!", ephemeral=True)
+
+    # Dispatched (with bot.dispatch("stats_pushed")) whenever entries are pushed to the stats stack
+    # in process, so they're ingested without waiting for the poll
+    @commands.Cog.listener()
+    async def on_stats_pushed(self):
+        logger.debug("Stats pushed, waking ingester")
+        self.ingest_wakeup.set()
+
+    # Fallback for entries pushed by other processes
+    @tasks.loop(seconds=60)
+    async def poll_stats_stack(self):
+        self.ingest_wakeup.set()
+
+    @poll_stats_stack.before_loop
+    async def before_poll_stats_stack(self):
+        logger.debug("Poll stats stack task loop waiting for bot startup")
+        await self.bot.wait_until_ready()
+
+    # Process the stats stack, highest priority first, until it's empty whenever woken
+    async def ingest_queue(self):
+        await self.bot.wait_until_ready()
+
+        while True:
+            await self.ingest_wakeup.wait()
+            self.ingest_wakeup.clear()
+
+            try:
+                while await self.ingest_next():
+                    pass
+            except Exception as e:
+                logger.error(f"Failed to ingest stats ({type(e).__name__}: {e})")
+
+    # Process the top entry of the stats stack, returning False if the stack is empty
+    @profile_calls("ingest_stats")
+    async def ingest_next(self):
+        async with self.bot.pool.acquire() as con:
+            res = await con.execute(get_stats.STACK_TOP_QUERY)
+            entry = await res.fetchone()
+
+            if entry is None:
+                logger.debug("No stats on the stack")
+                return False
+
+            entry = tuple(entry)
+            logger.info(f"Popped entry from stats stack - {entry}")
+
+            res = await con.execute(get_stats.SERIES_QUERY, (entry[1],))
+            series = await res.fetchone()
+            if series is not None:
+                series = tuple(series)
+            res = await con.execute(get_stats.GUIDS_QUERY, (entry[1],))
+            existing_guids = [row["guid"] for row in await res.fetchall()]
+
+        t1 = time.perf_counter()
+
+        # Search ballchasing without holding a connection, as this waits on the API
+        rows = []
+        search = get_stats.build_search(entry, series, existing_guids, self.bot.league.identities)
+        if search is not None:
+            rows = await self.fetch_replays(search)
+        found = round(time.time())
+
+        # Store the replays, pop the entry and update the series and its timeline in one
+        # transaction
+        async with self.bot.pool.acquire() as con:
+            async with con.transaction():
+                for game_row, player_rows in rows:
+                    await con.execute(get_stats.INSERT_GAME_STATS, game_row)
+                    await con.executemany(get_stats.INSERT_PLAYER_STATS, player_rows)
+
+                await con.execute(get_stats.POP_STACK_QUERY, (entry[0],))
+                await con.execute(get_stats.UPDATE_SERIES_QUERY, (entry[1], entry[1]))
+                await con.execute(
+                    get_stats.TIMELINE_STORED_QUERY,
+                    (found if rows else None, round(time.time()), entry[1]),
+                )
+
+        logger.info(
+            f"Stored {len(rows)} replays for {entry[1]} in {round(time.perf_counter() - t1, 3)}s"
+        )
+
+        try:
+            await asyncio.get_running_loop().run_in_executor(self.renderer, draw, entry[1])
+            async with self.bot.pool.acquire() as con:
+                await con.execute(get_stats.TIMELINE_DRAWN_QUERY, (round(time.time()), entry[1]))
+        except Exception as e:
+            logger.error(f"Failed to draw stats for {entry[1]} ({type(e).__name__}: {e})")
+
+        # Publish the series without waiting for the publisher's poll
+        self.bot.dispatch("stats_stored", entry[1])
+
+        return True
+
+    # Async version of get_stats.fetch_replays, returning the rows to store
+    async def fetch_replays(self, search):
+        rows = []
+        if search["replay_id"] is not None:
+            # Get the specified replay id, if it doesn't exist this will return {}
+            replay_data = await self.ballchasing.get(search["replay_id"])
+            get_stats.add_replay(search, rows, search["replay_id"], replay_data)
+            return rows
+
+        # Filter the replays, then get each one in turn
+        filtered_replays = await self.ballchasing.filter(
+            search["start"], search["end"], search["players"]
+        )
+        logger.info(f"Filter found {filtered_replays['count']} replays")
+        for replay in filtered_replays["list"]:
+            await asyncio.sleep(1)
+            logger.debug(f"Getting replay with id {replay['id']}")
+            replay_data = await self.ballchasing.get(replay["id"])
+            if not get_stats.add_replay(search, rows, replay["id"], replay_data):
+                break
+
+        return rows
+
+
+async def setup(bot):
+    # Only run in process when configured to, otherwise get_stats.py is run by cron
+    if not IN_PROCESS:
+        logger.info("In process ingestion disabled, not adding ingestion cog")
+        return
+
+    await bot.add_cog(Ingestion(bot))
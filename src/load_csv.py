@@ -0,0 +1,463 @@
+import os
+import re
+import csv
+import sys
+import json
+import time
+import sqlite3
+import logging
+import argparse
+
+import utils.db as db
+from utils.log import setup_logging
+
+with open("../config.json", "r") as read_file:
+    config = json.load(read_file)
+
+ORGS = config["ORGS"]
+TIERS = config["TIERS"]
+
+logger = logging.getLogger("script.load_csv")
+
+setup_logging()
+
+DATA_DIR = "../data"
+
+# Number of rows validated and inserted at a time
+BATCH_SIZE = 5000
+
+# Name of the org with each id, as fixtures store orgs by id
+ORG_NAMES = {org["id"]: name for name, org in ORGS.items()}
+
+# Change events older than this many seconds are removed whenever a sync is made. The bot picks
+# them up within a minute, so this only needs to cover it being restarted
+CHANGE_RETENTION = 7 * 24 * 60 * 60
+
+# Tables which can be synced with a CSV file instead of reloaded, with the query for the rows the
+# file replaces, the table's columns, and those in its primary key
+SYNCS = {
+    "players": (
+        "SELECT * FROM players WHERE status = 'main'",
+        ("id", "status", "name", "platform", "platform_id", "tier", "org"),
+        ("id", "status"),
+    ),
+    "fixtures": (
+        "SELECT * FROM fixtures",
+        ("week", "tier", "org_1", "org_2"),
+        ("week", "tier", "org_1", "org_2"),
+    ),
+}
+
+
+# Raised when a row of a CSV file can't be loaded
+class BadRow(Exception):
+    pass
+
+
+def integer(value, column):
+    try:
+        return int(value)
+    except ValueError:
+        raise BadRow(f"{column} must be an integer, not {value!r}") from None
+
+
+def text(value, column):
+    if value.strip() == "":
+        raise BadRow(f"{column} is empty")
+    return value
+
+
+def optional(value):
+    return None if value == "" else value
+
+
+def tier(value):
+    if value not in TIERS:
+        raise BadRow(f"unknown tier {value!r}")
+    return value
+
+
+def org(value):
+    if value not in ORGS:
+        raise BadRow(f"unknown org {value!r}")
+    return value
+
+
+# Convert a row of player_info.csv (discord id, name, platform, platform id, tier, org) to a row
+# of the players table. Every player loaded is on a main roster
+def convert_player(row):
+    return (
+        integer(row[0], "discord id"),
+        "main",
+        text(row[1], "name"),
+        text(row[2], "platform"),
+        text(row[3], "platform id"),
+        tier(row[4]),
+        org(row[5]),
+    )
+
+
+# Convert a row of fixtures.csv (week, tier, org 1, org 2) to a row of the fixtures table, which
+# stores orgs by id
+def convert_fixture(row):
+    return (
+        integer(row[0], "week"),
+        tier(row[1]),
+        ORGS[org(row[2])]["id"],
+        ORGS[org(row[3])]["id"],
+    )
+
+
+# Convert a row of series_log.csv (timestamp, game id, tier, mode, winning org, losing org, games
+# won by loser, played previously) to a row of the series_log table. Loaded series have had no
+# replays searched for and are unpublished
+def convert_series(row):
+    mode = integer(row[3], "mode")
+    if mode not in (1, 2, 3):
+        raise BadRow(f"mode must be 1, 2 or 3, not {mode}")
+
+    return (
+        integer(row[0], "timestamp"),
+        integer(row[1], "game id"),
+        tier(row[2]),
+        mode,
+        org(row[4]),
+        org(row[5]),
+        integer(row[6], "games won by loser"),
+        integer(row[7], "played previously"),
+        None,
+        0,
+    )
+
+
+# Convert a row of series_players.csv (game id, then the names of up to three winning and three
+# losing players, blank if the mode has fewer) to a row of the series_players table
+def convert_series_players(row):
+    return (integer(row[0], "game id"), *(optional(name) for name in row[1:7]))
+
+
+# A CSV file loaded into a table. key is the positions of the table's primary key in a converted
+# row, used to catch duplicates. If the table references a parent loaded before it, the first
+# value of each row must be the key of a row loaded into the parent
+class Source:
+    def __init__(self, file, columns, convert, insert, key, parent=None):
+        self.file = file
+        self.columns = columns
+        self.convert = convert
+        self.insert = insert
+        self.key = key
+        self.parent = parent
+
+        # Primary keys of the rows loaded so far, stored as {key: line number}
+        self.keys = {}
+
+
+# What can be loaded, i.e. the statements clearing the rows being replaced, the files loaded in
+# order, and the statements run once they have been
+def get_loads():
+    series = Source(
+        "series_log.csv",
+        8,
+        convert_series,
+        "INSERT INTO series_log VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (1,),
+    )
+
+    return {
+        "players": (
+            ["DELETE FROM players WHERE status = 'main'"],
+            [
+                Source(
+                    "player_info.csv",
+                    6,
+                    convert_player,
+                    "INSERT INTO players VALUES(?, ?, ?, ?, ?, ?, ?)",
+                    (0, 1),
+                )
+            ],
+            [],
+        ),
+        "fixtures": (
+            ["DELETE FROM fixtures"],
+            [
+                Source(
+                    "fixtures.csv",
+                    4,
+                    convert_fixture,
+                    "INSERT INTO fixtures VALUES(?, ?, ?, ?)",
+                    (0, 1, 2, 3),
+                )
+            ],
+            [],
+        ),
+        # Referential integrity constraints are not enforced when loading results, as this is
+        # considered a setup operation, so that the stats of reloaded series are kept. Timelines
+        # of reloaded series are kept too, but those of series no longer in the log are removed
+        "results": (
+            ["DELETE FROM series_log", "DELETE FROM series_players"],
+            [
+                series,
+                Source(
+                    "series_players.csv",
+                    7,
+                    convert_series_players,
+                    "INSERT INTO series_players VALUES(?, ?, ?, ?, ?, ?, ?)",
+                    (0,),
+                    series,
+                ),
+            ],
+            ["DELETE FROM series_timeline WHERE game_id NOT IN (SELECT game_id FROM series_log)"],
+        ),
+    }
+
+
+# Read a CSV file in batches of (line number, row), skipping blank lines and the header. The
+# header is the first row if its first value isn't a number
+def read_batches(path):
+    with open(path, "r", newline="") as csv_file:
+        reader = csv.reader(csv_file, delimiter=",")
+
+        batch = []
+        for row in reader:
+            if row == [] or all(value.strip() == "" for value in row):
+                continue
+            if reader.line_num == 1 and re.fullmatch(r"-?\d+", row[0].strip()) is None:
+                continue
+
+            batch.append((reader.line_num, row))
+            if len(batch) == BATCH_SIZE:
+                yield batch
+                batch = []
+
+        if batch != []:
+            yield batch
+
+
+# Validate and convert a batch of rows, returning the converted rows and a list of
+# (line number, error) for the bad ones
+def convert_batch(source, batch):
+    rows = []
+    errors = []
+    for line, row in batch:
+        try:
+            if len(row) != source.columns:
+                raise BadRow(f"expected {source.columns} values, got {len(row)}")
+
+            converted = source.convert(row)
+
+            key = tuple(converted[i] for i in source.key)
+            if key in source.keys:
+                raise BadRow(f"duplicate of line {source.keys[key]}")
+            if source.parent is not None and (converted[0],) not in source.parent.keys:
+                raise BadRow(f"{converted[0]} is not in {source.parent.file}")
+        except BadRow as e:
+            errors.append((line, str(e)))
+            continue
+
+        source.keys[key] = line
+        rows.append(converted)
+
+    return rows, errors
+
+
+# Stream a source into the database. Rows stop being inserted after the first bad one, as the load
+# will be rolled back, but every row is still validated so that all the errors are added to errors.
+# Returns the number of valid rows
+def load_source(cur, source, path, errors):
+    num_rows = 0
+    for batch in read_batches(path):
+        rows, batch_errors = convert_batch(source, batch)
+        errors += [(source.file, line, error) for line, error in batch_errors]
+
+        if errors == []:
+            try:
+                cur.executemany(source.insert, rows)
+            except sqlite3.Error as e:
+                errors.append((source.file, batch[0][0], f"{e} (in lines up to {batch[-1][0]})"))
+        num_rows += len(rows)
+
+    return num_rows
+
+
+# Load the CSV files of one kind of data in a single transaction, so that nothing is changed
+# unless every row is valid. Returns False if the load was rolled back
+def load(kind, data_dir=DATA_DIR):
+    clear, sources, after = get_loads()[kind]
+
+    con = db.connect()
+    if kind == "results":
+        con.execute("PRAGMA foreign_keys = OFF")
+
+    t1 = time.perf_counter()
+    cur = con.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        for statement in clear:
+            cur.execute(statement)
+
+        errors = []
+        counts = []
+        for source in sources:
+            counts.append(load_source(cur, source, os.path.join(data_dir, source.file), errors))
+
+        if errors != []:
+            con.rollback()
+            for file, line, error in errors:
+                print(f"{file}:{line}: {error}")
+            print(f"{len(errors)} bad rows, nothing loaded")
+            logger.error(f"Failed to load {kind} ({len(errors)} bad rows)")
+            return False
+
+        for statement in after:
+            cur.execute(statement)
+        con.commit()
+    except BaseException:
+        con.rollback()
+        raise
+    finally:
+        con.close()
+
+    elapsed = time.perf_counter() - t1
+    total = sum(counts)
+    for source, count in zip(sources, counts):
+        print(f"{count} rows loaded from {source.file}")
+    print(f"Loaded {total} rows in {elapsed:.3f}s ({round(total / elapsed)} rows/s)")
+    logger.info(f"Loaded {total} rows of {kind} in {round(elapsed, 3)}s")
+
+    return True
+
+
+# Get the (tier, org, week) affected by a row of the players or fixtures tables. week is None for
+# players, and a fixture affects both of its orgs
+def affected_by(kind, row):
+    if kind == "players":
+        return [(row[5], row[6], None)]
+    return [(row[1], ORG_NAMES[row[2]], row[0]), (row[1], ORG_NAMES[row[3]], row[0])]
+
+
+# Describe a row of the players or fixtures tables for the change summary
+def describe(kind, row):
+    if kind == "players":
+        return f"{row[2]} ({row[0]}, {row[3]} {row[4]}) in {row[5]} {row[6]}"
+    return f"{row[1]} week {row[0]}: {ORG_NAMES[row[2]]} vs {ORG_NAMES[row[3]]}"
+
+
+# Sync the players or fixtures tables with a CSV file, applying only the rows added, changed and
+# removed (by primary key) in a single transaction, and recording the tiers, orgs and weeks they
+# affect in league_changes for the bot. Returns False if nothing was changed as the file has bad
+# rows
+def sync(kind, data_dir=DATA_DIR):
+    query, columns, key_columns = SYNCS[kind]
+    source = get_loads()[kind][1][0]
+    key = [columns.index(column) for column in key_columns]
+    values = [i for i in range(len(columns)) if i not in key]
+
+    con = db.connect()
+
+    t1 = time.perf_counter()
+    cur = con.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        errors = []
+        rows = {}
+        for batch in read_batches(os.path.join(data_dir, source.file)):
+            converted, batch_errors = convert_batch(source, batch)
+            errors += [(source.file, line, error) for line, error in batch_errors]
+            rows.update((tuple(row[i] for i in key), row) for row in converted)
+
+        if errors != []:
+            con.rollback()
+            for file, line, error in errors:
+                print(f"{file}:{line}: {error}")
+            print(f"{len(errors)} bad rows, nothing changed")
+            logger.error(f"Failed to sync {kind} ({len(errors)} bad rows)")
+            return False
+
+        existing = {tuple(row[i] for i in key): tuple(row) for row in cur.execute(query).fetchall()}
+
+        added = [row for k, row in rows.items() if k not in existing]
+        removed = [row for k, row in existing.items() if k not in rows]
+        changed = [(existing[k], row) for k, row in rows.items() if existing.get(k, row) != row]
+
+        where = " AND ".join(f"{column} = ?" for column in key_columns)
+        cur.executemany(f"INSERT INTO {kind} VALUES({', '.join('?' * len(columns))})", added)
+        # Every column of a fixture is part of its key, so fixtures are only ever added or removed
+        if changed != []:
+            assignments = ", ".join(f"{columns[i]} = ?" for i in values)
+            cur.executemany(
+                f"UPDATE {kind} SET {assignments} WHERE {where}",
+                [tuple(new[i] for i in values + key) for _, new in changed],
+            )
+        cur.executemany(
+            f"DELETE FROM {kind} WHERE {where}", [tuple(row[i] for i in key) for row in removed]
+        )
+
+        affected = set()
+        for row in added + removed + [row for pair in changed for row in pair]:
+            affected.update(affected_by(kind, row))
+
+        now = round(time.time())
+        cur.executemany(
+            "INSERT INTO league_changes(timestamp, kind, tier, org, week) VALUES(?, ?, ?, ?, ?)",
+            [(now, kind, *change) for change in sorted(affected, key=str)],
+        )
+        cur.execute("DELETE FROM league_changes WHERE timestamp < ?", (now - CHANGE_RETENTION,))
+        con.commit()
+    except BaseException:
+        con.rollback()
+        raise
+    finally:
+        con.close()
+
+    elapsed = time.perf_counter() - t1
+    for row in added:
+        print(f"+ {describe(kind, row)}")
+    for old, new in changed:
+        print(f"~ {describe(kind, old)} -> {describe(kind, new)}")
+    for row in removed:
+        print(f"- {describe(kind, row)}")
+
+    summary = f"{len(added)} added, {len(changed)} changed, {len(removed)} removed"
+    print(f"Synced {len(rows)} {kind} in {elapsed:.3f}s: {summary}")
+    if affected:
+        tiers = sorted({str(tier) for tier, _, _ in affected})
+        orgs = sorted({str(org) for _, org, _ in affected})
+        print(f"Affected tiers: {', '.join(tiers)}. Affected orgs: {', '.join(orgs)}")
+    logger.info(f"Synced {kind} in {round(elapsed, 3)}s ({summary})")
+
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replace the players, fixtures or results in the database from CSV files"
+    )
+    parser.add_argument("kind", choices=["players", "fixtures", "results"])
+    parser.add_argument(
+        "--data-dir", default=DATA_DIR, help="Directory containing the CSV files to load"
+    )
+    parser.add_argument(
+        "--sync",
+        action="store_true",
+        help="Only apply the rows added, changed or removed (players and fixtures only)",
+    )
+    args = parser.parse_args()
+
+    if args.sync and args.kind not in SYNCS:
+        parser.error(f"{args.kind} can't be synced")
+
+    if not os.path.exists(db.DB_FILE):
+        print("Database does not exist")
+        sys.exit(1)
+
+    if args.sync:
+        success = sync(args.kind, args.data_dir)
+    else:
+        success = load(args.kind, args.data_dir)
+
+    if not success:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
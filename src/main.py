@@ -1,25 +1,30 @@
+import io
 import logging
 from os import listdir
 import json
+import sqlite3
+import datetime as dt
+from typing import Literal
+from contextlib import ExitStack
 import asqlite
 
 import discord
 from discord.ext import commands
+from discord import app_commands
 import asyncio
 
+from utils.db import DATABASE, DB_FILE, STATEMENT_CACHE, apply_pragmas
+from utils.league_cache import LeagueCache
+from utils.log import LOG_FILE, MAX_AGE_HOURS, setup_logging, tail
+import utils.perf as perf
+import utils.sql_stats as sql_stats
+import utils.profiling as profiling
+from utils.migrations import LATEST_VERSION, get_version
 
-logger = logging.getLogger("bot.main")
 
-# Suppress shard related logs from discord.gateway
-logging.getLogger("discord.gateway").setLevel(30)
+logger = logging.getLogger("bot.main")
 
-logging.basicConfig(
-    filename="../logs/rlis.log",
-    encoding="utf-8",
-    datefmt="%Y-%m-%d %H:%M:%S",
-    format="[%(asctime)s] [%(levelname)-8s] %(name)s: %(message)s",
-    level=logging.DEBUG,
-)
+setup_logging()
 
 logger.debug(f"Starting logger")
 
@@ -31,25 +36,88 @@ TOKEN = config["TOKEN"]
 GUILD_ID = config["GUILD_ID"]
 PREFIX = config["PREFIX"]
 
+# Most log records /tail_logs will return
+MAX_TAIL_LINES = 500
+
+# Furthest back /tail_logs can look, in minutes. The current log file is never older than this
+MAX_TAIL_MINUTES = MAX_AGE_HOURS * 60
+
+# Longest /profile waits for the invocations it's profiling, in seconds
+PROFILE_TIMEOUT = 600
+
+# Number of connections (and worker threads) in the bot's database pool
+POOL_SIZE = DATABASE.get("pool_size", 10)
+
 intents = discord.Intents.default()
 intents.members = True
 intents.message_content = True
 
 
+# Command tree which times every app command and autocomplete it runs, and profiles them on request
+class RLIS_Tree(app_commands.CommandTree):
+    # The tree runs each interaction (from this check to its command's error handlers) in a task of
+    # its own, so the invocation is started here and finished when that task is done, however the
+    # command ends. The task's context is used for the callback, as invocations reset a context
+    # variable set within it
+    async def interaction_check(self, interaction):
+        name = f"/{interaction.data.get('name')}"
+        if interaction.type is discord.InteractionType.autocomplete:
+            name += " (autocomplete)"
+
+        stack = ExitStack()
+        stack.enter_context(perf.invocation(name))
+        stack.enter_context(profiling.profiled(name))
+
+        task = asyncio.current_task()
+        task.add_done_callback(lambda _: stack.close(), context=task.get_context())
+
+        return True
+
+
 class RLIS_Bot(commands.Bot):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
     async def setup_hook(self):
 
-        # Create a connection pool for future database queries (including those in cogs)
-        self.pool = await asqlite.create_pool("../data/rlis_data.db")
-
-        # Enforce referential integrity constraints
-        async with bot.pool.acquire() as con:
-            await con.execute("PRAGMA foreign_keys = ON")
-
-        logger.info(f"Established connection pool with database")
+        # Refuse to start on a database whose schema is out of date, as the cogs' queries depend on
+        # the latest migrations. Migrations aren't applied here, so that a slow or failing one is
+        # run deliberately (with python utils/migrations.py migrate) rather than on every restart
+        con = sqlite3.connect(DB_FILE)
+        try:
+            version = get_version(con)
+        finally:
+            con.close()
+
+        if version < LATEST_VERSION:
+            logger.critical(f"Database is at schema version {version} of {LATEST_VERSION}")
+            raise RuntimeError(
+                f"Database is at schema version {version}, but the bot needs version "
+                f"{LATEST_VERSION}. Run python utils/migrations.py migrate first"
+            )
+
+        # Create a connection pool for future database queries (including those in cogs), with the
+        # configured pragmas (including foreign key enforcement) applied to every connection
+        # Time spent on queries (and waiting for a connection) is counted towards the command
+        # making them, and each statement's own timings are kept in utils/sql_stats.py
+        self.pool = perf.TimedPool(
+            await asqlite.create_pool(
+                DB_FILE,
+                init=apply_pragmas,
+                size=POOL_SIZE,
+                cached_statements=STATEMENT_CACHE,
+                factory=sql_stats.TimedConnection,
+            )
+        )
+
+        logger.info(f"Established connection pool of {POOL_SIZE} connections with database")
+
+        perf.time_discord_requests(self)
+
+        # Load the orgs, players and fixtures shared by the cogs, and keep them up to date. Changes
+        # synced by load_csv.py are dispatched as league_changed events
+        self.league = LeagueCache(self.pool, self.dispatch)
+        await self.league.start()
 
         # Attempt to load each cog in turn
         cogs = [f[:-3] for f in listdir() if "cog" == f[-6:-3]]
@@ -62,7 +130,7 @@ class RLIS_Bot(commands.Bot):
 
 
 # Create bot instance and initialise slash command tree
-bot = RLIS_Bot(command_prefix=PREFIX, intents=intents)
+bot = RLIS_Bot(command_prefix=PREFIX, intents=intents, tree_cls=RLIS_Tree)
 tree = bot.tree
 
 
@@ -152,20 +220,184 @@ async def ping_db(interaction: discord.Interaction):
     )
 
 
-# Get the current log file
-@tree.command(
-    description="Ping the database via the connection pool", guild=discord.Object(id=GUILD_ID)
-)
+# Get the current log file (older logs are archived alongside it as rlis.log.N.gz)
+@tree.command(description="Get the current log file", guild=discord.Object(id=GUILD_ID))
 async def get_logs(interaction: discord.Interaction):
     logger.debug(f"/get_logs used by {interaction.user.id}")
-    with open("../logs/rlis.log", "rb") as log_file:
+    with open(LOG_FILE, "rb") as log_file:
         await interaction.response.send_message(file=discord.File(log_file))
 
 
+# Get the last records of the current log file, optionally only those from a logger (and the
+# loggers below it), of at least a level, or from the last number of minutes
+@tree.command(description="Get the end of the current log file", guild=discord.Object(id=GUILD_ID))
+async def tail_logs(
+    interaction: discord.Interaction,
+    lines: app_commands.Range[int, 1, MAX_TAIL_LINES] = 50,
+    name: str = None,
+    level: Literal["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"] = None,
+    minutes: app_commands.Range[int, 1, MAX_TAIL_MINUTES] = None,
+):
+    logger.debug(f"/tail_logs used by {interaction.user.id}")
+
+    since = None
+    if minutes is not None:
+        since = dt.datetime.now() - dt.timedelta(minutes=minutes)
+
+    records = await asyncio.to_thread(tail, lines, name, level, since)
+
+    if records == []:
+        await interaction.response.send_message("No matching log records", ephemeral=True)
+        return
+
+    await send_text(interaction, "\n".join(records), "rlis_tail.log")
+
+
+# Round a time in seconds to milliseconds for display
+def ms(seconds):
+    return f"{round(seconds * 1000)}ms"
+
+
+# Get p50/p95/p99 timings of every command and autocomplete, or the breakdown and slowest recent
+# invocations of one of them
+@tree.command(
+    description="Get timings of recent commands", guild=discord.Object(id=GUILD_ID)
+)
+async def perf_stats(interaction: discord.Interaction, name: str = None):
+    logger.debug(f"/perf_stats used by {interaction.user.id}")
+
+    if name is None:
+        lines = [f"{'name':<40} {'count':>6} {'p50':>7} {'p95':>7} {'p99':>7}"]
+        for command, histogram in sorted(perf.histograms.items()):
+            p50, p95, p99 = histogram.percentiles()
+            lines.append(
+                f"{command:<40} {histogram.count:>6} {ms(p50):>7} {ms(p95):>7} {ms(p99):>7}"
+            )
+    elif name in perf.histograms:
+        histogram = perf.histograms[name]
+        lines = [
+            f"{name} ({histogram.count} invocations, last {len(histogram.samples)} shown)",
+            "",
+            f"{'part':<8} {'p50':>7} {'p95':>7} {'p99':>7}",
+        ]
+        for part in (None,) + perf.PARTS:
+            p50, p95, p99 = histogram.percentiles(part)
+            lines.append(f"{part or 'total':<8} {ms(p50):>7} {ms(p95):>7} {ms(p99):>7}")
+
+        lines += ["", "Slowest:"]
+        for finished, total, parts in histogram.slowest():
+            finished = dt.datetime.fromtimestamp(finished)
+            breakdown = ", ".join(f"{part} {ms(parts[part])}" for part in perf.PARTS)
+            lines.append(f"{finished:%Y-%m-%d %H:%M:%S} {ms(total):>7} ({breakdown})")
+    else:
+        await interaction.response.send_message("No timings for that command", ephemeral=True)
+        return
+
+    await send_text(interaction, "\n".join(lines), "perf_stats.txt")
+
+
+@perf_stats.autocomplete("name")
+async def perf_stats_name_autocomplete(interaction: discord.Interaction, current: str):
+    choices = []
+    for name in sorted(perf.histograms):
+        if current.lower() in name.lower():
+            choices.append(app_commands.Choice(name=name, value=name))
+
+    return choices[:25]
+
+
+# Get the number of executions and total, mean and max time of every SQL statement run by the bot
+# since it started (or since the stats were last reset)
+@tree.command(description="Get timings of SQL statements", guild=discord.Object(id=GUILD_ID))
+async def query_stats(interaction: discord.Interaction, reset: bool = False):
+    logger.debug(f"/query_stats used by {interaction.user.id}")
+
+    text = sql_stats.dump()
+    if reset:
+        sql_stats.reset()
+        logger.info("Reset query stats")
+
+    await send_text(interaction, text, "query_stats.txt")
+
+
+# Profile the next invocations of an app command (e.g. /standings), background task or rendering
+# function, replying with the reports once they've all run
+@tree.command(
+    description="Profile the next runs of a command or task", guild=discord.Object(id=GUILD_ID)
+)
+async def profile(
+    interaction: discord.Interaction, name: str, count: app_commands.Range[int, 1, 5] = 1
+):
+    logger.debug(f"/profile used by {interaction.user.id}")
+
+    if name not in profile_names(interaction):
+        await interaction.response.send_message(f"Unable to profile {name}", ephemeral=True)
+        return
+
+    try:
+        request = profiling.request(name, count, asyncio.get_running_loop())
+    except profiling.AlreadyRequested:
+        await interaction.response.send_message(
+            f"{name} is already waiting to be profiled", ephemeral=True
+        )
+        return
+
+    await interaction.response.send_message(
+        f"Profiling the next {count} invocation(s) of {name}", ephemeral=True
+    )
+
+    try:
+        files = await asyncio.wait_for(request.future, PROFILE_TIMEOUT)
+        message = f"Profiles of {name}:"
+    except asyncio.TimeoutError:
+        profiling.cancel(name, request)
+        files = list(request.files)
+        message = (
+            f"Gave up profiling {name} after {PROFILE_TIMEOUT // 60} minutes, "
+            f"{len(files) // 2}/{count} invocation(s) profiled"
+        )
+        logger.warning(f"/profile of {name} timed out")
+
+    attachments = [discord.File(path) for path in files]
+    try:
+        await interaction.followup.send(message, files=attachments, ephemeral=True)
+    except discord.HTTPException:
+        # The interaction expires after 15 minutes, so reply in the channel instead
+        attachments = [discord.File(path) for path in files]
+        await interaction.channel.send(message, files=attachments)
+
+
+# Names /profile accepts, i.e. app commands and the targets which run in the bot's own process
+def profile_names(interaction):
+    names = {f"/{command.name}" for command in tree.get_commands(guild=interaction.guild)}
+    return names | profiling.bot_targets
+
+
+@profile.autocomplete("name")
+async def profile_name_autocomplete(interaction: discord.Interaction, current: str):
+    choices = []
+    for name in sorted(profile_names(interaction)):
+        if current.lower() in name.lower():
+            choices.append(app_commands.Choice(name=name, value=name))
+
+    return choices[:25]
+
+
+# Send text in a code block, or as a file if it's too long for a message
+async def send_text(interaction, text, filename):
+    if len(text) <= 1900:
+        await interaction.response.send_message(f"```\n{text}\n```", ephemeral=True)
+    else:
+        f = discord.File(io.BytesIO(text.encode("utf-8")), filename=filename)
+        await interaction.response.send_message(file=f, ephemeral=True)
+
+
 # Start bot
 async def main():
     logger.debug("Attempting to launch bot")
     await bot.start(TOKEN)
 
 
-asyncio.run(main())
+# Guarded, as processes spawned by the bot (i.e. the ingestion cog's renderer) import this module
+if __name__ == "__main__":
+    asyncio.run(main())
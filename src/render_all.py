@@ -0,0 +1,117 @@
+import json
+import time
+import logging
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import update_standings
+import update_results
+import draw_stats
+from utils.asset_store import get_store
+from utils.log import setup_logging
+
+with open("../config.json", "r") as read_file:
+    config = json.load(read_file)
+
+TIERS = config["TIERS"]
+
+logger = logging.getLogger("script.render_all")
+
+setup_logging()
+
+KINDS = ["standings", "results", "stats"]
+
+
+# Get the data for every graphic of the requested kinds, returning a list of render jobs
+def get_jobs(kinds):
+    jobs = []
+
+    if "standings" in kinds:
+        standings = update_standings.get_all_data()
+        for tier in list(TIERS.keys()) + ["Overall"]:
+            jobs.append(("standings", tier, standings[tier]))
+
+    if "results" in kinds:
+        for tier in TIERS:
+            for week, data in update_results.get_all_data(tier).items():
+                jobs.append(("results", (tier, week), data))
+
+    if "stats" in kinds:
+        for game_id, data in draw_stats.get_all_data().items():
+            jobs.append(("stats", game_id, data))
+
+    return jobs
+
+
+# Render a single graphic - run in a worker process
+def render(job):
+    kind, name, data = job
+    t1 = time.perf_counter()
+
+    if kind == "standings":
+        update_standings.edit_graphic(name, data)
+    elif kind == "results":
+        update_results.edit_graphic(name[0], name[1], data)
+    elif kind == "stats":
+        draw_stats.draw_data(name, data)
+
+    return kind, name, time.perf_counter() - t1
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Regenerate every graphic for the season")
+    parser.add_argument(
+        "--only", choices=KINDS, action="append", help="Only render this kind of graphic"
+    )
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes")
+    args = parser.parse_args()
+
+    kinds = args.only if args.only else KINDS
+
+    t_start = time.perf_counter()
+
+    # Map the asset store before the workers are forked so that they share it
+    get_store()
+
+    jobs = get_jobs(kinds)
+    t_fetched = time.perf_counter()
+
+    logger.info(f"Fetched data for {len(jobs)} graphics in {round(t_fetched - t_start, 3)}s")
+    print(f"Fetched data for {len(jobs)} graphics in {t_fetched - t_start:.2f}s")
+
+    timings = {kind: [] for kind in kinds}
+    failed = []
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(render, job): job for job in jobs}
+        for i, future in enumerate(as_completed(futures), 1):
+            kind, name = futures[future][:2]
+            try:
+                _, _, elapsed = future.result()
+                timings[kind].append(elapsed)
+                print(f"[{i}/{len(jobs)}] {kind} {name} ({elapsed:.2f}s)")
+            except Exception as e:
+                logger.error(f"Failed to render {kind} graphic {name} ({type(e).__name__}: {e})")
+                failed.append((kind, name))
+                print(f"[{i}/{len(jobs)}] {kind} {name} FAILED ({type(e).__name__}: {e})")
+
+    t_end = time.perf_counter()
+
+    print("\nSummary:")
+    print(f"\tData fetch: {t_fetched - t_start:.2f}s")
+    for kind, times in timings.items():
+        if times:
+            print(
+                f"\t{kind}: {len(times)} rendered, total {sum(times):.2f}s, "
+                f"mean {sum(times) / len(times):.3f}s, max {max(times):.3f}s"
+            )
+    if failed:
+        print(f"\t{len(failed)} failed: {', '.join(f'{k} {n}' for k, n in failed)}")
+    print(f"\tWall time: {t_end - t_start:.2f}s")
+
+    logger.info(
+        f"Rendered {len(jobs) - len(failed)}/{len(jobs)} graphics in {round(t_end - t_start, 3)}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -12,6 +12,8 @@ from discord.ext import commands
 from discord import app_commands
 import asyncio
 
+import utils.perf as perf
+
 
 logger = logging.getLogger("bot.reporting")
 
@@ -29,28 +31,6 @@ class Reporting(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
 
-        self.PLAYERS = []
-        self.SUBS = []
-
-    # Query the database for registered players - done on first use of /report_...
-    async def get_players(self):
-        self.PLAYERS = []
-        async with self.bot.pool.acquire() as con:
-            res = await con.execute("SELECT name FROM players WHERE status = 'main'")
-            for row in await res.fetchall():
-                self.PLAYERS.append(row["name"])
-
-        logger.info("Successfully fetched players from database")
-
-    # Query the database for registered subs - done on first use of /report_...
-    async def get_subs(self):
-        self.SUBS = []
-        async with self.bot.pool.acquire() as con:
-            res = await con.execute("SELECT name FROM players WHERE status = 'sub'")
-            for row in await res.fetchall():
-                self.SUBS.append(row["name"])
-        logger.info("Successfully fetched subs from database")
-
     async def generate_game_id(self, org1, org2, tier, mode):
         org1_id = ORGS[org1]["id"]
         org2_id = ORGS[org2]["id"]
@@ -96,28 +76,18 @@ class Reporting(commands.Cog):
             return "You must supply either 0 or 6 player arguments"
 
         # Get the players who could have played from the main rosters
-        expected_winning_players = []
-        expected_losing_players = []
-        async with self.bot.pool.acquire() as con:
-            res = await con.execute(
-                "SELECT name, org FROM players WHERE tier = ? AND (org = ? OR org = ?) AND status = 'main'",
-                (tier, winning_org, losing_org),
-            )
-            for row in await res.fetchall():
-                if row[1] == winning_org:
-                    expected_winning_players.append(row[0])
-                else:
-                    expected_losing_players.append(row[0])
+        expected_winning_players = self.bot.league.roster(tier, winning_org)
+        expected_losing_players = self.bot.league.roster(tier, losing_org)
 
         # Check that all entries are either expected, or registered subs
         for player in winning_players:
-            if player not in expected_winning_players and player not in self.SUBS:
+            if player not in expected_winning_players and player not in self.bot.league.subs:
                 logger.warning("Report failing due to invalid player argument")
                 return (
                     "At least one player argument is invalid (Did you forget to register a sub?)"
                 )
         for player in losing_players:
-            if player not in expected_losing_players and player not in self.SUBS:
+            if player not in expected_losing_players and player not in self.bot.league.subs:
                 logger.warning("Report failing due to invalid player argument")
                 return (
                     "At least one player argument is invalid (Did you forget to register a sub?)"
@@ -158,6 +128,8 @@ class Reporting(commands.Cog):
 
         # Write to the series_log table, then to series_players
         # This is needed to maintain referential integrity
+        # Logging the series also starts its timeline in series_timeline, which ingestion and the
+        # publisher fill in
         async with self.bot.pool.acquire() as con:
             await con.execute(
                 """INSERT INTO series_log
@@ -203,7 +175,8 @@ class Reporting(commands.Cog):
         logger.info("Attempting to update standings graphics")
         try:
             t1 = time.time()
-            await asyncio.to_thread(update_s, tiers)
+            with perf.timing("render"):
+                await asyncio.to_thread(update_s, tiers)
             logger.info(
                 f"Successfully updated standings graphics for {len(tiers)} tiers in {round(time.time() - t1, 3)}s"
             )
@@ -216,13 +189,27 @@ class Reporting(commands.Cog):
         logger.info("Attempting to update results graphics")
         try:
             t1 = time.time()
-            await asyncio.to_thread(update_r, tiers, week)
+            with perf.timing("render"):
+                await asyncio.to_thread(update_r, tiers, week)
             logger.info(
                 f"Successfully updated results graphics for {len(tiers)} tiers in {round(time.time() - t1, 3)}s"
             )
         except Exception as e:
             logger.error(f"Failed to update results graphics: {e}")
 
+    # Dispatched (with bot.dispatch("league_changed", changes)) by the league cache when a sync
+    # changes the players or fixtures tables. Rosters aren't drawn on any graphic, so only the
+    # results graphics of the weeks with changed fixtures are updated
+    @commands.Cog.listener()
+    async def on_league_changed(self, changes):
+        weeks = {}
+        for kind, tier, org, week in changes:
+            if kind == "fixtures":
+                weeks.setdefault(week, set()).add(tier)
+
+        for week, tiers in sorted(weeks.items()):
+            await self.update_results_graphics(sorted(tiers), week)
+
     # Ping reporting cog
     @app_commands.command(description="Ping the reporting cog")
     @app_commands.guilds(discord.Object(id=GUILD_ID))
@@ -249,7 +236,7 @@ class Reporting(commands.Cog):
             )
 
         # Update the list of subs
-        await self.get_subs()
+        await self.bot.league.refresh()
 
         logger.info(f"Registered {name} as a sub")
 
@@ -292,16 +279,8 @@ class Reporting(commands.Cog):
 
         # If no player arguments were entered, the winning and losing players were as expected
         if len(winning_players) + len(losing_players) == 0:
-            async with self.bot.pool.acquire() as con:
-                res = await con.execute(
-                    "SELECT name, org FROM players WHERE tier = ? AND (org = ? OR org = ?) AND status = 'main'",
-                    (tier, winning_org, losing_org),
-                )
-                for row in await res.fetchall():
-                    if row[1] == winning_org:
-                        winning_players.append(row[0])
-                    else:
-                        losing_players.append(row[0])
+            winning_players = self.bot.league.roster(tier, winning_org)
+            losing_players = self.bot.league.roster(tier, losing_org)
 
         game_id = await self.generate_game_id(winning_org, losing_org, tier, 3)
 
@@ -337,15 +316,9 @@ class Reporting(commands.Cog):
         await interaction.response.send_message(embed=embed)
 
         # Find what week the fixture is in
-        async with self.bot.pool.acquire() as con:
-            res = await con.execute(
-                """SELECT week FROM fixtures WHERE 
-                tier = ? AND ? IN(org_1, org_2) AND ? IN(org_1, org_2)""",
-                (tier, ORGS[winning_org]["id"], ORGS[losing_org]["id"]),
-            )
-            # This will never fail as the format is round robin, meaning all possible matches
-            # (that get to this point) must be scheduled at some point
-            week = (await res.fetchone())["week"]
+        # This will never fail as the format is round robin, meaning all possible matches
+        # (that get to this point) must be scheduled at some point
+        week = self.bot.league.week_of(tier, winning_org, losing_org)
 
         await self.update_standings_graphics(["Overall", tier])
         await self.update_results_graphics([tier], week)
@@ -418,15 +391,9 @@ class Reporting(commands.Cog):
         await interaction.response.send_message(embed=embed)
 
         # Find what week the fixture is in
-        async with self.bot.pool.acquire() as con:
-            res = await con.execute(
-                """SELECT week FROM fixtures WHERE 
-                tier = ? AND ? IN(org_1, org_2) AND ? IN(org_1, org_2)""",
-                (tier, ORGS[winning_org]["id"], ORGS[losing_org]["id"]),
-            )
-            # This will never fail as the format is round robin, meaning all possible matches
-            # (that get to this point) must be scheduled at some point
-            week = (await res.fetchone())["week"]
+        # This will never fail as the format is round robin, meaning all possible matches
+        # (that get to this point) must be scheduled at some point
+        week = self.bot.league.week_of(tier, winning_org, losing_org)
 
         await self.update_standings_graphics(["Overall", tier])
         await self.update_results_graphics([tier], week)
@@ -497,15 +464,9 @@ class Reporting(commands.Cog):
         await interaction.response.send_message(embed=embed)
 
         # Find what week the fixture is in
-        async with self.bot.pool.acquire() as con:
-            res = await con.execute(
-                """SELECT week FROM fixtures WHERE 
-                tier = ? AND ? IN(org_1, org_2) AND ? IN(org_1, org_2)""",
-                (tier, ORGS[winning_org]["id"], ORGS[losing_org]["id"]),
-            )
-            # This will never fail as the format is round robin, meaning all possible matches
-            # (that get to this point) must be scheduled at some point
-            week = (await res.fetchone())["week"]
+        # This will never fail as the format is round robin, meaning all possible matches
+        # (that get to this point) must be scheduled at some point
+        week = self.bot.league.week_of(tier, winning_org, losing_org)
 
         await self.update_standings_graphics(["Overall", tier])
         await self.update_results_graphics([tier], week)
@@ -552,26 +513,11 @@ class Reporting(commands.Cog):
     @report_1v1.autocomplete("lp1")
     async def players_autocomplete(self, interaction: discord.Interaction, current: str):
 
-        if self.PLAYERS == [] and self.SUBS == []:
-            await self.get_players()
-            await self.get_subs()
-
+        # Search names by prefix and similarity, ranked towards the tier and orgs being reported
         choices = []
-        matched_subs = [p for p in self.SUBS if p.lower().startswith(current.lower())]
-        for player in matched_subs:
-            if len(choices) > 23:
-                logger.debug("Truncating autocomplete choices (subs)")
-                break
-            else:
-                choices.append(app_commands.Choice(name=f"{player} (SUB)", value=player))
-
-        matched_players = [p for p in self.PLAYERS if p.lower().startswith(current.lower())]
-        for player in matched_players:
-            if len(choices) > 23:
-                logger.debug("Truncating autocomplete choices (players)")
-                break
-            else:
-                choices.append(app_commands.Choice(name=player, value=player))
+        for name, status in self.bot.league.search_players(current, interaction):
+            label = f"{name} (SUB)" if status == "sub" else name
+            choices.append(app_commands.Choice(name=label, value=name))
 
         logger.debug(f"Generated {len(choices)} player choices")
         return choices
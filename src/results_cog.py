@@ -1,11 +1,16 @@
 import logging
+import os
 from os import listdir
 import json
+import time
+from urllib.parse import parse_qs, urlparse
 
 import discord
 from discord.ext import commands
 from discord import app_commands
 
+from utils.graphics import encoding_for, upload_path
+
 
 logger = logging.getLogger("bot.results")
 
@@ -27,6 +32,48 @@ class Results(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
 
+        # The most recent upload of each graphic, stored as {path: (version, url)}
+        self.uploads = {}
+
+    # Check whether a previously uploaded attachment url can still be used in an embed. Attachment
+    # urls are signed with a hex expiry timestamp, which is all that's checked - requesting the url
+    # could take longer than the 3s Discord allows for responding to the interaction
+    def attachment_available(self, url):
+        expiry = parse_qs(urlparse(url).query).get("ex")
+        if expiry is None or int(expiry[0], 16) <= time.time() + 60:
+            logger.debug("Cached attachment url has expired")
+            return False
+
+        return True
+
+    # Send a stored graphic, reusing the attachment url of the last upload if the graphic hasn't
+    # changed since, and falling back to uploading the file if not (or if the url has expired)
+    async def send_graphic(self, interaction, output, name):
+        path = upload_path(output, name)
+
+        # Raises FileNotFoundError if the graphic doesn't exist
+        stat = os.stat(path)
+        version = (stat.st_mtime_ns, stat.st_size)
+
+        cached = self.uploads.get(path)
+        if cached is not None and cached[0] == version:
+            if self.attachment_available(cached[1]):
+                embed = discord.Embed()
+                embed.set_image(url=cached[1])
+                logger.debug(f"Reusing uploaded attachment for {path}")
+                await interaction.response.send_message(embed=embed)
+                return
+            del self.uploads[path]
+
+        f = discord.File(path, filename=f"image.{encoding_for(output)['format']}")
+        logger.debug("Ready to send image")
+        await interaction.response.send_message(file=f)
+
+        # Remember where the graphic was uploaded to for future requests
+        message = await interaction.original_response()
+        if message.attachments:
+            self.uploads[path] = (version, message.attachments[0].url)
+
     # Ping results cog
     @app_commands.command(description="Ping the results cog")
     @app_commands.guilds(discord.Object(id=GUILD_ID))
@@ -45,12 +92,7 @@ class Results(commands.Cog):
             player = interaction.user
 
         # Get the tier and org of the necessary player
-        async with self.bot.pool.acquire() as con:
-            res = await con.execute(
-                "SELECT name, tier, org FROM players WHERE id = ?", (player.id,)
-            )
-
-            player_info = await res.fetchone()
+        player_info = self.bot.league.members.get(player.id)
 
         if player_info == None:
             logger.warning("/series_played failing as player does not exist")
@@ -65,25 +107,16 @@ class Results(commands.Cog):
             1: {"won": 0, "lost": 0},
         }
 
-        # Get the number of 3s series wins and losses
+        # Get the number of series won and lost in each mode, including any series the player
+        # subbed into for another org
         async with self.bot.pool.acquire() as con:
             res = await con.execute(
-                """SELECT mode, wp1, wp2, wp3, lp1, lp2, lp3
-                FROM series_log AS L JOIN series_players AS P ON L.game_id = P.game_id
-                WHERE tier = ? AND ? IN (winning_org, losing_org)""",
-                (player_info["tier"], player_info["org"]),
+                """SELECT mode, SUM(won) AS won, COUNT(*) - SUM(won) AS lost
+                FROM series_participation WHERE player = ? GROUP BY mode""",
+                (player_info["name"],),
             )
-            # Data only includes results in the relevant tier where the relevant org was involved
-            data = await res.fetchall()
-            for row in data:
-                winning_players = [row["wp1"], row["wp2"], row["wp3"]]
-                losing_players = [row["lp1"], row["lp2"], row["lp3"]]
-
-                mode = row["mode"]
-                if player_info["name"] in winning_players:
-                    player_record[mode]["won"] += 1
-                if player_info["name"] in losing_players:
-                    player_record[mode]["lost"] += 1
+            for row in await res.fetchall():
+                player_record[row["mode"]] = {"won": row["won"], "lost": row["lost"]}
 
         record_3v3 = f"{player_record[3]["won"]}-{player_record[3]["lost"]}"
         record_2v2 = f"{player_record[2]["won"]}-{player_record[2]["lost"]}"
@@ -111,26 +144,15 @@ class Results(commands.Cog):
         logger.debug(f"/standings used by {interaction.user.id}")
 
         if tier is None:
-            async with self.bot.pool.acquire() as con:
-                res = await con.execute(
-                    "SELECT tier FROM players WHERE id = ?",
-                    (interaction.user.id,),
-                )
-                data = await res.fetchone()
-                if data is None:
-                    logger.warning(
-                        f"/standings failing as no tier was supplied by a non playing user"
-                    )
-                    await interaction.response.send_message("Tier not found")
-                    return
-                else:
-                    tier = data[0]
-
-        f = discord.File(
-            f"../data/graphics/{tier.replace(' ', '_').lower()}.png", filename="image.png"
-        )
-        logger.debug("Ready to send image")
-        await interaction.response.send_message(file=f)
+            member = self.bot.league.members.get(interaction.user.id)
+            if member is None:
+                logger.warning(f"/standings failing as no tier was supplied by a non playing user")
+                await interaction.response.send_message("Tier not found")
+                return
+            else:
+                tier = member["tier"]
+
+        await self.send_graphic(interaction, "standings", tier.replace(" ", "_").lower())
 
     # View the results for a tier
     @app_commands.command(description="View the results for a specified tier in a particular week")
@@ -139,27 +161,17 @@ class Results(commands.Cog):
         logger.debug(f"/results used by {interaction.user.id}")
 
         if tier is None:
-            async with self.bot.pool.acquire() as con:
-                res = await con.execute(
-                    "SELECT tier FROM players WHERE id = ?",
-                    (interaction.user.id,),
-                )
-                data = await res.fetchone()
-                if data is None:
-                    logger.warning(
-                        f"/results failing as no tier was supplied by a non playing user"
-                    )
-                    await interaction.response.send_message("Tier not found")
-                    return
-                else:
-                    tier = data[0]
+            member = self.bot.league.members.get(interaction.user.id)
+            if member is None:
+                logger.warning(f"/results failing as no tier was supplied by a non playing user")
+                await interaction.response.send_message("Tier not found")
+                return
+            else:
+                tier = member["tier"]
         try:
-            f = discord.File(
-                f"../data/graphics/{tier.replace(' ', '_').lower()}_week_{week}.png",
-                filename="image.png",
+            await self.send_graphic(
+                interaction, "results", f"{tier.replace(' ', '_').lower()}_week_{week}"
             )
-            logger.debug("Ready to send image")
-            await interaction.response.send_message(file=f)
         except FileNotFoundError:
             logger.debug("Failed to send image as the required graphic does not exist")
             await interaction.response.send_message("No results to show")
@@ -8,6 +8,9 @@ from discord.ext import commands, tasks
 from discord import app_commands
 import asyncio
 
+from utils.graphics import encoding_for, upload_path
+from utils.profiling import profile_calls
+
 logger = logging.getLogger("bot.tasks")
 
 with open("../config.json", "r") as read_file:
@@ -20,12 +23,34 @@ MAX_GAMES_3v3 = config["MAX_GAMES_3v3"]
 MAX_GAMES_2v2 = config["MAX_GAMES_2v2"]
 MAX_GAMES_1v1 = config["MAX_GAMES_1v1"]
 
+# Number of unpublished series to load at a time
+PUBLISH_BATCH_SIZE = 20
+
+# Target time from a series being reported to its stats being posted, in minutes
+PUBLISH_TARGET_MINUTES = config.get("PERF", {}).get("publish_target_minutes", 30)
+
+# Stages of a series' timeline (see series_timeline in utils/migrations.py) in order, and the gaps
+# between them shown by /publish_latency
+STAGES = ("reported", "replays_found", "stored", "drawn", "posted")
+GAPS = list(zip(STAGES, STAGES[1:])) + [("reported", "posted")]
+
 
 class Tasks(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+
+        # Set whenever there may be series to publish, waking the publisher
+        self.publish_wakeup = asyncio.Event()
+
         self.publish_stats.start()
 
+    async def cog_load(self):
+        self.publisher = asyncio.create_task(self.publish_queue())
+
+    async def cog_unload(self):
+        self.publish_stats.cancel()
+        self.publisher.cancel()
+
     # Ping helper cog
     @app_commands.command(description="Ping the tasks cog")
     @app_commands.guilds(discord.Object(id=GUILD_ID))
@@ -33,107 +58,218 @@ class Tasks(commands.Cog):
         logger.debug(f"/ping_tasks used by {interaction.user.id}")
         await interaction.response.send_message("Pong!", ephemeral=True)
 
+    # Get the distribution of the time between each stage of the timelines of the most recently
+    # reported series, and how many were posted within the target
+    @app_commands.command(description="Get the time taken to publish recent series")
+    @app_commands.guilds(discord.Object(id=GUILD_ID))
+    async def publish_latency(
+        self, interaction: discord.Interaction, last: app_commands.Range[int, 1, 1000] = 100
+    ):
+        logger.debug(f"/publish_latency used by {interaction.user.id}")
+
+        async with self.bot.pool.acquire() as con:
+            res = await con.execute(
+                """SELECT L.timestamp AS reported, T.replays_found, T.stored, T.drawn, T.posted
+                FROM series_log AS L JOIN series_timeline AS T ON T.game_id = L.game_id
+                ORDER BY L.timestamp DESC LIMIT ?""",
+                (last,),
+            )
+            timelines = await res.fetchall()
+
+        if timelines == []:
+            await interaction.response.send_message("No series reported", ephemeral=True)
+            return
+
+        totals = [t["posted"] - t["reported"] for t in timelines if t["posted"] is not None]
+        within = sum(total <= PUBLISH_TARGET_MINUTES * 60 for total in totals)
+        lines = [
+            f"Last {len(timelines)} series, {len(totals)} posted, {within} within "
+            f"{PUBLISH_TARGET_MINUTES}m",
+            "",
+            f"{'stage':<30} {'count':>5} {'p50':>8} {'p95':>8} {'max':>8}",
+        ]
+
+        for start, end in GAPS:
+            # Only series which have reached both stages count towards a gap. Stages which
+            # happened on a later search (e.g. replays found after the series was first stored
+            # without any) are out of order, and left out too
+            gaps = sorted(
+                t[end] - t[start]
+                for t in timelines
+                if t[start] is not None and t[end] is not None and t[end] >= t[start]
+            )
+            if gaps == []:
+                p50 = p95 = longest = "-"
+            else:
+                p50, p95 = (
+                    duration(gaps[min(len(gaps) - 1, int(len(gaps) * p))]) for p in (0.5, 0.95)
+                )
+                longest = duration(gaps[-1])
+
+            stage = f"{start} -> {end}"
+            lines.append(f"{stage:<30} {len(gaps):>5} {p50:>8} {p95:>8} {longest:>8}")
+
+        text = "\n".join(lines)
+        await interaction.response.send_message(f"```\n{text}\n```", ephemeral=True)
+
+    # Dispatched (with bot.dispatch("stats_stored", game_id)) whenever stats are stored or changed
+    # in process, so the series is published without waiting for the fallback poll
+    @commands.Cog.listener()
+    async def on_stats_stored(self, game_id):
+        logger.debug(f"Stats stored for {game_id}, waking publisher")
+        self.publish_wakeup.set()
+
+    # Fallback for stats stored by other processes (i.e. get_stats.py), which can't wake the
+    # publisher directly
     @tasks.loop(minutes=1)
     async def publish_stats(self):
-        channel = self.bot.get_channel(STAT_CHANNEL_ID)
-        # Get the data of the oldest series which has not been published,
-        # but replays have been search for
+        self.publish_wakeup.set()
+
+    @publish_stats.before_loop
+    async def before_publish_stats(self):
+        logger.debug("Publish stats task loop waiting for bot startup")
+        await self.bot.wait_until_ready()
+
+    # Publish every unpublished series whenever woken, oldest first. Sends are made one at a time
+    # and discord.py waits out the channel's rate limit between them, so a backlog drains as
+    # fast as Discord allows
+    async def publish_queue(self):
+        await self.bot.wait_until_ready()
+
+        while True:
+            await self.publish_wakeup.wait()
+            self.publish_wakeup.clear()
+
+            try:
+                while await self.publish_batch() > 0:
+                    pass
+            except Exception as e:
+                logger.error(f"Failed to publish stats ({type(e).__name__}: {e})")
+
+    # Get the data and replay urls of the oldest unpublished series whose replays have been
+    # searched for, in one query. Returns a list of (series data, urls)
+    async def get_unpublished(self):
         async with self.bot.pool.acquire() as con:
             res = await con.execute(
-                """SELECT L.game_id, L.tier, 
-                L.winning_org, L.losing_org, L.mode, L.games_won_by_loser, 
-                P.wp1, P.wp2, P.wp3, P.lp1, P.lp2, P.lp3 
-                FROM series_log AS L JOIN series_players AS P ON L.game_id = P.game_id 
-                WHERE published = 0 AND replays_stored IS NOT NULL 
-                ORDER BY timestamp ASC LIMIT 1"""
+                """WITH S AS (
+                    SELECT L.timestamp, L.game_id, L.tier, 
+                    L.winning_org, L.losing_org, L.mode, L.games_won_by_loser, 
+                    P.wp1, P.wp2, P.wp3, P.lp1, P.lp2, P.lp3 
+                    FROM series_log AS L JOIN series_players AS P ON L.game_id = P.game_id 
+                    WHERE published = 0 AND replays_stored IS NOT NULL 
+                    ORDER BY timestamp ASC LIMIT ?
+                )
+                SELECT S.*, G.url FROM S LEFT JOIN game_stats AS G ON G.game_id = S.game_id 
+                ORDER BY S.timestamp ASC, S.game_id, G.timestamp ASC""",
+                (PUBLISH_BATCH_SIZE,),
             )
+            rows = await res.fetchall()
 
-        d = await res.fetchone()
+        series = {}
+        for row in rows:
+            if row["game_id"] not in series:
+                series[row["game_id"]] = (row, [])
+            if row["url"] is not None:
+                series[row["game_id"]][1].append(row["url"])
 
-        # If d is None, there are no unpublished series, so do nothing
-        if d is not None:
-            game_id = d["game_id"]
+        return list(series.values())
 
-            logger.info(f"Running publish stats task on game id {game_id}")
+    # Publish a batch of unpublished series, returning the number published
+    @profile_calls("publish_stats")
+    async def publish_batch(self):
+        batch = await self.get_unpublished()
+        if batch == []:
+            return 0
 
-            # Get the winning and losing players
-            winning_players = [p for p in [d["wp1"], d["wp2"], d["wp3"]] if p is not None]
-            losing_players = [p for p in [d["lp1"], d["lp2"], d["lp3"]] if p is not None]
+        channel = self.bot.get_channel(STAT_CHANNEL_ID)
+        logger.info(f"Publishing {len(batch)} series")
 
-            if d["mode"] == 3:
-                max_games = MAX_GAMES_3v3
-            if d["mode"] == 2:
-                max_games = MAX_GAMES_2v2
-            if d["mode"] == 1:
-                max_games = MAX_GAMES_1v1
+        for d, series_urls in batch:
+            await self.publish(channel, d, series_urls)
 
-            # Get the replay urls from the game_stats table for the series
-            async with self.bot.pool.acquire() as con:
-                res = await con.execute(
-                    "SELECT url FROM game_stats WHERE game_id = ? ORDER BY timestamp ASC",
-                    (game_id,),
-                )
+        return len(batch)
 
-            series_urls = await res.fetchall()
+    # Publish the stats of a series to the stats channel
+    async def publish(self, channel, d, series_urls):
+        game_id = d["game_id"]
 
-            # Format the urls for the embed
-            urls_fmt = []
-            for i in range(len(series_urls)):
-                urls_fmt.append(f"[Game {i+1}]({series_urls[i]['url']})")
+        logger.info(f"Running publish stats task on game id {game_id}")
 
-            # Colour the embed based on the extent of replays found
-            if len(series_urls) == 0:
-                logger.debug(f"Publishing {game_id} with no replays found")
-                embed_colour = 0xCC3232
-            elif len(series_urls) == max_games + d["games_won_by_loser"]:
-                logger.debug(f"Publishing {game_id} with all replays found")
-                embed_colour = 0x2DC937
-            else:
-                logger.debug(f"Publishing {game_id} with some replays found")
-                embed_colour = 0xDB7B2B
+        # Get the winning and losing players
+        winning_players = [p for p in [d["wp1"], d["wp2"], d["wp3"]] if p is not None]
+        losing_players = [p for p in [d["lp1"], d["lp2"], d["lp3"]] if p is not None]
 
-            embed = discord.Embed(
-                title=f"{d['winning_org']} vs {d['losing_org']} — ({max_games} - {d['games_won_by_loser']})",
-                colour=embed_colour,
-            )
-            embed.add_field(
-                name=f"{d['tier']} {d['mode']}v{d['mode']}",
-                value=f"{', '.join(winning_players)} vs {', '.join(losing_players)}",
-                inline=False,
+        if d["mode"] == 3:
+            max_games = MAX_GAMES_3v3
+        if d["mode"] == 2:
+            max_games = MAX_GAMES_2v2
+        if d["mode"] == 1:
+            max_games = MAX_GAMES_1v1
+
+        # Format the urls for the embed
+        urls_fmt = []
+        for i in range(len(series_urls)):
+            urls_fmt.append(f"[Game {i+1}]({series_urls[i]})")
+
+        # Colour the embed based on the extent of replays found
+        if len(series_urls) == 0:
+            logger.debug(f"Publishing {game_id} with no replays found")
+            embed_colour = 0xCC3232
+        elif len(series_urls) == max_games + d["games_won_by_loser"]:
+            logger.debug(f"Publishing {game_id} with all replays found")
+            embed_colour = 0x2DC937
+        else:
+            logger.debug(f"Publishing {game_id} with some replays found")
+            embed_colour = 0xDB7B2B
+
+        embed = discord.Embed(
+            title=f"{d['winning_org']} vs {d['losing_org']} — ({max_games} - {d['games_won_by_loser']})",
+            colour=embed_colour,
+        )
+        embed.add_field(
+            name=f"{d['tier']} {d['mode']}v{d['mode']}",
+            value=f"{', '.join(winning_players)} vs {', '.join(losing_players)}",
+            inline=False,
+        )
+        embed.add_field(
+            name=f"{len(series_urls)}/{max_games + d['games_won_by_loser']} replays found",
+            value="",
+            inline=False,
+        )
+        # Only add the 'Links:' field if at least one link has been found
+        if len(series_urls) != 0:
+            embed.add_field(name="Links:", value=", ".join(urls_fmt), inline=False)
+        embed.set_footer(text=f"Think this is wrong? Ask Res (id: {game_id})")
+
+        try:
+            f = discord.File(
+                upload_path("stats", str(game_id)),
+                filename=f"image.{encoding_for('stats')['format']}",
             )
-            embed.add_field(
-                name=f"{len(series_urls)}/{max_games + d['games_won_by_loser']} replays found",
-                value="",
-                inline=False,
+            logger.debug("Ready to send image")
+            await channel.send(file=f, embed=embed)
+        except FileNotFoundError:
+            logger.debug("No stat graphic available, sending without it")
+            await channel.send(embed=embed)
+
+        # Set the game id as published, and record when it was first posted in its timeline
+        async with self.bot.pool.acquire() as con:
+            await con.execute("UPDATE series_log SET published = 1 WHERE game_id = ?", (game_id,))
+            await con.execute(
+                "UPDATE series_timeline SET posted = COALESCE(posted, ?) WHERE game_id = ?",
+                (round(time.time()), game_id),
             )
-            # Only add the 'Links:' field if at least one link has been found
-            if len(series_urls) != 0:
-                embed.add_field(name="Links:", value=", ".join(urls_fmt), inline=False)
-            embed.set_footer(text=f"Think this is wrong? Ask Res (id: {game_id})")
 
-            try:
-                f = discord.File(
-                    f"../data/graphics/{game_id}.png",
-                    filename="image.png",
-                )
-                logger.debug("Ready to send image")
-                await channel.send(file=f, embed=embed)
-            except FileNotFoundError:
-                logger.debug("No stat graphic available, sending without it")
-                await channel.send(embed=embed)
-
-            # Set the game id as published
-            async with self.bot.pool.acquire() as con:
-                await con.execute(
-                    "UPDATE series_log SET published = 1 WHERE game_id = ?", (game_id,)
-                )
+        logger.info(f"{game_id} has been published")
 
-            logger.info(f"{game_id} has been published")
 
-    @publish_stats.before_loop
-    async def before_publish_stats(self):
-        logger.debug("Publish stats task loop waiting for bot startup")
-        await self.bot.wait_until_ready()
+# Format a number of seconds as e.g. 1h05m, 12m30s or 45s
+def duration(seconds):
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m{seconds % 60:02}s"
+    return f"{seconds}s"
 
 
 async def setup(bot):
@@ -1,10 +1,20 @@
-import os
-import sqlite3
 import json
 
 import logging
 
-from PIL import Image, ImageFont, ImageDraw
+from PIL import ImageDraw
+
+import utils.db as db
+from utils.graphics import (
+    TileCache,
+    get_font,
+    get_logo,
+    get_template,
+    remove_graphic,
+    save_graphic,
+)
+from utils.log import setup_logging
+from utils.profiling import profile_calls
 
 with open("../config.json", "r") as read_file:
     config = json.load(read_file)
@@ -22,48 +32,148 @@ POINTS_1v1 = config["POINTS_1v1"]
 
 logger = logging.getLogger("script.update_results")
 
-# Suppress spammy PIL image editing logs
-logging.getLogger("PIL.PngImagePlugin").setLevel(30)
+setup_logging()
 
-logging.basicConfig(
-    filename="../logs/rlis.log",
-    encoding="utf-8",
-    datefmt="%Y-%m-%d %H:%M:%S",
-    format="[%(asctime)s] [%(levelname)-8s] %(name)s: %(message)s",
-    level=logging.DEBUG,
-)
 
+# Each match box is rendered as a tile positioned at (0, BOX_Y + pos_index * BOX_HEIGHT)
+BOX_Y = 290
+BOX_HEIGHT = 270
 
-def edit_graphic(tier, week, data):
-
-    # Delete stored graphic if it exists
-    try:
-        os.remove(f"../data/graphics/{tier.replace(' ', '_').lower()}_week_{week}.png")
-        logger.debug("Outdated results graphic removed")
-    except OSError:
-        pass
+# Rendered template + title images, and rendered match boxes, keyed by the data drawn on them
+BASE_CACHE = TileCache("results base", max_tiles=64)
+BOX_CACHE = TileCache("results box", max_tiles=256)
 
-    # Attempt to load the template file
-    try:
-        image = Image.open(f"assets/templates/results_template.png")
-        logger.info("Successfully opened template file")
-    except FileNotFoundError:
-        logger.error("Failed to update results as template file does not exist")
-        return
 
+def render_base(tier, week):
+    image = get_template("results_template.png").copy()
     image_editable = ImageDraw.Draw(image)
 
     # Draw tier text
-    font = ImageFont.truetype("assets/fonts/SourceSansPro-Black.ttf", 80)
+    font = get_font("SourceSansPro-Black.ttf", 80)
     w = font.getlength(f"{tier} Results")
     image_editable.text(((1512 - w) / 2, 60), f"{tier} Results", (255, 255, 255), font=font)
     # Draw week text
-    font = ImageFont.truetype("assets/fonts/SourceSansPro-SemiBold.ttf", 48)
+    font = get_font("SourceSansPro-SemiBold.ttf", 48)
     w = font.getlength(f"Week {week}")
     image_editable.text(((1512 - w) / 2, 150), f"Week {week}", (180, 180, 180), font=font)
 
+    return image
+
+
+# Hashable key of everything drawn in a match box
+def match_key(match_data):
+    return tuple(
+        (
+            mode,
+            series_data["org_1_name"],
+            series_data["org_1_games"],
+            tuple(series_data["org_1_roster"]),
+            series_data["org_2_name"],
+            series_data["org_2_games"],
+            tuple(series_data["org_2_roster"]),
+        )
+        for mode, series_data in sorted(match_data.items())
+    )
+
+
+# Render a single match box as a tile cut from the template at the box's position, such that the
+# tile can be pasted straight back on. Coordinates are relative to the tile origin
+def render_box(pos_index, match_data):
+    # Draw the backing gradient which is displayed for series with something to show
+    backing_gradient = get_template("results_backing_gradient.png")
+    top = BOX_Y + BOX_HEIGHT * pos_index
+    tile = get_template("results_template.png").crop(
+        (0, top, backing_gradient.width, top + backing_gradient.height)
+    )
+    tile.alpha_composite(backing_gradient)
+    tile_editable = ImageDraw.Draw(tile)
+
+    # These a guaranteed to be populated since making it this far guarantees that at least one
+    # mode has been played
+    org_1_logo = None
+    org_2_logo = None
+
+    # Draw data for each mode in turn
+    for i in range(3):
+        try:
+            series_data = match_data[3 - i]
+        except KeyError:
+            # If a key error is raised, the series has not been played yet, so skip to the next
+            continue
+
+        # Store the logo file names of the involved orgs to draw later
+        org_1_logo = ORGS[series_data["org_1_name"]]["logo_file"]
+        org_2_logo = ORGS[series_data["org_2_name"]]["logo_file"]
+
+        # Draw the left org name
+        font = get_font("SourceSansPro-SemiBold.ttf", 40)
+        w = font.getlength(series_data["org_1_name"])
+        tile_editable.text(
+            (((1512 - w) / 2) - (w / 2) - 100, 10 + 67 * i),
+            series_data["org_1_name"],
+            (255, 255, 255),
+            font=font,
+        )
+        # Draw the right org name
+        w = font.getlength(series_data["org_2_name"])
+        tile_editable.text(
+            (((1512 - w) / 2) + (w / 2) + 100, 10 + 67 * i),
+            series_data["org_2_name"],
+            (255, 255, 255),
+            font=font,
+        )
+
+        # Draw the score
+        score_str = f"{series_data["org_1_games"]} - {series_data["org_2_games"]}"
+        font = get_font("SourceSansPro-Black.ttf", 54)
+        w = font.getlength(score_str)
+        tile_editable.text(((1512 - w) / 2, 10 + 67 * i), score_str, (255, 255, 255), font=font)
+
+        # Draw the left roster
+        font = get_font("SourceSansPro-Light.ttf", 18)
+        w = font.getlength(", ".join(series_data["org_1_roster"]))
+        tile_editable.text(
+            (((1512 - w) / 2) - (w / 2) - 100, 58 + 67 * i),
+            ", ".join(series_data["org_1_roster"]),
+            (200, 200, 200),
+            font=font,
+        )
+
+        # Draw the right roster
+        w = font.getlength(", ".join(series_data["org_2_roster"]))
+        tile_editable.text(
+            (((1512 - w) / 2) + (w / 2) + 100, 58 + 67 * i),
+            ", ".join(series_data["org_2_roster"]),
+            (200, 200, 200),
+            font=font,
+        )
+
+    # Paste the resized logos
+    tile.alpha_composite(get_logo(org_1_logo, (200, 200)), (112, 15))
+    tile.alpha_composite(get_logo(org_2_logo, (200, 200)), (1200, 15))
+
+    return tile
+
+
+def edit_graphic(tier, week, data):
+
+    # Delete stored graphic if it exists
+    remove_graphic(f"{tier.replace(' ', '_').lower()}_week_{week}")
+
+    # Attempt to load the template file with the tier and week already drawn on
+    try:
+        base = BASE_CACHE.get((tier, week), lambda: render_base(tier, week))
+        logger.info("Successfully opened template file")
+    except FileNotFoundError:
+        logger.error("Failed to update results as template file does not exist")
+        return
+
+    image = base.copy()
+
     logger.debug("Starting to draw result data")
 
+    misses = BOX_CACHE.misses
+
     # Track whether the first, second, or third box is being drawn to
     pos_index = 0
 
@@ -73,188 +183,110 @@ def edit_graphic(tier, week, data):
         if data[match] == {}:
             continue
 
-        # Draw the backing gradient which is displayed for series with something to show
-        backing_gradient = Image.open(f"assets/templates/results_backing_gradient.png")
-        image.paste(backing_gradient, (0, 290 + 270 * pos_index), mask=backing_gradient)
-
-        # These a guaranteed to be populated since making it this far guarantees that at least one
-        # mode has been played
-        org_1_logo = None
-        org_2_logo = None
-
-        # Draw data for each mode in turn
-        for i in range(3):
-            try:
-                series_data = data[match][3 - i]
-            except KeyError:
-                # If a key error is raised, the series has not been played yet, so skip to the next
-                continue
-
-            # Store the logo file names of the involved orgs to draw later
-            org_1_logo = ORGS[series_data["org_1_name"]]["logo_file"]
-            org_2_logo = ORGS[series_data["org_2_name"]]["logo_file"]
-
-            # Draw the left org name
-            font = ImageFont.truetype("assets/fonts/SourceSansPro-SemiBold.ttf", 40)
-            w = font.getlength(series_data["org_1_name"])
-            image_editable.text(
-                (
-                    ((1512 - w) / 2) - (w / 2) - 100,
-                    300 + 270 * pos_index + 67 * i,
-                ),
-                series_data["org_1_name"],
-                (255, 255, 255),
-                font=font,
-            )
-            # Draw the right org name
-            w = font.getlength(series_data["org_2_name"])
-            image_editable.text(
-                (
-                    ((1512 - w) / 2) + (w / 2) + 100,
-                    300 + 270 * pos_index + 67 * i,
-                ),
-                series_data["org_2_name"],
-                (255, 255, 255),
-                font=font,
-            )
-
-            # Draw the score
-            score_str = f"{series_data["org_1_games"]} - {series_data["org_2_games"]}"
-            font = ImageFont.truetype("assets/fonts/SourceSansPro-Black.ttf", 54)
-            w = font.getlength(score_str)
-            image_editable.text(
-                (
-                    (1512 - w) / 2,
-                    300 + 270 * pos_index + 67 * i,
-                ),
-                score_str,
-                (255, 255, 255),
-                font=font,
-            )
-
-            # Draw the left roster
-            font = ImageFont.truetype("assets/fonts/SourceSansPro-Light.ttf", 18)
-            w = font.getlength(", ".join(series_data["org_1_roster"]))
-            image_editable.text(
-                (
-                    ((1512 - w) / 2) - (w / 2) - 100,
-                    348 + 270 * pos_index + 67 * i,
-                ),
-                ", ".join(series_data["org_1_roster"]),
-                (200, 200, 200),
-                font=font,
-            )
-
-            # Draw the right roster
-            w = font.getlength(", ".join(series_data["org_2_roster"]))
-            image_editable.text(
-                (
-                    ((1512 - w) / 2) + (w / 2) + 100,
-                    348 + 270 * pos_index + 67 * i,
-                ),
-                ", ".join(series_data["org_2_roster"]),
-                (200, 200, 200),
-                font=font,
-            )
-
-        # Load the logo files, resize them, and paste them
-        logo_1 = Image.open(f"assets/logos/{org_1_logo}")
-        logo_2 = Image.open(f"assets/logos/{org_2_logo}")
-
-        logo_1 = logo_1.resize((200, 200))
-        logo_2 = logo_2.resize((200, 200))
-
-        image.paste(logo_1, (112, 305 + 270 * pos_index), mask=logo_1)
-        image.paste(logo_2, (1200, 305 + 270 * pos_index), mask=logo_2)
+        # Paste the tile for this match - only boxes whose results have changed get redrawn
+        box = BOX_CACHE.get(
+            (pos_index, match_key(data[match])), lambda: render_box(pos_index, data[match])
+        )
+        image.paste(box, (0, BOX_Y + BOX_HEIGHT * pos_index))
 
         # Increment to move on to the next result box
         pos_index += 1
 
+    logger.debug(f"Redrew {BOX_CACHE.misses - misses} of {pos_index} result boxes")
+
     logger.debug("Finished drawing result data")
 
-    # Save file compression level 5 to balance time and space
-    image.save(
-        f"../data/graphics/{tier.replace(' ', '_').lower()}_week_{week}.png", compress_level=5
-    )
+    # Save file with the encoder settings configured for results graphics
+    save_graphic(image.convert("RGB"), "results", f"{tier.replace(' ', '_').lower()}_week_{week}")
 
     logger.info("Successfully saved results graphic")
 
 
-def get_data(tier, week):
+# Get the results of every fixture in a tier with a single query, either for one week or for
+# every week if week is None. Returns {week: {partial_id: {mode: series_data}}}
+def get_all_data(tier, week=None):
 
     tier_id = TIERS[tier]
 
-    con = sqlite3.connect("../data/rlis_data.db")
+    con = db.get_connection(read_only=True)
     cur = con.cursor()
 
     logger.info("Connected to database")
 
-    # Get fixtures for specified week and tier in a deterministic order
-    cur.execute(
-        "SELECT org_1, org_2 FROM fixtures WHERE week = ? AND tier = ? ORDER BY org_1 DESC, org_2 DESC",
-        (week, tier),
+    # Generate the game id of each fixture excluding the mode value, then join each fixture to the
+    # series played under it (if any) in a deterministic order
+    res = cur.execute(
+        """WITH F AS (
+            SELECT week, org_1, org_2, 
+            CAST(MAX(org_1, org_2) || MIN(org_1, org_2) || ? AS INTEGER) AS partial_id
+            FROM fixtures WHERE tier = ? AND (? IS NULL OR week = ?)
+        )
+        SELECT F.week, F.partial_id, L.mode, L.winning_org, L.losing_org, L.games_won_by_loser,
+        P.wp1, P.wp2, P.wp3, P.lp1, P.lp2, P.lp3, P.game_id 
+        FROM F 
+        LEFT JOIN series_log AS L 
+        ON L.game_id IN (F.partial_id * 10 + 3, F.partial_id * 10 + 2, F.partial_id * 10 + 1)
+        LEFT JOIN series_players AS P ON L.game_id = P.game_id
+        ORDER BY F.week, F.org_1 DESC, F.org_2 DESC, L.mode DESC""",
+        (tier_id, tier, week, week),
     )
+    rows = res.fetchall()
 
-    fixtures = cur.fetchall()
-
-    logger.info("Successfully fetched fixtures from database")
+    logger.debug(f"Fetched {len(rows)} fixture results from database")
 
-    # Generate the game ids excluding the mode value
-    partial_game_ids = [f"{max(match)}{min(match)}{tier_id}" for match in fixtures]
+    data = {}
+    for row in rows:
+        match_data = data.setdefault(row[0], {}).setdefault(str(row[1]), {})
 
-    data = {partial_id: {} for partial_id in partial_game_ids}
-
-    logger.debug("Starting to query database for results")
+        # If the mode is None, no series have been played in this fixture yet (series without
+        # players are skipped too)
+        mode = row[2]
+        if mode is None or row[12] is None:
+            continue
 
-    for partial_id in partial_game_ids:
-        # Get the series info and players of all modes under the partial id
-        cur.execute(
-            """SELECT mode, winning_org, losing_org, games_won_by_loser,
-            wp1, wp2, wp3, lp1, lp2, lp3 
-            FROM series_log AS L JOIN series_players AS P ON L.game_id = P.game_id
-            WHERE L.game_id IN (?, ?, ?)""",
-            (f"{partial_id}3", f"{partial_id}2", f"{partial_id}1"),
-        )
-        match_data = cur.fetchall()
-        for match in match_data:
-            # Find the number of games won by the winning team / lost by the losing team
-            if match[0] == 3:
-                max_games = MAX_GAMES_3v3
-            if match[0] == 2:
-                max_games = MAX_GAMES_2v2
-            if match[0] == 1:
-                max_games = MAX_GAMES_1v1
-
-            # Get the winning and losing players without None values
-            winning_players = [p for p in [match[4], match[5], match[6]] if p is not None]
-            losing_players = [p for p in [match[7], match[8], match[9]] if p is not None]
-
-            if ORGS[match[1]]["id"] > ORGS[match[2]]["id"]:
-                # In this case the winning org is org 1
-                data[partial_id][match[0]] = {
-                    "org_1_name": match[1],
-                    "org_1_games": max_games,
-                    "org_1_roster": winning_players,
-                    "org_2_name": match[2],
-                    "org_2_games": match[3],
-                    "org_2_roster": losing_players,
-                }
-            else:
-                # In this case the winning org is org 2
-                data[partial_id][match[0]] = {
-                    "org_1_name": match[2],
-                    "org_1_games": match[3],
-                    "org_1_roster": losing_players,
-                    "org_2_name": match[1],
-                    "org_2_games": max_games,
-                    "org_2_roster": winning_players,
-                }
+        # Find the number of games won by the winning team / lost by the losing team
+        if mode == 3:
+            max_games = MAX_GAMES_3v3
+        if mode == 2:
+            max_games = MAX_GAMES_2v2
+        if mode == 1:
+            max_games = MAX_GAMES_1v1
+
+        # Get the winning and losing players without None values
+        winning_players = [p for p in row[6:9] if p is not None]
+        losing_players = [p for p in row[9:12] if p is not None]
+
+        if ORGS[row[3]]["id"] > ORGS[row[4]]["id"]:
+            # In this case the winning org is org 1
+            match_data[mode] = {
+                "org_1_name": row[3],
+                "org_1_games": max_games,
+                "org_1_roster": winning_players,
+                "org_2_name": row[4],
+                "org_2_games": row[5],
+                "org_2_roster": losing_players,
+            }
+        else:
+            # In this case the winning org is org 2
+            match_data[mode] = {
+                "org_1_name": row[4],
+                "org_1_games": row[5],
+                "org_1_roster": losing_players,
+                "org_2_name": row[3],
+                "org_2_games": max_games,
+                "org_2_roster": winning_players,
+            }
 
     logger.debug("Finished querying database for results")
 
     return data
 
 
+def get_data(tier, week):
+    return get_all_data(tier, week).get(week, {})
+
+
+@profile_calls("update_r")
 def update(tiers, week):
     # For each tier that needs a graphic generating, get the data, then edit the graphic
     for tier in tiers:
@@ -1,15 +1,28 @@
-import os
 import sqlite3
 import json
+import argparse
 
 import logging
 
-from PIL import Image, ImageFont, ImageDraw
+from PIL import Image, ImageDraw
+
+import utils.db as db
+from utils.graphics import (
+    TileCache,
+    get_font,
+    get_logo,
+    get_template,
+    remove_graphic,
+    save_graphic,
+)
+from utils.log import setup_logging
+from utils.profiling import profile_calls
 
 with open("../config.json", "r") as read_file:
     config = json.load(read_file)
 
 ORGS = config["ORGS"]
+TIERS = config["TIERS"]
 
 MAX_GAMES_3v3 = config["MAX_GAMES_3v3"]
 MAX_GAMES_2v2 = config["MAX_GAMES_2v2"]
@@ -21,16 +34,80 @@ POINTS_1v1 = config["POINTS_1v1"]
 
 logger = logging.getLogger("script.update_standings")
 
-# Suppress spammy PIL image editing logs
-logging.getLogger("PIL.PngImagePlugin").setLevel(30)
+setup_logging()
 
-logging.basicConfig(
-    filename="../logs/rlis.log",
-    encoding="utf-8",
-    datefmt="%Y-%m-%d %H:%M:%S",
-    format="[%(asctime)s] [%(levelname)-8s] %(name)s: %(message)s",
-    level=logging.DEBUG,
-)
+
+# Each org row is rendered as a tile positioned at (ROW_X, ROW_Y + i * ROW_HEIGHT)
+ROW_X = 339
+ROW_Y = 240
+ROW_WIDTH = 1920 - ROW_X
+ROW_HEIGHT = 130
+
+# Rendered template + title images, and rendered org rows, keyed by the data drawn on them
+BASE_CACHE = TileCache("standings base", max_tiles=16)
+ROW_CACHE = TileCache("standings row", max_tiles=128)
+
+
+def render_base(template_file, tier):
+    image = get_template(template_file).copy()
+    image_editable = ImageDraw.Draw(image)
+
+    # Draw title text
+    font = get_font("SourceSansPro-Black.ttf", 80)
+    text = f"{tier} Standings"
+
+    w = font.getlength(text)
+    image_editable.text(((1920 - w) / 2, 50), text, (255, 255, 251), font=font)
+
+    return image
+
+
+# Render a single org row onto a transparent tile. Coordinates are relative to the tile origin
+def render_row(org, org_data):
+    tile = Image.new("RGBA", (ROW_WIDTH, ROW_HEIGHT), (0, 0, 0, 0))
+    tile_editable = ImageDraw.Draw(tile)
+
+    # Draw org name
+    font = get_font("SourceSansPro-Black.ttf", 56)
+    tile_editable.text((142, 9), org, (255, 255, 251), font=font)
+
+    # Draw points
+    w = font.getlength(str(org_data["points"]))
+    tile_editable.text(
+        (((1920 - w) / 2) + 653 - ROW_X, 21),
+        str(org_data["points"]),
+        (255, 255, 251),
+        font=font,
+    )
+
+    # Draw roster
+    font = get_font("SourceSansPro-Light.ttf", 24)
+    tile_editable.text((142, 81), ", ".join(org_data["roster"]), (185, 185, 181), font=font)
+
+    # Draw game record
+    font = get_font("SourceSansPro-SemiBold.ttf", 48)
+    w = font.getlength(f"{org_data["games_won"]} - {org_data["games_lost"]}")
+    tile_editable.text(
+        (((1920 - w) / 2) + 411 - ROW_X, 28),
+        f"{org_data["games_won"]} - {org_data["games_lost"]}",
+        (255, 255, 251),
+        font=font,
+    )
+
+    # Draw series record
+    w = font.getlength(f"{org_data["series_won"]} - {org_data["series_lost"]}")
+    tile_editable.text(
+        (((1920 - w) / 2) + 111 - ROW_X, 28),
+        f"{org_data["series_won"]} - {org_data["series_lost"]}",
+        (255, 255, 251),
+        font=font,
+    )
+
+    # Paste resized logo
+    logo = get_logo(ORGS[org]["logo_file"], (100, 100))
+    tile.alpha_composite(logo, (0, 15))
+
+    return tile
 
 
 def edit_graphic(tier, data):
@@ -60,107 +137,56 @@ def edit_graphic(tier, data):
     logger.info("Sorted org standings")
 
     # Delete stored graphic if it exists
-    try:
-        os.remove(f"../data/graphics/{tier.replace(' ', '_').lower()}.png")
-        logger.debug("Outdated standings graphic removed")
-    except OSError:
-        pass
+    remove_graphic(tier.replace(" ", "_").lower())
 
     if tier == "Overall":
         template_file = f"standings_template_{len(ordered_orgs)}o.png"
     else:
         template_file = f"standings_template_{len(ordered_orgs)}.png"
 
-    # Attempt to load the template file
+    # Attempt to load the template file with the title already drawn on
     try:
-        image = Image.open(f"assets/templates/{template_file}")
+        base = BASE_CACHE.get((template_file, tier), lambda: render_base(template_file, tier))
         logger.info("Successfully opened template file")
     except FileNotFoundError:
         logger.error("Failed to update standings as template file does not exist")
         return
 
-    image_editable = ImageDraw.Draw(image)
-
-    # Draw title text
-    font = ImageFont.truetype("assets/fonts/SourceSansPro-Black.ttf", 80)
-    text = f"{tier} Standings"
-
-    w = font.getlength(text)
-    image_editable.text(((1920 - w) / 2, 50), text, (255, 255, 251), font=font)
+    image = base.copy()
 
     logger.info("Starting to draw org data")
 
-    for i in range(len(ordered_orgs)):
-
-        org_data = data[ordered_orgs[i]]
-
-        # Draw org names
-        font = ImageFont.truetype("assets/fonts/SourceSansPro-Black.ttf", 56)
-        image_editable.text(
-            (481, 379 + (i - 1) * 130),
-            ordered_orgs[i],
-            (255, 255, 251),
-            font=font,
-        )
-
-        # Draw points
-        w = font.getlength(str(org_data["points"]))
-        image_editable.text(
-            (((1920 - w) / 2) + 653, 391 + (i - 1) * 130),
-            str(org_data["points"]),
-            (255, 255, 251),
-            font=font,
-        )
-
-        # Draw rosters
-        font = ImageFont.truetype("assets/fonts/SourceSansPro-Light.ttf", 24)
-        image_editable.text(
-            (481, 451 + (i - 1) * 130),
-            ", ".join(org_data["roster"]),
-            (185, 185, 181),
-            font=font,
-        )
+    misses = ROW_CACHE.misses
 
-        # Draw game record
-        font = ImageFont.truetype("assets/fonts/SourceSansPro-SemiBold.ttf", 48)
-        w = font.getlength(f"{org_data["games_won"]} - {org_data["games_lost"]}")
-        image_editable.text(
-            (((1920 - w) / 2) + 411, 398 + (i - 1) * 130),
-            f"{org_data["games_won"]} - {org_data["games_lost"]}",
-            (255, 255, 251),
-            font=font,
-        )
-
-        # Draw series record
-        w = font.getlength(f"{org_data["series_won"]} - {org_data["series_lost"]}")
-        image_editable.text(
-            (((1920 - w) / 2) + 111, 398 + (i - 1) * 130),
-            f"{org_data["series_won"]} - {org_data["series_lost"]}",
-            (255, 255, 251),
-            font=font,
+    # Paste the tile for each org in order - only rows whose data has changed get redrawn
+    for i in range(len(ordered_orgs)):
+        org = ordered_orgs[i]
+        org_data = data[org]
+        key = (
+            org,
+            org_data["points"],
+            org_data["series_won"],
+            org_data["series_lost"],
+            org_data["games_won"],
+            org_data["games_lost"],
+            tuple(org_data["roster"]),
         )
+        row = ROW_CACHE.get(key, lambda: render_row(org, org_data))
+        image.alpha_composite(row, (ROW_X, ROW_Y + i * ROW_HEIGHT))
 
-        org_logo_file = ORGS[ordered_orgs[i]]["logo_file"]
-
-        # Paste resized logos
-        logo = Image.open(f"assets/logos/{org_logo_file}")
-        logo = logo.resize((100, 100))
-        image.paste(logo, (339, 385 + (i - 1) * 130), mask=logo)
+    logger.debug(f"Redrew {ROW_CACHE.misses - misses} of {len(ordered_orgs)} standings rows")
 
     logger.info("Finished drawing org data")
 
-    # Save file compression level 5 to balance time and space
-    image.save(f"../data/graphics/{tier.replace(' ', '_').lower()}.png", compress_level=5)
+    # Save file with the encoder settings configured for standings graphics
+    save_graphic(image.convert("RGB"), "standings", tier.replace(" ", "_").lower())
 
     logger.info("Successfully saved standings graphic")
 
 
-def get_data(tier):
-    con = sqlite3.connect("../data/rlis_data.db")
-    cur = con.cursor()
-    logger.info("Connected to database")
-
-    data = {
+# Get a blank standings record for every org
+def blank_standings():
+    return {
         org: {
             "points": 0,
             "series_won": 0,
@@ -172,119 +198,230 @@ def get_data(tier):
         for org in ORGS.keys()
     }
 
-    logger.info("Beginning to query database for org data")
 
-    # Get rosters (or manager in case of Overall)
-    if tier == "Overall":
-        for org in data:
-            data[org]["roster"] = [ORGS[org]["manager"]]
-        tier_str = tier
-        # If the tier is Overall, query the wildcard character to get all tiers
-        tier = "%"
-    else:
-        res = cur.execute("SELECT name, org FROM players WHERE tier = ?", (tier,))
-        for row in res.fetchall():
-            data[row[1]]["roster"].append(row[0])
-    # Points
-    res = cur.execute(
-        """SELECT winning_org, SUM(CASE
-                WHEN mode = 3 THEN ?
-                WHEN mode = 2 THEN ?
-                WHEN mode = 1 THEN ? END) AS total_points 
-        FROM series_log WHERE tier LIKE ? GROUP BY winning_org""",
-        (POINTS_3v3, POINTS_2v2, POINTS_1v1, tier),
-    )
-    for row in res.fetchall():
-        data[row[0]]["points"] = row[1]
+# Total the points, series and games of every org in every tier from series_log. Each series is
+# read once and counted from both the winner's and the loser's perspective, then grouped by tier
+# and org. Returns {tier: {org: record}} with unrounded points and no rosters
+def compute_standings(cur):
+    standings = {tier: blank_standings() for tier in TIERS}
 
-    # Series won
     res = cur.execute(
-        """SELECT winning_org, COUNT(winning_org) AS series_won
-        FROM series_log WHERE tier LIKE ?
-        GROUP BY winning_org""",
-        (tier,),
+        """WITH modes(mode, points, max_games) AS (VALUES (3, ?, ?), (2, ?, ?), (1, ?, ?)),
+        sides(won) AS (VALUES (1), (0))
+        SELECT 
+            L.tier, 
+            CASE WHEN S.won THEN L.winning_org ELSE L.losing_org END AS org,
+            SUM(CASE WHEN S.won THEN M.points ELSE 0 END),
+            SUM(S.won),
+            SUM(1 - S.won),
+            SUM(CASE WHEN S.won THEN M.max_games ELSE L.games_won_by_loser END),
+            SUM(CASE WHEN S.won THEN L.games_won_by_loser ELSE M.max_games END)
+        FROM series_log AS L 
+        JOIN modes AS M ON L.mode = M.mode 
+        CROSS JOIN sides AS S
+        GROUP BY L.tier, org""",
+        (
+            POINTS_3v3,
+            MAX_GAMES_3v3,
+            POINTS_2v2,
+            MAX_GAMES_2v2,
+            POINTS_1v1,
+            MAX_GAMES_1v1,
+        ),
     )
     for row in res.fetchall():
-        data[row[0]]["series_won"] = row[1]
+        record = standings.setdefault(row[0], blank_standings())[row[1]]
+        record["points"] = row[2]
+        record["series_won"] = row[3]
+        record["series_lost"] = row[4]
+        record["games_won"] = row[5]
+        record["games_lost"] = row[6]
 
-    # Series lost
-    res = cur.execute(
-        """SELECT losing_org, COUNT(losing_org) AS series_lost
-        FROM series_log WHERE tier LIKE ?
-        GROUP BY losing_org""",
-        (tier,),
-    )
+    return standings
 
-    for row in res.fetchall():
-        data[row[0]]["series_lost"] = row[1]
 
-    # Games won as winner
-    res = cur.execute(
-        """SELECT winning_org, SUM(CASE
-                WHEN mode = 3 THEN ?
-                WHEN mode = 2 THEN ?
-                WHEN mode = 1 THEN ? END) AS games_won_as_winner 
-        FROM series_log WHERE tier LIKE ? GROUP BY winning_org""",
-        (MAX_GAMES_3v3, MAX_GAMES_2v2, MAX_GAMES_1v1, tier),
-    )
-    for row in res.fetchall():
-        data[row[0]]["games_won"] = row[1]
+STATS = ["points", "series_won", "series_lost", "games_won", "games_lost"]
 
-    # Games lost as loser
-    res = cur.execute(
-        """SELECT losing_org, SUM(CASE
-                WHEN mode = 3 THEN ?
-                WHEN mode = 2 THEN ?
-                WHEN mode = 1 THEN ? END) AS games_lost_as_loser 
-        FROM series_log WHERE tier LIKE ? GROUP BY losing_org""",
-        (MAX_GAMES_3v3, MAX_GAMES_2v2, MAX_GAMES_1v1, tier),
+
+# The points and max games of each mode as they should be stored in standings_modes
+def config_modes():
+    return {
+        3: (POINTS_3v3, MAX_GAMES_3v3),
+        2: (POINTS_2v2, MAX_GAMES_2v2),
+        1: (POINTS_1v1, MAX_GAMES_1v1),
+    }
+
+
+# Recalculate org_standings from scratch (and standings_modes from the config) in one transaction
+def rebuild_standings_table(con):
+    cur = con.cursor()
+    cur.execute("DELETE FROM standings_modes")
+    cur.executemany(
+        "INSERT INTO standings_modes VALUES(?, ?, ?)",
+        [(mode, points, max_games) for mode, (points, max_games) in config_modes().items()],
     )
-    for row in res.fetchall():
-        data[row[0]]["games_lost"] = row[1]
 
-    # Games won as loser
-    res = cur.execute(
-        """SELECT losing_org, SUM(games_won_by_loser) AS games_won_as_loser
-        FROM series_log WHERE tier LIKE ? GROUP BY losing_org""",
-        (tier,),
+    cur.execute("DELETE FROM org_standings")
+    standings = compute_standings(cur)
+    cur.executemany(
+        "INSERT INTO org_standings VALUES(?, ?, ?, ?, ?, ?, ?)",
+        [
+            (tier, org, *[standings[tier][org][stat] for stat in STATS])
+            for tier in standings
+            for org in standings[tier]
+        ],
     )
-    for row in res.fetchall():
-        data[row[0]]["games_won"] += row[1]
+    con.commit()
+
+    logger.info("Rebuilt org_standings table")
+
+
+# Read the materialized standings in the same form as compute_standings. Returns None if the
+# table doesn't exist or was built with points/max games which no longer match the config
+def read_standings_table(cur):
+    try:
+        res = cur.execute("SELECT mode, points, max_games FROM standings_modes")
+        modes = {row[0]: (row[1], row[2]) for row in res.fetchall()}
+        if modes != config_modes():
+            logger.warning("org_standings is out of date with the config, rebuild it")
+            return None
+
+        res = cur.execute(
+            """SELECT tier, org, points, series_won, series_lost, games_won, games_lost 
+            FROM org_standings"""
+        )
+        rows = res.fetchall()
+    except sqlite3.OperationalError:
+        logger.debug("org_standings table does not exist")
+        return None
+
+    standings = {tier: blank_standings() for tier in TIERS}
+    for row in rows:
+        record = standings.setdefault(row[0], blank_standings())[row[1]]
+        for i, stat in enumerate(STATS):
+            record[stat] = row[i + 2]
+
+    return standings
+
+
+# Compare the materialized standings with the aggregate over series_log, returning a list of
+# (tier, org, stat, table value, aggregate value) for every mismatch
+def check_standings_table(cur):
+    table = read_standings_table(cur)
+    if table is None:
+        return None
+
+    aggregate = compute_standings(cur)
 
-    # Games lost as winner
+    mismatches = []
+    for tier in aggregate.keys() | table.keys():
+        for org in ORGS:
+            for stat in STATS:
+                expected = aggregate.get(tier, blank_standings())[org][stat]
+                actual = table.get(tier, blank_standings())[org][stat]
+                if abs(expected - actual) > 1e-6:
+                    mismatches.append((tier, org, stat, actual, expected))
+
+    return mismatches
+
+
+# Get the standings of every tier plus Overall in one pass. Returns {tier: {org: record}}
+def get_all_data():
+    con = db.get_connection(read_only=True)
+    cur = con.cursor()
+    logger.info("Connected to database")
+
+    logger.info("Beginning to query database for org data")
+
+    # Read the materialized standings, falling back to aggregating series_log if unavailable
+    standings = read_standings_table(cur)
+    if standings is None:
+        standings = compute_standings(cur)
+
+    # Get the rosters of every tier
+    res = cur.execute("SELECT name, tier, org FROM players WHERE tier IS NOT NULL")
+    for row in res.fetchall():
+        standings.setdefault(row[1], blank_standings())[row[2]]["roster"].append(row[0])
+
+    # Overall is the sum of every tier, with the manager in place of the roster
+    overall = blank_standings()
+    for tier in standings:
+        for org in overall:
+            for stat in STATS:
+                overall[org][stat] += standings[tier][org][stat]
+    for org in overall:
+        overall[org]["roster"] = [ORGS[org]["manager"]]
+
+    # Get the number of distinct tiers where each org has at least one player registered
     res = cur.execute(
-        """SELECT winning_org, SUM(games_won_by_loser) AS games_lost_as_winner
-        FROM series_log WHERE tier LIKE ? GROUP BY winning_org""",
-        (tier,),
+        "SELECT org, COUNT(DISTINCT tier) FROM players WHERE org IS NOT NULL GROUP BY org"
     )
-    for row in res.fetchall():
-        data[row[0]]["games_lost"] += row[1]
+    num_teams = dict(res.fetchall())
 
-    # Round the points to ensure there isn't floating point inaccuracy
-    # If the tier is overall, find how many teams the org has, and divide to get an average
-    for org in data:
-        # If tier is '%' then the Overall standings are being generated, so get average points
-        if tier == "%":
-            # Get the number of distinct tiers where the org has at least one player registered
-            res = cur.execute("SELECT COUNT (DISTINCT tier) FROM players WHERE org = ?", (org,))
-            num_teams = res.fetchone()[0]
-            data[org]["points"] = round(data[org]["points"] / num_teams, 2)
-        else:
-            data[org]["points"] = round(data[org]["points"], 1)
+    standings["Overall"] = overall
 
-        # If a value is a float that is representing an integer (e.g 7.0), make it an integer
-        # such that it displays as 7
-        if isinstance(data[org]["points"], float) and data[org]["points"].is_integer():
-            data[org]["points"] = int(data[org]["points"])
+    # Round the points to ensure there isn't floating point inaccuracy
+    # For Overall, divide by the number of teams the org has to get an average
+    for tier in standings:
+        for org in standings[tier]:
+            record = standings[tier][org]
+            if tier == "Overall":
+                if num_teams.get(org, 0) > 0:
+                    record["points"] = round(record["points"] / num_teams[org], 2)
+            else:
+                record["points"] = round(record["points"], 1)
+
+            # If a value is a float that is representing an integer (e.g 7.0), make it an integer
+            # such that it displays as 7
+            if isinstance(record["points"], float) and record["points"].is_integer():
+                record["points"] = int(record["points"])
 
     logger.info("Finished querying database for org data")
 
-    return data
+    return standings
 
 
+def get_data(tier):
+    return get_all_data()[tier]
+
+
+@profile_calls("update_s")
 def update(tiers):
-    # For each tier that needs a graphic generating, get the data, then edit the graphic
+    # Get the standings of every tier at once, then edit the graphic of each tier that needs one
+    standings = get_all_data()
     for tier in tiers:
         logger.info(f"Generating standings graphic for {tier}")
-        data = get_data(tier)
-        edit_graphic(tier, data)
+        edit_graphic(tier, standings[tier])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the materialized org_standings table")
+    parser.add_argument(
+        "action",
+        choices=["rebuild", "check"],
+        help="rebuild: recalculate the table (and its modes) from series_log and the config. "
+        "check: compare the table with series_log",
+    )
+    args = parser.parse_args()
+
+    con = db.connect()
+
+    if args.action == "rebuild":
+        rebuild_standings_table(con)
+        print("org_standings rebuilt")
+    else:
+        mismatches = check_standings_table(con.cursor())
+        if mismatches is None:
+            print("org_standings is out of date with the config, run rebuild to fix")
+        elif mismatches == []:
+            print("org_standings is consistent with series_log")
+        else:
+            for tier, org, stat, actual, expected in mismatches:
+                print(f"{tier} {org} {stat}: table has {actual}, series_log gives {expected}")
+            print(f"{len(mismatches)} mismatches, run rebuild to fix")
+
+    con.close()
+
+
+if __name__ == "__main__":
+    main()
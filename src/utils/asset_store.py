@@ -0,0 +1,137 @@
+import os
+import json
+import mmap
+import logging
+from threading import Lock
+
+from PIL import Image
+
+from utils.log import setup_logging
+
+logger = logging.getLogger("script.asset_store")
+
+setup_logging()
+
+# Raw RGBA pixel data of every asset, and the index of where each asset is within it
+STORE_FILE = "../data/assets.bin"
+INDEX_FILE = "../data/assets.json"
+
+# Sizes logos are pre-scaled to (None is the original size) - stat graphics use the original,
+# standings use 100x100 and results use 200x200
+LOGO_SIZES = [None, (100, 100), (200, 200)]
+
+
+def asset_key(kind, name, size=None):
+    if size is None:
+        return f"{kind}/{name}"
+    return f"{kind}/{name}@{size[0]}x{size[1]}"
+
+
+# Decode every template and logo (at each size) and write them out as raw RGBA buffers, so that
+# short lived processes can map them into memory instead of decoding PNGs on every run.
+# Run from the src directory with: python -m utils.asset_store
+def build():
+    sources = []
+    for file in sorted(os.listdir("assets/templates")):
+        if file.endswith(".png"):
+            sources.append(("templates", file, None))
+    for file in sorted(os.listdir("assets/logos")):
+        if file.endswith(".png"):
+            for size in LOGO_SIZES:
+                sources.append(("logos", file, size))
+
+    index = {}
+    offset = 0
+    with open(f"{STORE_FILE}.tmp", "wb") as store:
+        for kind, file, size in sources:
+            path = f"assets/{kind}/{file}"
+            image = Image.open(path).convert("RGBA")
+            if size is not None:
+                image = image.resize(size)
+
+            raw = image.tobytes("raw", "RGBA")
+            store.write(raw)
+
+            index[asset_key(kind, file, size)] = {
+                "offset": offset,
+                "width": image.width,
+                "height": image.height,
+                "source": path,
+                "mtime": os.stat(path).st_mtime_ns,
+            }
+            offset += len(raw)
+
+    with open(f"{INDEX_FILE}.tmp", "w") as index_file:
+        json.dump(index, index_file)
+
+    # Replace the old store atomically so running processes never see a partial file
+    os.replace(f"{STORE_FILE}.tmp", STORE_FILE)
+    os.replace(f"{INDEX_FILE}.tmp", INDEX_FILE)
+
+    logger.info(f"Built asset store with {len(index)} assets ({round(offset / 1024 ** 2, 1)}MB)")
+
+    return len(index), offset
+
+
+# Read only view of the asset store. Images returned share memory with the mapped file, so they
+# are read only and must be copied before being drawn on
+class AssetStore:
+    def __init__(self, store_file=STORE_FILE, index_file=INDEX_FILE):
+        with open(index_file, "r") as read_file:
+            self.index = json.load(read_file)
+
+        with open(store_file, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+
+        logger.debug(f"Mapped asset store with {len(self.index)} assets")
+
+    # Get an asset as an image, or None if it isn't in the store or the source file has changed
+    # since the store was built
+    def get(self, kind, name, size=None):
+        entry = self.index.get(asset_key(kind, name, size))
+        if entry is None:
+            return None
+
+        try:
+            if os.stat(entry["source"]).st_mtime_ns != entry["mtime"]:
+                logger.warning(f"{entry['source']} has changed since the asset store was built")
+                return None
+        except OSError:
+            return None
+
+        length = entry["width"] * entry["height"] * 4
+        buffer = self._view[entry["offset"] : entry["offset"] + length]
+        return Image.frombuffer(
+            "RGBA", (entry["width"], entry["height"]), buffer, "raw", "RGBA", 0, 1
+        )
+
+
+_store = None
+_store_loaded = False
+_lock = Lock()
+
+
+# Get the asset store for this process, or None if it hasn't been built
+def get_store():
+    global _store, _store_loaded
+
+    with _lock:
+        if not _store_loaded:
+            _store_loaded = True
+            try:
+                _store = AssetStore()
+            except (OSError, ValueError) as e:
+                logger.info(f"Asset store unavailable, decoding assets instead ({e})")
+                _store = None
+
+    return _store
+
+
+def main():
+    num_assets, num_bytes = build()
+    print(f"{num_assets} assets written to {STORE_FILE} ({round(num_bytes / 1024 ** 2, 1)}MB)")
+
+
+if __name__ == "__main__":
+    main()
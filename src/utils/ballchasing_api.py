@@ -1,93 +1,136 @@
 import logging
 from requests import sessions
+import aiohttp
 from datetime import datetime, timedelta
 import time
 
 import json
+from utils.log import setup_logging
 
 logger = logging.getLogger("script.ballchasing_api")
 
-logging.basicConfig(
-    filename="../logs/rlis.log",
-    encoding="utf-8",
-    datefmt="%Y-%m-%d %H:%M:%S",
-    format="[%(asctime)s] [%(levelname)-8s] %(name)s: %(message)s",
-    level=logging.DEBUG,
-)
+setup_logging()
 
 
-class API:
-    def __init__(self, api_key):
+BASE_URL = "https://ballchasing.com/api/replays"
 
-        self.api_key = api_key
 
-        # Establish a session to reuse TCP connection
-        self._session = sessions.Session()
+# Url of a search for private match replays including every one of the players (given as
+# (platform, id)), uploaded between start and end
+def filter_url(start: datetime, end: datetime, players: list[tuple[int, int]]) -> str:
 
-        logger.info("Established session with ballchasing.com API")
+    # Base url only requires private match playlist type
+    url = f"{BASE_URL}?playlist=private"
 
-    def filter(self, start: datetime, end: datetime, players: list[tuple[int, int]]) -> dict:
+    # Add player constraints
+    for player in players:
+        url += f"&player-id={player[0]}:{player[1]}"
 
-        # Base url only requires private match playlist type
-        url = "https://ballchasing.com/api/replays?playlist=private"
+    time_format = "%Y-%m-%dT%H:%M:00Z"
+    start_str = start.strftime(time_format)
+    end_str = end.strftime(time_format)
+    # Add time constraints
+    url += f"&created-after={start_str}&created-before={end_str}"
 
-        # Add player constraints
-        for player in players:
-            url += f"&player-id={player[0]}:{player[1]}"
+    return url
 
-        time_format = "%Y-%m-%dT%H:%M:00Z"
-        start_str = start.strftime(time_format)
-        end_str = end.strftime(time_format)
-        # Add time constraints
-        url += f"&created-after={start_str}&created-before={end_str}"
 
-        r = self._session.get(url, headers={"Authorization": self.api_key})
+def replay_url(id: str) -> str:
+    return f"{BASE_URL}/{id}"
 
-        if r.status_code == 200:
-            logger.info(f"Call returned {r.status_code}")
 
-            data = r.json()
+# Further filter the results of a search to only include those with exactly the specified players
+def trim_filter_result(data: dict, players: list[tuple[int, int]]) -> dict:
+    data["list"] = [
+        game
+        for game in data["list"]
+        if len(game["blue"]["players"]) + len(game["orange"]["players"]) == len(players)
+    ]
 
-            # Further filter the results to only include those with exactly the specified players
-            data["list"] = [
-                game
-                for game in data["list"]
-                if len(game["blue"]["players"]) + len(game["orange"]["players"]) == len(players)
-            ]
+    data["count"] = len(data["list"])
 
-            data["count"] = len(data["list"])
+    return data
 
-            return data
 
-        elif r.status_code == 429:
-            logger.warning(f"Call returned {r.status_code}, slow down requests")
-            return r.json()
+# Log the status of a call, returning its data if it can be used. A replay which doesn't exist
+# gives {} if missing_ok, and any other failure raises APIError
+def handle_status(status: int, data: dict, missing_ok: bool = False) -> dict:
+    if status == 200:
+        logger.info(f"Call returned {status}")
+        return data
 
-        else:
-            logger.error(f"Call returned {r.status_code}, failing")
-            raise APIError(f"status code {r.status_code}")
+    elif status == 429:
+        logger.warning(f"Call returned {status}, slow down requests")
+        return data
 
-    def get(self, id: str) -> dict:
-        url = f"https://ballchasing.com/api/replays/{id}"
+    elif status == 404 and missing_ok:
+        logger.warning(f"Call returned {status}, replay does not exist")
+        return {}
+
+    else:
+        logger.error(f"Call returned {status}, failing")
+        raise APIError(f"status code {status}")
+
+
+class API:
+    def __init__(self, api_key):
+
+        self.api_key = api_key
 
+        # Establish a session to reuse TCP connection
+        self._session = sessions.Session()
+
+        logger.info("Established session with ballchasing.com API")
+
+    # Get a url, returning its status and its data if it has any
+    def _get(self, url):
         r = self._session.get(url, headers={"Authorization": self.api_key})
+        if r.status_code in (200, 429):
+            return r.status_code, r.json()
+        return r.status_code, None
+
+    def filter(self, start: datetime, end: datetime, players: list[tuple[int, int]]) -> dict:
+        status, data = self._get(filter_url(start, end, players))
+        data = handle_status(status, data)
+        return trim_filter_result(data, players) if status == 200 else data
+
+    def get(self, id: str) -> dict:
+        status, data = self._get(replay_url(id))
+        return handle_status(status, data, missing_ok=True)
+
+
+# Async version of API for use inside the bot's event loop, with the same filter and get semantics
+class AsyncAPI:
+    def __init__(self, api_key):
+
+        self.api_key = api_key
+
+        # Created on first use, so that the session belongs to the running event loop
+        self._session = None
 
-        if r.status_code == 200:
-            logger.info(f"Call returned {r.status_code}")
+    async def _get(self, url):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(headers={"Authorization": self.api_key})
+            logger.info("Established session with ballchasing.com API")
 
-            return r.json()
+        async with self._session.get(url) as r:
+            if r.status in (200, 429):
+                return r.status, await r.json()
+            return r.status, None
 
-        elif r.status_code == 429:
-            logger.warning(f"Call returned {r.status_code}, slow down requests")
-            return r.json()
+    async def filter(self, start: datetime, end: datetime, players: list[tuple[int, int]]) -> dict:
+        status, data = await self._get(filter_url(start, end, players))
+        data = handle_status(status, data)
+        return trim_filter_result(data, players) if status == 200 else data
 
-        elif r.status_code == 404:
-            logger.warning(f"Call returned {r.status_code}, replay does not exist")
-            return {}
+    async def get(self, id: str) -> dict:
+        status, data = await self._get(replay_url(id))
+        return handle_status(status, data, missing_ok=True)
 
-        else:
-            logger.error(f"Call returned {r.status_code}, failing")
-            raise APIError(f"status code {r.status_code}")
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
 
 
 class APIError(Exception):
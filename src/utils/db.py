@@ -0,0 +1,81 @@
+import os
+import json
+import sqlite3
+import logging
+import threading
+from utils.log import setup_logging
+from utils.sql_stats import TimedConnection
+
+with open("../config.json", "r") as read_file:
+    config = json.load(read_file)
+
+DB_FILE = "../data/rlis_data.db"
+
+# Connection settings, see example_config.json
+DATABASE = config.get("DATABASE", {})
+
+# busy_timeout is applied first so that the journal mode change waits for other processes rather
+# than failing if the database is locked. journal_mode=WAL is persistent and lets the bot read
+# while the cron worker writes (and vice versa)
+DEFAULT_PRAGMAS = {
+    "busy_timeout": 5000,
+    "journal_mode": "wal",
+    "synchronous": "normal",
+    "foreign_keys": "on",
+    "cache_size": -16000,
+    "mmap_size": 268435456,
+}
+
+PRAGMAS = DEFAULT_PRAGMAS | DATABASE.get("pragmas", {})
+
+# Number of prepared statements each connection keeps
+STATEMENT_CACHE = DATABASE.get("statement_cache", 256)
+
+logger = logging.getLogger("script.db")
+
+setup_logging()
+
+_local = threading.local()
+
+
+# Apply each pragma to a connection, in order
+def apply_pragmas(con, pragmas=PRAGMAS):
+    for pragma, value in pragmas.items():
+        con.execute(f"PRAGMA {pragma} = {value}")
+
+
+# Open a new connection with the configured pragmas. Read only connections set query_only, so
+# renderers can never write or take a write lock by accident
+def connect(read_only=False):
+    # Statements are timed, see utils/sql_stats.py
+    con = sqlite3.connect(DB_FILE, cached_statements=STATEMENT_CACHE, factory=TimedConnection)
+    apply_pragmas(con)
+    if read_only:
+        con.execute("PRAGMA query_only = ON")
+
+    logger.debug(f"Opened {'read only' if read_only else 'read/write'} database connection")
+
+    return con
+
+
+# Get this thread's connection, opening it on first use. Connections are reused for the life of
+# the thread, so callers should commit their writes but not close the connection
+def get_connection(read_only=False):
+    # A forked process mustn't reuse its parent's connections
+    if getattr(_local, "pid", None) != os.getpid():
+        _local.pid = os.getpid()
+        _local.connections = {}
+
+    con = _local.connections.get(read_only)
+    if con is None:
+        con = connect(read_only)
+        _local.connections[read_only] = con
+
+    return con
+
+
+# Close this thread's connections
+def close_connections():
+    for con in getattr(_local, "connections", {}).values():
+        con.close()
+    _local.connections = {}
@@ -0,0 +1,181 @@
+import os
+import json
+import logging
+from collections import OrderedDict
+from functools import lru_cache
+from threading import Lock
+
+from PIL import Image, ImageFont
+
+from utils.asset_store import get_store
+from utils.log import setup_logging
+
+with open("../config.json", "r") as read_file:
+    config = json.load(read_file)
+
+# Encoder settings for each output (standings, results, stats), see example_config.json
+GRAPHICS = config.get("GRAPHICS", {})
+
+DEFAULT_ENCODING = {
+    "format": "png",
+    "compress_level": 5,
+    "quantize": False,
+    "colors": 256,
+    "lossless": True,
+    "quality": 90,
+    "method": 4,
+    "preview_width": None,
+}
+
+EXTENSIONS = {"png": "png", "webp": "webp"}
+
+logger = logging.getLogger("script.graphics")
+
+setup_logging()
+
+
+# Fonts are loaded once per (file, size) rather than every time some text is drawn
+@lru_cache(maxsize=None)
+def get_font(font_file, size):
+    return ImageFont.truetype(f"assets/fonts/{font_file}", size)
+
+
+# Templates are mapped from the asset store if it has been built, otherwise they are decoded once.
+# Either way they are read only and must be copied before being drawn on
+@lru_cache(maxsize=None)
+def get_template(template_file):
+    store = get_store()
+    if store is not None:
+        template = store.get("templates", template_file)
+        if template is not None:
+            return template
+
+    return Image.open(f"assets/templates/{template_file}").convert("RGBA")
+
+
+# Logos are mapped from the asset store if it has been built, otherwise they are decoded and
+# resized once per (file, size) - size None keeps the original dimensions
+@lru_cache(maxsize=None)
+def get_logo(logo_file, size=None):
+    store = get_store()
+    if store is not None:
+        logo = store.get("logos", logo_file, size)
+        if logo is not None:
+            return logo
+
+    logo = Image.open(f"assets/logos/{logo_file}").convert("RGBA")
+    if size is not None:
+        logo = logo.resize(size)
+    return logo
+
+
+# In-memory cache of rendered tiles (e.g. one standings row or one results box). Each tile is keyed
+# by the data drawn on it, so a tile is only redrawn when that data changes. Least recently used
+# tiles are evicted once max_tiles is exceeded.
+class TileCache:
+    def __init__(self, name, max_tiles=128):
+        self.name = name
+        self.max_tiles = max_tiles
+
+        self._tiles = OrderedDict()
+        # Graphics are generated in worker threads by the bot, so guard the cache with a lock
+        self._lock = Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, render):
+        with self._lock:
+            tile = self._tiles.get(key)
+            if tile is not None:
+                self._tiles.move_to_end(key)
+                self.hits += 1
+                return tile
+
+        # Render outside of the lock so that a slow render doesn't block other threads
+        tile = render()
+
+        with self._lock:
+            self.misses += 1
+            self._tiles[key] = tile
+            self._tiles.move_to_end(key)
+            while len(self._tiles) > self.max_tiles:
+                self._tiles.popitem(last=False)
+
+        return tile
+
+    def clear(self):
+        with self._lock:
+            self._tiles.clear()
+        logger.debug(f"Cleared {self.name} tile cache")
+
+
+# Get the encoder settings for an output, falling back to the defaults for any missing keys
+def encoding_for(output):
+    return DEFAULT_ENCODING | GRAPHICS.get(output, {})
+
+
+# Get the path of a stored graphic (e.g. graphic_path("results", "premier_week_1"))
+def graphic_path(output, name, preview=False):
+    ext = EXTENSIONS[encoding_for(output)["format"]]
+    if preview:
+        return f"../data/graphics/{name}_preview.{ext}"
+    return f"../data/graphics/{name}.{ext}"
+
+
+# Get the path of the graphic which should be sent to Discord - the preview if one is configured
+# and exists, otherwise the full size graphic
+def upload_path(output, name):
+    if encoding_for(output)["preview_width"] is not None:
+        path = graphic_path(output, name, preview=True)
+        if os.path.exists(path):
+            return path
+    return graphic_path(output, name)
+
+
+# Delete a stored graphic (and its preview) in any format, if it exists
+def remove_graphic(name):
+    for ext in EXTENSIONS.values():
+        for path in [f"../data/graphics/{name}.{ext}", f"../data/graphics/{name}_preview.{ext}"]:
+            try:
+                os.remove(path)
+                logger.debug(f"Outdated graphic {path} removed")
+            except OSError:
+                pass
+
+
+# Encode an image to a file path or file object with the given encoder settings
+def encode(image, fp, settings):
+    if settings["format"] == "webp":
+        image.save(
+            fp,
+            "WEBP",
+            lossless=settings["lossless"],
+            quality=settings["quality"],
+            method=settings["method"],
+        )
+    else:
+        # Reduce to a palette image - much smaller, and fast to compress since there are
+        # fewer bytes per pixel
+        if settings["quantize"]:
+            image = image.quantize(colors=settings["colors"], method=Image.Quantize.FASTOCTREE)
+        image.save(fp, "PNG", compress_level=settings["compress_level"])
+
+
+# Save a rendered graphic using the encoder settings of its output, plus a downscaled preview if
+# one is configured. Returns the path of the full size graphic
+def save_graphic(image, output, name):
+    settings = encoding_for(output)
+
+    path = graphic_path(output, name)
+    encode(image, path, settings)
+
+    if settings["preview_width"] is not None:
+        width = settings["preview_width"]
+        height = round(image.height * width / image.width)
+        preview = image.resize((width, height), Image.Resampling.LANCZOS)
+        encode(preview, graphic_path(output, name, preview=True), settings)
+
+    logger.debug(f"Saved {path} as {settings['format']}")
+
+    return path
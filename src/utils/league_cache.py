@@ -0,0 +1,201 @@
+import json
+import time
+import logging
+import sqlite3
+import asyncio
+
+from discord.ext import tasks
+
+from utils.player_index import PlayerIndex
+from utils.profiling import profile_calls
+
+logger = logging.getLogger("bot.league_cache")
+
+with open("../config.json", "r") as read_file:
+    config = json.load(read_file)
+
+TIERS = config["TIERS"]
+ORGS = config["ORGS"]
+
+# How often to check whether another process (e.g. a loader script) has changed the players or
+# fixtures tables, in seconds
+VERSION_CHECK_INTERVAL = 30
+
+
+# In memory copy of the league's orgs, tiers, players and fixtures, shared by every cog through
+# bot.league. The bot refreshes it after writing to the players or fixtures tables itself, and
+# writes from other processes are picked up by polling the league_version table. Changes made by
+# syncs are passed on to dispatch, so that cogs can refresh whatever they affect
+class LeagueCache:
+    def __init__(self, pool, dispatch=None):
+        self.pool = pool
+        self.dispatch = dispatch
+
+        self.orgs = ORGS
+        self.tiers = TIERS
+
+        # Names of every main roster player and every sub
+        self.players = []
+        self.subs = []
+        # Main roster of each org in each tier, stored as {(tier, org): [name]}
+        self.rosters = {}
+        # Name, tier and org of each discord user, preferring their main roster entry
+        self.members = {}
+        # Name of the player behind each platform account, stored as {(platform, id): name}
+        self.identities = {}
+        # Week of each fixture, stored as {(tier, frozenset of org ids): week}
+        self.fixture_weeks = {}
+        # Search index over player and sub names, updated in place as the rosters change
+        self.player_index = PlayerIndex()
+
+        self.version = None
+        # Id of the last change event seen in league_changes
+        self.change_id = None
+        self.refreshed_at = None
+        self.lock = asyncio.Lock()
+
+        self.watch_version = tasks.loop(seconds=VERSION_CHECK_INTERVAL)(self.check_version)
+
+    # Get the number of changes made to the players and fixtures tables, or None if the database
+    # predates the league_version table
+    async def get_version(self, con):
+        try:
+            res = await con.execute("SELECT version FROM league_version")
+            row = await res.fetchone()
+        except sqlite3.OperationalError:
+            return None
+
+        return row["version"] if row is not None else None
+
+    # Get the change events recorded since the last one seen, as a list of (kind, tier, org, week).
+    # The first call only notes the latest event, as the cache is refreshed in full on startup
+    async def get_changes(self, con):
+        try:
+            if self.change_id is None:
+                res = await con.execute("SELECT IFNULL(MAX(id), 0) AS id FROM league_changes")
+                self.change_id = (await res.fetchone())["id"]
+                return []
+
+            res = await con.execute(
+                "SELECT id, kind, tier, org, week FROM league_changes WHERE id > ? ORDER BY id",
+                (self.change_id,),
+            )
+            rows = await res.fetchall()
+        except sqlite3.OperationalError:
+            return []
+
+        if rows != []:
+            self.change_id = rows[-1]["id"]
+
+        return [(row["kind"], row["tier"], row["org"], row["week"]) for row in rows]
+
+    # Reload everything from the database, replacing the cached data in one go so that readers
+    # never see a partially refreshed cache
+    @profile_calls("league_refresh")
+    async def refresh(self):
+        async with self.lock:
+            t1 = time.perf_counter()
+
+            async with self.pool.acquire() as con:
+                version = await self.get_version(con)
+
+                res = await con.execute(
+                    """SELECT id, status, name, platform, platform_id, tier, org
+                    FROM players ORDER BY id, status"""
+                )
+                player_rows = await res.fetchall()
+
+                res = await con.execute("SELECT week, tier, org_1, org_2 FROM fixtures")
+                fixture_rows = await res.fetchall()
+
+            players = []
+            subs = []
+            rosters = {}
+            members = {}
+            identities = {}
+            index_entries = {}
+            for row in player_rows:
+                if row["status"] == "main":
+                    players.append(row["name"])
+                    rosters.setdefault((row["tier"], row["org"]), []).append(row["name"])
+                elif row["status"] == "sub":
+                    subs.append(row["name"])
+
+                # Rows are ordered by status, so a user's main entry is seen before their sub one
+                members.setdefault(
+                    row["id"], {"name": row["name"], "tier": row["tier"], "org": row["org"]}
+                )
+                identities[(row["platform"], row["platform_id"])] = row["name"]
+                index_entries[(row["name"], row["status"])] = (row["tier"], row["org"])
+
+            fixture_weeks = {
+                (row["tier"], frozenset((row["org_1"], row["org_2"]))): row["week"]
+                for row in fixture_rows
+            }
+
+            self.players = players
+            self.subs = subs
+            self.rosters = rosters
+            self.members = members
+            self.identities = identities
+            self.fixture_weeks = fixture_weeks
+            changed = self.player_index.update(index_entries)
+            self.version = version
+            self.refreshed_at = time.time()
+
+        logger.info(
+            f"Refreshed league cache with {len(players)} players, {len(subs)} subs and "
+            f"{len(fixture_weeks)} fixtures in {round(time.perf_counter() - t1, 3)}s "
+            f"({changed} player index entries changed)"
+        )
+
+    # Refresh the cache if the players or fixtures tables have changed since the last refresh, and
+    # dispatch any new change events. The events are read on every check rather than only when the
+    # version has changed, as a refresh by the bot itself (e.g. after registering a sub) may have
+    # already taken in the version bump of a sync
+    async def check_version(self):
+        try:
+            async with self.pool.acquire() as con:
+                version = await self.get_version(con)
+                changes = await self.get_changes(con)
+
+            if version != self.version:
+                logger.debug(f"League version changed from {self.version} to {version}")
+                await self.refresh()
+
+            if changes != [] and self.dispatch is not None:
+                logger.info(f"Dispatching {len(changes)} league changes")
+                self.dispatch("league_changed", changes)
+        except Exception as e:
+            logger.error(f"Failed to check league version ({type(e).__name__}: {e})")
+
+    async def start(self):
+        async with self.pool.acquire() as con:
+            await self.get_changes(con)
+        await self.refresh()
+        self.watch_version.start()
+
+    def stop(self):
+        self.watch_version.cancel()
+
+    # Get a copy of the main roster of an org in a tier
+    def roster(self, tier, org):
+        return list(self.rosters.get((tier, org), []))
+
+    # Search player and sub names for an autocomplete, favouring the tier and orgs already entered
+    # on the command, or else the user's own tier and org. Returns a list of (name, status)
+    def search_players(self, current, interaction):
+        namespace = interaction.namespace
+        member = self.members.get(interaction.user.id, {})
+
+        tier = namespace.tier or member.get("tier")
+        orgs = {org for org in (namespace.winning_org, namespace.losing_org) if org is not None}
+        if not orgs and member.get("org") is not None:
+            orgs = {member["org"]}
+
+        return self.player_index.search(current, tier, orgs)
+
+    # Get the week in which two orgs play each other in a tier, or None if there's no such fixture
+    def week_of(self, tier, org_1, org_2):
+        ids = frozenset((self.orgs[org_1]["id"], self.orgs[org_2]["id"]))
+        return self.fixture_weeks.get((tier, ids))
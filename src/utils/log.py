@@ -0,0 +1,274 @@
+import os
+import re
+import gzip
+import json
+import time
+import fcntl
+import queue
+import shutil
+import datetime as dt
+import atexit
+import logging
+import logging.handlers
+import multiprocessing.util
+from threading import Lock
+
+with open("../config.json", "r") as read_file:
+    config = json.load(read_file)
+
+LOG_FILE = "../logs/rlis.log"
+
+# Logging settings, see example_config.json
+LOGGING = config.get("LOGGING", {})
+
+LEVEL = LOGGING.get("level", "DEBUG")
+
+# Level of individual loggers, overriding LEVEL
+DEFAULT_LEVELS = {
+    # Suppress shard related logs from discord.gateway
+    "discord.gateway": "WARNING",
+    # Suppress spammy PIL image editing logs
+    "PIL.PngImagePlugin": "WARNING",
+}
+
+LEVELS = DEFAULT_LEVELS | LOGGING.get("levels", {})
+
+# Loggers whose DEBUG records come from hot paths (per replay, per player, per autocomplete
+# keystroke), and the minimum number of seconds between DEBUG records from the same line of each
+DEFAULT_SAMPLED = {
+    "bot.helper": 1,
+    "bot.reporting": 1,
+    "bot.results": 1,
+    "script.get_stats": 1,
+    "script.draw_stats": 1,
+    "script.graphics": 1,
+    "script.asset_store": 1,
+}
+
+SAMPLED = DEFAULT_SAMPLED | LOGGING.get("sampled", {})
+
+# Start a new log file once the current one reaches this size in bytes (kept under Discord's upload
+# limit so /get_logs can always send it) or age in hours, keeping this many gzipped archives
+MAX_BYTES = LOGGING.get("max_bytes", 8 * 1024 * 1024)
+MAX_AGE_HOURS = LOGGING.get("max_age_hours", 24)
+BACKUP_COUNT = LOGGING.get("backup_count", 14)
+
+FORMAT = "[%(asctime)s] [%(levelname)-8s] %(name)s: %(message)s"
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Matches the start of a record written with FORMAT. Lines that don't match (e.g. tracebacks)
+# belong to the record before them
+RECORD_START = re.compile(r"^\[(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d)\] \[(\w+) *\] ([^:]+):")
+
+# Number of bytes read at a time when reading the log backwards
+TAIL_BLOCK_SIZE = 64 * 1024
+
+_handler = None
+_listener = None
+
+
+# Let through at most one DEBUG record per line of code every interval seconds, noting how many
+# were dropped in between on the next one let through. Other levels are never dropped
+class SampleFilter(logging.Filter):
+    def __init__(self, interval):
+        super().__init__()
+        self.interval = interval
+        # {(path, line): (time of the last record let through, number dropped since)}
+        self.sites = {}
+        self.lock = Lock()
+
+    def filter(self, record):
+        if record.levelno != logging.DEBUG:
+            return True
+
+        site = (record.pathname, record.lineno)
+        with self.lock:
+            last, dropped = self.sites.get(site, (0, 0))
+            if record.created - last < self.interval:
+                self.sites[site] = (last, dropped + 1)
+                return False
+            self.sites[site] = (record.created, 0)
+
+        if dropped > 0:
+            record.msg = f"{record.getMessage()} ({dropped} similar suppressed)"
+            record.args = None
+        return True
+
+
+# File handler that starts a new file once the current one is too big or too old, gzipping the old
+# one. The bot and the scripts share the log file, so rollovers are made under a lock file and each
+# process reopens the file if another process has rolled it over
+class CompressedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    def __init__(self, filename, max_bytes, max_age_hours, backup_count):
+        super().__init__(
+            filename, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8", delay=True
+        )
+        self.max_age = max_age_hours * 3600
+        self.lock_file = f"{self.baseFilename}.lock"
+        self.rollover_at = None
+
+    def namer(self, name):
+        return f"{name}.gz"
+
+    def rotator(self, source, dest):
+        with open(source, "rb") as f_in, gzip.open(dest, "wb") as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        os.remove(source)
+
+    # Open the file, working out when it's due to be rolled over from the time of its first record
+    def _open(self):
+        stream = super()._open()
+
+        opened = time.time()
+        with open(self.baseFilename, "r", encoding="utf-8", errors="replace") as f:
+            match = RECORD_START.match(f.readline())
+        if match is not None:
+            opened = dt.datetime.strptime(match[1], DATE_FORMAT).timestamp()
+
+        self.rollover_at = opened + self.max_age
+        return stream
+
+    # Reopen the file if it has been rolled over by another process
+    def reopen_if_moved(self):
+        if self.stream is None:
+            return
+        try:
+            moved = os.stat(self.baseFilename).st_ino != os.fstat(self.stream.fileno()).st_ino
+        except FileNotFoundError:
+            moved = True
+        if moved:
+            self.stream.close()
+            self.stream = self._open()
+
+    def due(self):
+        return self.stream.tell() >= self.maxBytes or time.time() >= self.rollover_at
+
+    def shouldRollover(self, record):
+        self.reopen_if_moved()
+        if self.stream is None:
+            self.stream = self._open()
+
+        return self.due()
+
+    def doRollover(self):
+        with open(self.lock_file, "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            # Another process may have rolled the file over while waiting for the lock
+            self.reopen_if_moved()
+            if self.stream.tell() == 0:
+                self.rollover_at = time.time() + self.max_age
+                return
+            if not self.due():
+                return
+
+            super().doRollover()
+            self.stream = self._open()
+
+
+# Write records to the log file from a background thread. The handler on the root logger only puts
+# records on a queue, so logging never waits on the disk
+def start_listener(log_queue):
+    global _listener
+
+    file_handler = CompressedRotatingFileHandler(LOG_FILE, MAX_BYTES, MAX_AGE_HOURS, BACKUP_COUNT)
+    file_handler.setFormatter(logging.Formatter(FORMAT, DATE_FORMAT))
+
+    _listener = logging.handlers.QueueListener(log_queue, file_handler, respect_handler_level=True)
+    _listener.start()
+
+
+# Flush any queued records and close the log file
+def stop_listener():
+    global _listener
+
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+# A forked process (e.g. a render worker) inherits the handler but not the thread writing out its
+# queue, so give it a queue and listener of its own. Worker processes exit without running atexit
+# functions, so the listener is also stopped by multiprocessing's own exit handling
+def restart_listener_in_child():
+    if _handler is not None:
+        _handler.queue = queue.SimpleQueue()
+        start_listener(_handler.queue)
+        multiprocessing.util.Finalize(None, stop_listener, exitpriority=0)
+
+
+# Set up logging for the process, once. Called at import by every module that logs, in place of
+# logging.basicConfig
+def setup_logging():
+    global _handler
+
+    if _handler is not None:
+        return
+
+    _handler = logging.handlers.QueueHandler(queue.SimpleQueue())
+    start_listener(_handler.queue)
+    atexit.register(stop_listener)
+
+    root = logging.getLogger()
+    root.addHandler(_handler)
+    root.setLevel(LEVEL)
+
+    for name, level in LEVELS.items():
+        logging.getLogger(name).setLevel(level)
+
+    for name, interval in SAMPLED.items():
+        logging.getLogger(name).addFilter(SampleFilter(interval))
+
+
+os.register_at_fork(after_in_child=restart_listener_in_child)
+
+
+# Get the last lines records of the log file, oldest first, by reading backwards from the end of the
+# file until enough have been found. Records can be filtered by logger name (including the loggers
+# below it), minimum level and a time range
+def tail(lines, name=None, level=None, since=None, until=None, path=LOG_FILE):
+    min_level = logging.getLevelName(level) if level is not None else logging.NOTSET
+
+    records = []
+    # Lines read since the last record start, i.e. the rest of the record being read backwards
+    continuation = []
+    with open(path, "rb") as f:
+        position = f.seek(0, os.SEEK_END)
+        remainder = b""
+        while position > 0 and len(records) < lines:
+            size = min(TAIL_BLOCK_SIZE, position)
+            position -= size
+            f.seek(position)
+            block = f.read(size) + remainder
+
+            # The first line of the block may be incomplete, so keep it for the next block
+            block_lines = block.split(b"\n")
+            remainder = block_lines.pop(0) if position > 0 else b""
+
+            for raw in reversed(block_lines):
+                line = raw.decode("utf-8", errors="replace")
+                match = RECORD_START.match(line)
+                if match is None:
+                    if line != "":
+                        continuation.append(line)
+                    continue
+
+                record = "\n".join([line] + continuation[::-1])
+                continuation = []
+
+                timestamp = dt.datetime.strptime(match[1], DATE_FORMAT)
+                # Records are written in time order, so nothing earlier can match
+                if since is not None and timestamp < since:
+                    return records[::-1]
+                if until is not None and timestamp > until:
+                    continue
+                if name is not None and match[3] != name and not match[3].startswith(f"{name}."):
+                    continue
+                if logging.getLevelName(match[2]) < min_level:
+                    continue
+
+                records.append(record)
+                if len(records) == lines:
+                    break
+
+    return records[::-1]
@@ -0,0 +1,545 @@
+import sys
+import sqlite3
+import logging
+import argparse
+
+logger = logging.getLogger("script.migrations")
+
+# Versioned schema changes, applied in order to bring any database up to the latest version.
+# The version a database is at is stored in PRAGMA user_version. Each migration must be safe to
+# apply to a live database in place, and is applied in a single transaction.
+MIGRATIONS = [
+    (
+        1,
+        "Base schema",
+        """
+        CREATE TABLE IF NOT EXISTS players(
+            id INTEGER,
+            status TEXT,
+            name TEXT NOT NULL,
+            platform TEXT NOT NULL,
+            platform_id TEXT NOT NULL,
+            tier TEXT,
+            org TEXT,
+            PRIMARY KEY(id, status)
+        ) STRICT;
+
+        CREATE TABLE IF NOT EXISTS fixtures(
+            week INTEGER,
+            tier TEXT,
+            org_1 INTEGER,
+            org_2 INTEGER,
+            PRIMARY KEY(week, tier, org_1, org_2)
+        ) STRICT;
+
+        CREATE TABLE IF NOT EXISTS series_log(
+            timestamp INTEGER NOT NULL,
+            game_id INTEGER PRIMARY KEY,
+            tier TEXT NOT NULL,
+            mode INTEGER NOT NULL,
+            winning_org TEXT NOT NULL,
+            losing_org TEXT NOT NULL,
+            games_won_by_loser INTEGER NOT NULL,
+            played_previously INTEGER NOT NULL,
+            replays_stored INTEGER,
+            published INTEGER NOT NULL
+        ) STRICT;
+
+        CREATE TABLE IF NOT EXISTS series_players(
+            game_id INTEGER PRIMARY KEY,
+            wp1 TEXT,
+            wp2 TEXT,
+            wp3 TEXT,
+            lp1 TEXT,
+            lp2 TEXT,
+            lp3 TEXT,
+            FOREIGN KEY(game_id) REFERENCES series_log(game_id) ON DELETE CASCADE
+        ) STRICT;
+
+        CREATE TABLE IF NOT EXISTS game_stats(
+            guid TEXT PRIMARY KEY,
+            url TEXT NOT NULL,
+            timestamp INTEGER NOT NULL,
+            game_id INTEGER NOT NULL,
+            winning_org TEXT NOT NULL,
+            losing_org TEXT NOT NULL,
+            duration REAL,
+            overtime_duration REAL,
+            winner_goals INTEGER,
+            loser_goals INTEGER,
+            time_in_side_winner REAL,
+            time_in_side_loser REAL,
+            FOREIGN KEY(game_id) REFERENCES series_log(game_id) ON DELETE CASCADE
+        ) STRICT;
+
+        CREATE TABLE IF NOT EXISTS player_stats(
+            guid TEXT NOT NULL,
+            name TEXT NOT NULL,
+            game_id INTEGER NOT NULL,
+            duration REAL,
+            goals INTEGER,
+            assists INTEGER,
+            saves INTEGER,
+            shots INTEGER,
+            score INTEGER,
+            demos_inflicted INTEGER,
+            demos_taken INTEGER,
+            car TEXT,
+            boost_while_ss INTEGER,
+            time_0_boost REAL,
+            avg_speed REAL,
+            dist_travelled INTEGER,
+            PRIMARY KEY(guid, name),
+            FOREIGN KEY(guid) REFERENCES game_stats(guid) ON DELETE CASCADE
+        ) STRICT;
+
+        CREATE TABLE IF NOT EXISTS stats_stack(
+            priority INTEGER PRIMARY KEY,
+            game_id INTEGER NOT NULL,
+            replay_id TEXT,
+            start_timestamp INTEGER,
+            end_timestamp INTEGER,
+            winning_org TEXT,
+            losing_org TEXT,
+            p_out TEXT,
+            alt_platform TEXT,
+            alt_platform_id TEXT,
+            FOREIGN KEY(game_id) REFERENCES series_log(game_id) ON DELETE CASCADE
+        ) STRICT;
+        """,
+    ),
+    (
+        2,
+        "Indexes for hot queries",
+        # player_stats lookups by guid are already served by its (guid, name) primary key
+        """
+        CREATE INDEX IF NOT EXISTS game_stats_by_game_id
+        ON game_stats(game_id, timestamp, url);
+
+        CREATE INDEX IF NOT EXISTS players_by_platform
+        ON players(platform, platform_id, name);
+
+        CREATE INDEX IF NOT EXISTS players_by_roster
+        ON players(tier, org, status, name);
+
+        CREATE INDEX IF NOT EXISTS series_log_unpublished
+        ON series_log(timestamp) WHERE published = 0 AND replays_stored IS NOT NULL;
+        """,
+    ),
+    (
+        3,
+        "Series participation of each player",
+        # One row per player per series, kept in sync with series_players and series_log by
+        # triggers so that it is populated whenever a series is reported or loaded
+        """
+        CREATE TABLE IF NOT EXISTS series_participation(
+            game_id INTEGER NOT NULL,
+            player TEXT NOT NULL,
+            org TEXT NOT NULL,
+            mode INTEGER NOT NULL,
+            won INTEGER NOT NULL,
+            PRIMARY KEY(game_id, player),
+            FOREIGN KEY(game_id) REFERENCES series_log(game_id) ON DELETE CASCADE
+        ) STRICT;
+
+        CREATE INDEX IF NOT EXISTS series_participation_by_player
+        ON series_participation(player, mode, won);
+
+        CREATE TRIGGER IF NOT EXISTS series_participation_insert AFTER INSERT ON series_players
+        BEGIN
+            INSERT OR IGNORE INTO series_participation
+            SELECT L.game_id, S.player, IIF(S.won, L.winning_org, L.losing_org), L.mode, S.won
+            FROM series_log AS L, (
+                SELECT NEW.wp1 AS player, 1 AS won UNION ALL SELECT NEW.wp2, 1
+                UNION ALL SELECT NEW.wp3, 1 UNION ALL SELECT NEW.lp1, 0
+                UNION ALL SELECT NEW.lp2, 0 UNION ALL SELECT NEW.lp3, 0
+            ) AS S
+            WHERE L.game_id = NEW.game_id AND S.player IS NOT NULL;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS series_participation_delete AFTER DELETE ON series_players
+        BEGIN
+            DELETE FROM series_participation WHERE game_id = OLD.game_id;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS series_participation_update AFTER UPDATE ON series_players
+        BEGIN
+            DELETE FROM series_participation WHERE game_id = OLD.game_id;
+
+            INSERT OR IGNORE INTO series_participation
+            SELECT L.game_id, S.player, IIF(S.won, L.winning_org, L.losing_org), L.mode, S.won
+            FROM series_log AS L, (
+                SELECT NEW.wp1 AS player, 1 AS won UNION ALL SELECT NEW.wp2, 1
+                UNION ALL SELECT NEW.wp3, 1 UNION ALL SELECT NEW.lp1, 0
+                UNION ALL SELECT NEW.lp2, 0 UNION ALL SELECT NEW.lp3, 0
+            ) AS S
+            WHERE L.game_id = NEW.game_id AND S.player IS NOT NULL;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS series_participation_series_update
+        AFTER UPDATE OF mode, winning_org, losing_org ON series_log
+        BEGIN
+            UPDATE series_participation
+            SET org = IIF(won, NEW.winning_org, NEW.losing_org), mode = NEW.mode
+            WHERE game_id = NEW.game_id;
+        END;
+
+        INSERT OR IGNORE INTO series_participation
+        SELECT L.game_id, S.player, IIF(S.won, L.winning_org, L.losing_org), L.mode, S.won
+        FROM series_log AS L JOIN (
+            SELECT game_id, wp1 AS player, 1 AS won FROM series_players
+            UNION ALL SELECT game_id, wp2, 1 FROM series_players
+            UNION ALL SELECT game_id, wp3, 1 FROM series_players
+            UNION ALL SELECT game_id, lp1, 0 FROM series_players
+            UNION ALL SELECT game_id, lp2, 0 FROM series_players
+            UNION ALL SELECT game_id, lp3, 0 FROM series_players
+        ) AS S ON S.game_id = L.game_id
+        WHERE S.player IS NOT NULL;
+        """,
+    ),
+    (
+        4,
+        "League version counter",
+        # Counts changes to the players and fixtures tables, so that the bot's league cache can
+        # tell when another process (e.g. a loader script) has changed them
+        """
+        CREATE TABLE IF NOT EXISTS league_version(
+            id INTEGER PRIMARY KEY CHECK(id = 0),
+            version INTEGER NOT NULL
+        ) STRICT;
+
+        INSERT OR IGNORE INTO league_version VALUES(0, 0);
+
+        CREATE TRIGGER IF NOT EXISTS league_version_players_insert AFTER INSERT ON players
+        BEGIN
+            UPDATE league_version SET version = version + 1;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS league_version_players_update AFTER UPDATE ON players
+        BEGIN
+            UPDATE league_version SET version = version + 1;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS league_version_players_delete AFTER DELETE ON players
+        BEGIN
+            UPDATE league_version SET version = version + 1;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS league_version_fixtures_insert AFTER INSERT ON fixtures
+        BEGIN
+            UPDATE league_version SET version = version + 1;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS league_version_fixtures_update AFTER UPDATE ON fixtures
+        BEGIN
+            UPDATE league_version SET version = version + 1;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS league_version_fixtures_delete AFTER DELETE ON fixtures
+        BEGIN
+            UPDATE league_version SET version = version + 1;
+        END;
+        """,
+    ),
+    (
+        5,
+        "Series timeline",
+        # When each stage between a series being reported (series_log.timestamp) and its stats
+        # being posted first happened. A row is added whenever a series is logged, and the
+        # stages are filled in by ingestion (get_stats.py or the ingestion cog) and the publisher
+        """
+        CREATE TABLE IF NOT EXISTS series_timeline(
+            game_id INTEGER PRIMARY KEY,
+            replays_found INTEGER,
+            stored INTEGER,
+            drawn INTEGER,
+            posted INTEGER,
+            FOREIGN KEY(game_id) REFERENCES series_log(game_id) ON DELETE CASCADE
+        ) STRICT;
+
+        CREATE TRIGGER IF NOT EXISTS series_timeline_insert AFTER INSERT ON series_log
+        BEGIN
+            INSERT OR IGNORE INTO series_timeline(game_id) VALUES(NEW.game_id);
+        END;
+
+        INSERT OR IGNORE INTO series_timeline(game_id) SELECT game_id FROM series_log;
+
+        CREATE INDEX IF NOT EXISTS series_log_by_timestamp
+        ON series_log(timestamp);
+        """,
+    ),
+    (
+        6,
+        "League change events",
+        # Tiers, orgs and weeks affected by each change a sync (load_csv.py --sync) makes to the
+        # players or fixtures tables, so that the bot only refreshes what they affect. week is
+        # NULL for players
+        """
+        CREATE TABLE IF NOT EXISTS league_changes(
+            id INTEGER PRIMARY KEY,
+            timestamp INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            tier TEXT,
+            org TEXT,
+            week INTEGER
+        ) STRICT;
+        """,
+    ),
+    (
+        7,
+        "Materialized standings",
+        # Standings per tier and org, kept up to date by triggers on series_log. standings_modes
+        # holds the points and max games of each mode, since triggers can't read the config. It
+        # starts empty, so org_standings isn't used until update_standings.py rebuild fills both
+        # from the config and series_log (standings are aggregated from series_log until then)
+        """
+        CREATE TABLE IF NOT EXISTS standings_modes(
+            mode INTEGER PRIMARY KEY,
+            points REAL NOT NULL,
+            max_games INTEGER NOT NULL
+        ) STRICT;
+
+        CREATE TABLE IF NOT EXISTS org_standings(
+            tier TEXT NOT NULL,
+            org TEXT NOT NULL,
+            points REAL NOT NULL,
+            series_won INTEGER NOT NULL,
+            series_lost INTEGER NOT NULL,
+            games_won INTEGER NOT NULL,
+            games_lost INTEGER NOT NULL,
+            PRIMARY KEY(tier, org)
+        ) STRICT;
+
+        CREATE TRIGGER IF NOT EXISTS org_standings_insert AFTER INSERT ON series_log
+        BEGIN
+            INSERT INTO org_standings
+            SELECT NEW.tier, NEW.winning_org, M.points, 1, 0, M.max_games, NEW.games_won_by_loser
+            FROM standings_modes AS M WHERE M.mode = NEW.mode
+            ON CONFLICT(tier, org) DO UPDATE SET
+                points = points + excluded.points,
+                series_won = series_won + 1,
+                games_won = games_won + excluded.games_won,
+                games_lost = games_lost + excluded.games_lost;
+
+            INSERT INTO org_standings
+            SELECT NEW.tier, NEW.losing_org, 0, 0, 1, NEW.games_won_by_loser, M.max_games
+            FROM standings_modes AS M WHERE M.mode = NEW.mode
+            ON CONFLICT(tier, org) DO UPDATE SET
+                series_lost = series_lost + 1,
+                games_won = games_won + excluded.games_won,
+                games_lost = games_lost + excluded.games_lost;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS org_standings_delete AFTER DELETE ON series_log
+        WHEN OLD.mode IN (SELECT mode FROM standings_modes)
+        BEGIN
+            UPDATE org_standings SET
+                points = points - (SELECT points FROM standings_modes WHERE mode = OLD.mode),
+                series_won = series_won - 1,
+                games_won = games_won - (SELECT max_games FROM standings_modes WHERE mode = OLD.mode),
+                games_lost = games_lost - OLD.games_won_by_loser
+            WHERE tier = OLD.tier AND org = OLD.winning_org;
+
+            UPDATE org_standings SET
+                series_lost = series_lost - 1,
+                games_won = games_won - OLD.games_won_by_loser,
+                games_lost = games_lost - (SELECT max_games FROM standings_modes WHERE mode = OLD.mode)
+            WHERE tier = OLD.tier AND org = OLD.losing_org;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS org_standings_update
+        AFTER UPDATE OF tier, mode, winning_org, losing_org, games_won_by_loser ON series_log
+        BEGIN
+            UPDATE org_standings SET
+                points = points - (SELECT points FROM standings_modes WHERE mode = OLD.mode),
+                series_won = series_won - 1,
+                games_won = games_won - (SELECT max_games FROM standings_modes WHERE mode = OLD.mode),
+                games_lost = games_lost - OLD.games_won_by_loser
+            WHERE tier = OLD.tier AND org = OLD.winning_org
+            AND OLD.mode IN (SELECT mode FROM standings_modes);
+
+            UPDATE org_standings SET
+                series_lost = series_lost - 1,
+                games_won = games_won - OLD.games_won_by_loser,
+                games_lost = games_lost - (SELECT max_games FROM standings_modes WHERE mode = OLD.mode)
+            WHERE tier = OLD.tier AND org = OLD.losing_org
+            AND OLD.mode IN (SELECT mode FROM standings_modes);
+
+            INSERT INTO org_standings
+            SELECT NEW.tier, NEW.winning_org, M.points, 1, 0, M.max_games, NEW.games_won_by_loser
+            FROM standings_modes AS M WHERE M.mode = NEW.mode
+            ON CONFLICT(tier, org) DO UPDATE SET
+                points = points + excluded.points,
+                series_won = series_won + 1,
+                games_won = games_won + excluded.games_won,
+                games_lost = games_lost + excluded.games_lost;
+
+            INSERT INTO org_standings
+            SELECT NEW.tier, NEW.losing_org, 0, 0, 1, NEW.games_won_by_loser, M.max_games
+            FROM standings_modes AS M WHERE M.mode = NEW.mode
+            ON CONFLICT(tier, org) DO UPDATE SET
+                series_lost = series_lost + 1,
+                games_won = games_won + excluded.games_won,
+                games_lost = games_lost + excluded.games_lost;
+        END;
+        """,
+    ),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+# Hot queries and the index each must use, checked with EXPLAIN QUERY PLAN so that schema or
+# query changes don't silently regress them to full table scans
+PLAN_CHECKS = [
+    (
+        "Replay urls of a series in order",
+        "SELECT url FROM game_stats WHERE game_id = ? ORDER BY timestamp ASC",
+        (1,),
+        "game_stats_by_game_id",
+    ),
+    (
+        "Goals of each game in a series in order",
+        """SELECT winning_org, losing_org, winner_goals, loser_goals
+        FROM game_stats WHERE game_id = ? ORDER BY timestamp ASC""",
+        (1,),
+        "game_stats_by_game_id",
+    ),
+    (
+        "Player name from platform id",
+        "SELECT name FROM players WHERE platform = ? AND platform_id = ?",
+        ("steam", "1"),
+        "players_by_platform",
+    ),
+    (
+        "Main roster of two orgs in a tier",
+        """SELECT name, org FROM players
+        WHERE tier = ? AND (org = ? OR org = ?) AND status = 'main'""",
+        ("A", "B", "C"),
+        "players_by_roster",
+    ),
+    (
+        "Oldest unpublished series",
+        """SELECT game_id FROM series_log
+        WHERE published = 0 AND replays_stored IS NOT NULL
+        ORDER BY timestamp ASC LIMIT 1""",
+        (),
+        "series_log_unpublished",
+    ),
+    (
+        "Player stats of the replays of a series",
+        """SELECT name, AVG(score) FROM player_stats
+        WHERE guid IN (SELECT guid FROM game_stats WHERE game_id = ?) GROUP BY name""",
+        (1,),
+        "sqlite_autoindex_player_stats_1",
+    ),
+    (
+        "Series record of a player",
+        """SELECT mode, SUM(won), COUNT(*) - SUM(won) FROM series_participation
+        WHERE player = ? GROUP BY mode""",
+        ("A",),
+        "series_participation_by_player",
+    ),
+    (
+        "Timelines of the most recently reported series",
+        """SELECT L.timestamp, T.replays_found, T.stored, T.drawn, T.posted
+        FROM series_log AS L JOIN series_timeline AS T ON T.game_id = L.game_id
+        ORDER BY L.timestamp DESC LIMIT ?""",
+        (100,),
+        "series_log_by_timestamp",
+    ),
+]
+
+
+def get_version(con):
+    return con.execute("PRAGMA user_version").fetchone()[0]
+
+
+# Apply every migration newer than the database's version, returning the versions applied. Each
+# migration is applied in its own transaction, so a failing one leaves the database at the last
+# version which applied cleanly
+def migrate(con):
+    version = get_version(con)
+    applied = []
+
+    for migration_version, description, sql in MIGRATIONS:
+        if migration_version <= version:
+            continue
+
+        logger.info(f"Applying migration {migration_version} ({description})")
+        try:
+            con.executescript(f"BEGIN; {sql}; PRAGMA user_version = {migration_version}; COMMIT;")
+        except sqlite3.Error as e:
+            # The script stops at the failing statement, leaving its transaction open
+            con.rollback()
+            logger.error(f"Migration {migration_version} failed and was rolled back ({e})")
+            raise
+        applied.append(migration_version)
+
+    return applied
+
+
+# Run EXPLAIN QUERY PLAN on each hot query, returning a list of (description, plan) for every
+# query which doesn't use its expected index
+def check_plans(con):
+    failures = []
+    for description, sql, params, index in PLAN_CHECKS:
+        plan = [row[3] for row in con.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+        if not any(index in step for step in plan):
+            failures.append((description, plan))
+
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage database schema migrations")
+    parser.add_argument(
+        "action",
+        choices=["status", "migrate", "check"],
+        help="status: show the schema version. "
+        "migrate: apply outstanding migrations. "
+        "check: verify the query plans of hot queries on a fresh and the live database",
+    )
+    parser.add_argument("--db", default="../data/rlis_data.db", help="Path to the database")
+    args = parser.parse_args()
+
+    con = sqlite3.connect(args.db)
+
+    if args.action == "status":
+        version = get_version(con)
+        print(f"Database is at version {version} of {LATEST_VERSION}")
+        for migration_version, description, _ in MIGRATIONS:
+            state = "applied" if migration_version <= version else "pending"
+            print(f"\t{migration_version}: {description} ({state})")
+
+    elif args.action == "migrate":
+        applied = migrate(con)
+        if applied:
+            print(f"Applied migrations {', '.join(str(v) for v in applied)}")
+        else:
+            print(f"Database is already at version {LATEST_VERSION}")
+
+    else:
+        # Check a fresh database built purely from the migrations, and the live database
+        fresh = sqlite3.connect(":memory:")
+        migrate(fresh)
+
+        failed = False
+        for name, db in [("fresh", fresh), ("live", con)]:
+            if db is con and get_version(con) < LATEST_VERSION:
+                print(f"Skipping the {name} database as it has pending migrations")
+                continue
+
+            failures = check_plans(db)
+            for description, plan in failures:
+                print(f"[{name}] {description} does not use its index:\n\t{'; '.join(plan)}")
+            failed = failed or failures != []
+
+        if failed:
+            sys.exit(1)
+        print(f"All {len(PLAN_CHECKS)} query plans use their indexes")
+
+    con.close()
+
+
+if __name__ == "__main__":
+    main()
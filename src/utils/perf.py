@@ -0,0 +1,190 @@
+import json
+import time
+import logging
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+
+from discord.webhook.async_ import async_context
+
+logger = logging.getLogger("bot.perf")
+
+with open("../config.json", "r") as read_file:
+    config = json.load(read_file)
+
+# Performance monitoring settings, see example_config.json
+PERF = config.get("PERF", {})
+
+# Number of recent invocations of each command kept for percentiles
+WINDOW = PERF.get("window", 500)
+
+# Invocations taking longer than this many seconds are logged as a warning
+SLOW_THRESHOLD = PERF.get("slow_threshold", 2.5)
+
+# Parts of an invocation timed separately. Anything else (i.e. the bot's own Python) is the
+# difference between the total and these
+PARTS = ("db", "render", "discord")
+
+# Timings of the invocation running in the current task, or None outside of one
+_current = contextvars.ContextVar("invocation", default=None)
+
+# Recent timings of each command and autocomplete, stored as {name: Histogram}
+histograms = {}
+
+
+# Rolling window of the timings of the most recent invocations of a command
+class Histogram:
+    def __init__(self, size=WINDOW):
+        # Each sample is (finish time, total, {part: seconds})
+        self.samples = deque(maxlen=size)
+        self.count = 0
+
+    def add(self, total, parts):
+        self.samples.append((time.time(), total, parts))
+        self.count += 1
+
+    # Get the p50, p95 and p99 of the total, or of one of the parts
+    def percentiles(self, part=None):
+        if part is None:
+            values = sorted(sample[1] for sample in self.samples)
+        else:
+            values = sorted(sample[2].get(part, 0) for sample in self.samples)
+
+        if values == []:
+            return (0, 0, 0)
+
+        return tuple(values[min(len(values) - 1, int(len(values) * p))] for p in (0.5, 0.95, 0.99))
+
+    # Get the slowest invocations in the window, slowest first
+    def slowest(self, n=5):
+        return sorted(self.samples, key=lambda sample: sample[1], reverse=True)[:n]
+
+
+# Time an app command or autocomplete, recording it in the command's histogram
+@contextmanager
+def invocation(name):
+    parts = {part: 0 for part in PARTS}
+    token = _current.set(parts)
+    t1 = time.perf_counter()
+    try:
+        yield parts
+    finally:
+        total = time.perf_counter() - t1
+        _current.reset(token)
+
+        # Stored as a copy, as tasks started during the invocation (e.g. event listeners) share
+        # its context and may still be timing things after it has finished
+        histograms.setdefault(name, Histogram()).add(total, dict(parts))
+
+        if total >= SLOW_THRESHOLD:
+            breakdown = ", ".join(f"{part} {round(parts[part], 3)}s" for part in PARTS)
+            logger.warning(f"Slow invocation of {name} took {round(total, 3)}s ({breakdown})")
+
+
+# Add the time spent in a block to a part of the current invocation, if there is one
+@contextmanager
+def timing(part):
+    parts = _current.get()
+    if parts is None:
+        yield
+        return
+
+    t1 = time.perf_counter()
+    try:
+        yield
+    finally:
+        parts[part] += time.perf_counter() - t1
+
+
+# Wrap a coroutine function so that the time awaiting it is added to a part of the current
+# invocation
+def timed(part, func):
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        with timing(part):
+            return await func(*args, **kwargs)
+
+    return wrapper
+
+
+# Count time spent on Discord API requests towards the invocation making them. Channel messages
+# go through the client's HTTP client, and interaction responses and followups through the
+# webhook adapter
+def time_discord_requests(client):
+    client.http.request = timed("discord", client.http.request)
+
+    adapter = async_context.get()
+    adapter.request = timed("discord", adapter.request)
+
+
+# Cursor of a TimedConnection, timing fetches as database time
+class TimedCursor:
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    async def fetchone(self):
+        with timing("db"):
+            return await self._cursor.fetchone()
+
+    async def fetchmany(self, size=None):
+        with timing("db"):
+            return await self._cursor.fetchmany(size)
+
+    async def fetchall(self):
+        with timing("db"):
+            return await self._cursor.fetchall()
+
+
+# Pool connection which counts the time awaiting queries towards the current invocation
+class TimedConnection:
+    def __init__(self, con):
+        self._con = con
+
+    def __getattr__(self, name):
+        return getattr(self._con, name)
+
+    async def execute(self, sql, *parameters):
+        with timing("db"):
+            return TimedCursor(await self._con.execute(sql, *parameters))
+
+    async def executemany(self, sql, seq_of_parameters):
+        with timing("db"):
+            return TimedCursor(await self._con.executemany(sql, seq_of_parameters))
+
+    async def executescript(self, sql_script):
+        with timing("db"):
+            return TimedCursor(await self._con.executescript(sql_script))
+
+    async def commit(self):
+        with timing("db"):
+            await self._con.commit()
+
+
+# Acquires a connection from the pool (counting any wait as database time) and releases it
+class _TimedAcquire:
+    def __init__(self, pool):
+        self.pool = pool
+
+    async def __aenter__(self):
+        with timing("db"):
+            self.con = await self.pool.acquire()
+        return TimedConnection(self.con)
+
+    async def __aexit__(self, *args):
+        await self.pool.release(self.con)
+
+
+# asqlite pool whose connections time their queries
+class TimedPool:
+    def __init__(self, pool):
+        self._pool = pool
+
+    def __getattr__(self, name):
+        return getattr(self._pool, name)
+
+    def acquire(self):
+        return _TimedAcquire(self._pool)
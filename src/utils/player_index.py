@@ -0,0 +1,168 @@
+import heapq
+import bisect
+
+# How well a name matches what has been typed so far, best first
+EXACT, PREFIX, WORD_PREFIX, SUBSTRING, FUZZY = range(5)
+
+# Minimum trigram similarity (shared trigrams / all trigrams) for a fuzzy match
+MIN_SIMILARITY = 0.2
+
+# Discord shows at most 25 autocomplete choices
+MAX_CHOICES = 25
+
+
+# Trigrams of a string, padded so that the start and end of the string form trigrams too
+def trigrams(text):
+    padded = f"  {text} "
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+
+# Words a name could be searched by, i.e. the full name and each part of it after a space,
+# underscore, dot or dash
+def words(name):
+    parts = [name]
+    for i, char in enumerate(name):
+        if char in " _.-" and i + 1 < len(name):
+            parts.append(name[i + 1 :])
+    return parts
+
+
+# Search index over player and sub names, matching by prefix for short queries and by trigram
+# similarity for longer ones so that names don't have to be typed from the start. Entries are
+# keyed by (name, status) and are added and removed individually as the rosters change
+class PlayerIndex:
+    def __init__(self):
+        # {(name, status): (tier, org)}
+        self.entries = {}
+        # Sorted list of (lowercase word, key) for prefix searches
+        self.words = []
+        # {trigram: set of keys}, and the number of trigrams in each name
+        self.trigrams = {}
+        self.trigram_counts = {}
+        # {tier or org: set of keys}, to answer empty queries without ranking every entry
+        self.groups = {}
+
+    def add(self, key, tier, org):
+        self.entries[key] = (tier, org)
+
+        lower = key[0].lower()
+        for word in words(lower):
+            bisect.insort(self.words, (word, key))
+
+        name_trigrams = trigrams(lower)
+        for trigram in name_trigrams:
+            self.trigrams.setdefault(trigram, set()).add(key)
+        self.trigram_counts[key] = len(name_trigrams)
+
+        for group in (("tier", tier), ("org", org)):
+            self.groups.setdefault(group, set()).add(key)
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+
+        lower = key[0].lower()
+        for word in words(lower):
+            i = bisect.bisect_left(self.words, (word, key))
+            if i < len(self.words) and self.words[i] == (word, key):
+                del self.words[i]
+        for trigram in trigrams(lower):
+            keys = self.trigrams.get(trigram)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.trigrams[trigram]
+        del self.trigram_counts[key]
+
+        for group in (("tier", entry[0]), ("org", entry[1])):
+            keys = self.groups[group]
+            keys.discard(key)
+            if not keys:
+                del self.groups[group]
+
+    # Bring the index in line with {(name, status): (tier, org)}, only touching entries which
+    # have been added, removed or changed. Returns the number of entries touched
+    def update(self, entries):
+        changed = 0
+        for key in list(self.entries):
+            if entries.get(key) != self.entries[key]:
+                self.remove(key)
+                changed += 1
+        for key, (tier, org) in entries.items():
+            if key not in self.entries:
+                self.add(key, tier, org)
+                changed += 1
+
+        return changed
+
+    # How closely an entry relates to the tier and orgs the search is for
+    def context_score(self, key, tier, orgs):
+        entry_tier, entry_org = self.entries[key]
+        return (entry_tier is not None and entry_tier == tier) + (entry_org in orgs)
+
+    # Get up to limit (name, status) keys matching the query, ordered by how well they match and
+    # then by how relevant they are to the given tier and orgs
+    def search(self, query, tier=None, orgs=(), limit=MAX_CHOICES):
+        query = query.lower().strip()
+
+        matches = {}
+        if query == "":
+            # Entries in the tier or orgs being searched for, topped up with the first names
+            # alphabetically if there are too few
+            for group in [("tier", tier)] + [("org", org) for org in orgs]:
+                if group[1] is None:
+                    continue
+                for key in self.groups.get(group, ()):
+                    matches[key] = PREFIX
+            i = 0
+            while len(matches) < limit and i < len(self.words):
+                word, key = self.words[i]
+                if word == key[0].lower():
+                    matches.setdefault(key, SUBSTRING)
+                i += 1
+        else:
+            # Every name with a word starting with the query
+            i = bisect.bisect_left(self.words, (query,))
+            while i < len(self.words) and self.words[i][0].startswith(query):
+                word, key = self.words[i]
+                lower = key[0].lower()
+                if lower == query:
+                    rank = EXACT
+                elif word == lower:
+                    rank = PREFIX
+                else:
+                    rank = WORD_PREFIX
+                matches[key] = min(rank, matches.get(key, rank))
+                i += 1
+
+        # Names sharing enough trigrams with the query, ranked by similarity within each rank
+        similarity = {}
+        if len(query) >= 3:
+            query_trigrams = trigrams(query)
+            shared = {}
+            for trigram in query_trigrams:
+                for key in self.trigrams.get(trigram, ()):
+                    shared[key] = shared.get(key, 0) + 1
+
+            for key, count in shared.items():
+                score = count / (len(query_trigrams) + self.trigram_counts[key] - count)
+                similarity[key] = score
+                if key in matches:
+                    continue
+                if query in key[0].lower():
+                    matches[key] = SUBSTRING
+                elif score >= MIN_SIMILARITY:
+                    matches[key] = FUZZY
+
+        return heapq.nsmallest(
+            limit,
+            matches,
+            key=lambda key: (
+                matches[key],
+                -self.context_score(key, tier, orgs),
+                -similarity.get(key, 0),
+                key[0].lower(),
+                key[1],
+            ),
+        )
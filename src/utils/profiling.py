@@ -0,0 +1,201 @@
+import io
+import os
+import time
+import pstats
+import asyncio
+import cProfile
+import logging
+import threading
+import itertools
+import tracemalloc
+from contextlib import contextmanager
+from functools import wraps
+
+from utils.log import setup_logging
+
+logger = logging.getLogger("script.profiling")
+
+setup_logging()
+
+PROFILE_DIR = "../logs/profiles"
+
+# Number of functions and allocation sites included in each report
+REPORT_LINES = 40
+
+# Names of everything that can be profiled besides app commands, i.e. background tasks and
+# rendering functions, and those of them which run in the bot's own process (so can be profiled
+# with /profile rather than RLIS_PROFILE)
+targets = set()
+bot_targets = set()
+
+# Pending requests to profile the next invocations of something, stored as {name: Request}
+requests = {}
+_lock = threading.Lock()
+
+# Whether this thread is already being profiled, as only one profiler can be active per thread
+_local = threading.local()
+
+# Number of profiles currently tracing memory allocations
+_tracing = 0
+
+# Numbers the reports written by this process, so that their names are unique
+_sequence = itertools.count(1)
+
+
+# Raised when requesting a profile of something which already has a pending request
+class AlreadyRequested(Exception):
+    pass
+
+
+# Request to profile the next count invocations of something. When a loop is given, future is set
+# on it to the list of report files once they're all done
+class Request:
+    def __init__(self, count, loop=None):
+        self.remaining = count
+        self.pending = count
+        self.files = []
+        self.loop = loop
+        self.future = loop.create_future() if loop is not None else None
+
+    def finish(self, files):
+        with _lock:
+            self.files += files
+            self.pending -= 1
+            done = self.pending == 0
+
+        if done and self.future is not None:
+            self.loop.call_soon_threadsafe(self._resolve)
+
+    # The future may have been cancelled by whoever was waiting on it giving up
+    def _resolve(self):
+        if not self.future.done():
+            self.future.set_result(self.files)
+
+
+# Profile the next count invocations of something, unless it already has a pending request
+def request(name, count, loop=None):
+    with _lock:
+        if name in requests:
+            raise AlreadyRequested(name)
+        requests[name] = Request(count, loop)
+        return requests[name]
+
+
+# Drop a request before all of its invocations have been profiled. Profiles already in progress
+# still finish, but their reports are no longer waited on
+def cancel(name, req):
+    with _lock:
+        if requests.get(name) is req:
+            del requests[name]
+
+
+# Take the next invocation of something from its pending request, if it has one
+def _take(name):
+    with _lock:
+        req = requests.get(name)
+        if req is None or req.remaining == 0:
+            return None
+        req.remaining -= 1
+        if req.remaining == 0:
+            del requests[name]
+        return req
+
+
+# Profile a block with cProfile and tracemalloc if there's a pending request for name, writing a
+# .prof file (for pstats or snakeviz) and a text report. Profiles the calling thread only, so
+# anything run in another thread needs profiling there. In the event loop, other tasks running
+# while the block awaits are included
+@contextmanager
+def profiled(name):
+    if getattr(_local, "active", False) or not requests:
+        yield
+        return
+
+    req = _take(name)
+    if req is None:
+        yield
+        return
+
+    global _tracing
+    with _lock:
+        if _tracing == 0:
+            tracemalloc.start()
+        _tracing += 1
+    before = tracemalloc.take_snapshot()
+
+    _local.active = True
+    profiler = cProfile.Profile()
+    t1 = time.perf_counter()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        elapsed = time.perf_counter() - t1
+        _local.active = False
+
+        after = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+        with _lock:
+            _tracing -= 1
+            if _tracing == 0:
+                tracemalloc.stop()
+
+        req.finish(write_report(name, profiler, before, after, elapsed, peak))
+
+
+# Write the results of a profile, returning the paths of the files written
+def write_report(name, profiler, before, after, elapsed, peak):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    stem = f"{PROFILE_DIR}/{name.strip('/').replace(' ', '_')}_{time.strftime('%Y%m%d_%H%M%S')}"
+    stem += f"_{os.getpid()}_{next(_sequence)}"
+
+    profiler.dump_stats(f"{stem}.prof")
+
+    report = io.StringIO()
+    report.write(f"{name} took {round(elapsed, 3)}s, peak traced memory {peak // 1024}KiB\n\n")
+    pstats.Stats(profiler, stream=report).sort_stats("cumulative").print_stats(REPORT_LINES)
+
+    report.write("Largest allocation changes:\n")
+    for stat in after.compare_to(before, "lineno")[:REPORT_LINES]:
+        report.write(f"{stat}\n")
+
+    with open(f"{stem}.txt", "w", encoding="utf-8") as f:
+        f.write(report.getvalue())
+
+    logger.info(f"Profiled {name} in {round(elapsed, 3)}s, written to {stem}.prof")
+    return [f"{stem}.txt", f"{stem}.prof"]
+
+
+# Wrap a function so that its invocations can be profiled under name. in_bot is False for functions
+# which never run in the bot's own process
+def profile_calls(name, in_bot=True):
+    targets.add(name)
+    if in_bot:
+        bot_targets.add(name)
+
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                with profiled(name):
+                    return await func(*args, **kwargs)
+
+        else:
+
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with profiled(name):
+                    return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+# Scripts are profiled by setting RLIS_PROFILE to a comma separated list of names, each optionally
+# followed by the number of invocations to profile, e.g. RLIS_PROFILE=get_stats,draw_stats:3
+for entry in filter(None, os.environ.get("RLIS_PROFILE", "").split(",")):
+    name, _, count = entry.partition(":")
+    request(name.strip(), int(count) if count else 1)
@@ -0,0 +1,167 @@
+import os
+import re
+import json
+import time
+import atexit
+import sqlite3
+import logging
+from functools import lru_cache
+from threading import Lock
+
+from utils.log import setup_logging
+
+with open("../config.json", "r") as read_file:
+    config = json.load(read_file)
+
+# Connection settings, see example_config.json
+DATABASE = config.get("DATABASE", {})
+
+# Queries taking at least this many milliseconds are logged along with their query plan
+SLOW_QUERY_MS = DATABASE.get("slow_query_ms", 100)
+
+# Set to log the query stats of a script when it exits, e.g. RLIS_QUERY_STATS=1 python get_stats.py
+DUMP_AT_EXIT = os.environ.get("RLIS_QUERY_STATS") is not None
+
+logger = logging.getLogger("script.sql_stats")
+
+setup_logging()
+
+# Executions, total seconds and max seconds of each normalized statement, stored as
+# {statement: [count, total, max]}
+stats = {}
+_lock = Lock()
+
+# Query plan of each statement that has been slow, so that it's only explained once
+plans = {}
+
+
+# Reduce a statement to a form shared by every execution of it, i.e. with whitespace collapsed and
+# literals and lists of placeholders replaced
+@lru_cache(maxsize=1024)
+def normalize(sql):
+    sql = re.sub(r"'(?:[^']|'')*'", "?", sql)
+    sql = re.sub(r"\b\d+(?:\.\d+)?\b", "?", sql)
+    sql = re.sub(r"\s+", " ", sql).strip()
+    sql = re.sub(r"\(\s*\?(?:\s*,\s*\?)*\s*\)", "(...)", sql)
+    return sql
+
+
+# Add the time taken by an execution of a statement (or a fetch from one, which isn't counted as
+# another execution) to its stats. elapsed is the time taken by the execution so far, including any
+# fetches, which is logged along with the query plan once it passes the slow query threshold
+def record(con, sql, parameters, seconds, elapsed, execution=True):
+    statement = normalize(sql)
+    with _lock:
+        entry = stats.setdefault(statement, [0, 0, 0])
+        entry[0] += execution
+        entry[1] += seconds
+        entry[2] = max(entry[2], elapsed)
+
+    threshold = SLOW_QUERY_MS / 1000
+    if elapsed >= threshold and elapsed - seconds < threshold:
+        logger.warning(
+            f"Slow query has taken {round(elapsed * 1000)}ms: {statement}\n"
+            f"{explain(con, statement, sql, parameters)}"
+        )
+
+
+# Get the query plan of a statement, explaining it with the parameters of the slow execution
+def explain(con, statement, sql, parameters):
+    if statement not in plans:
+        try:
+            # Explained with a plain cursor so that it isn't recorded itself
+            rows = con.cursor(sqlite3.Cursor).execute(f"EXPLAIN QUERY PLAN {sql}", parameters)
+            plans[statement] = "\n".join(f"  {row[3]}" for row in rows.fetchall())
+        except sqlite3.Error as e:
+            plans[statement] = f"  (unable to explain: {e})"
+
+    return plans[statement]
+
+
+# Cursor which records the time taken by each statement it executes
+class TimedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        t1 = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._last = [sql, parameters, time.perf_counter() - t1]
+            record(self.connection, sql, parameters, self._last[2], self._last[2])
+
+    def executemany(self, sql, seq_of_parameters):
+        t1 = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            # The parameters have been consumed, so a slow executemany can't be explained
+            self._last = [sql, (), time.perf_counter() - t1]
+            record(self.connection, sql, (), self._last[2], self._last[2])
+
+    # Rows after the first are only read from the database when fetched, so fetches are timed as
+    # part of the last statement executed
+    def _fetch(self, fetch, *args):
+        t1 = time.perf_counter()
+        try:
+            return fetch(*args)
+        finally:
+            last = getattr(self, "_last", None)
+            if last is not None:
+                seconds = time.perf_counter() - t1
+                last[2] += seconds
+                record(self.connection, last[0], last[1], seconds, last[2], execution=False)
+
+    def fetchone(self):
+        return self._fetch(super().fetchone)
+
+    def fetchmany(self, size=None):
+        if size is None:
+            return self._fetch(super().fetchmany)
+        return self._fetch(super().fetchmany, size)
+
+    def fetchall(self):
+        return self._fetch(super().fetchall)
+
+
+# Connection whose statements are timed, used as the factory of every connection (including those
+# in the bot's pool)
+class TimedConnection(sqlite3.Connection):
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+# Get the stats of every statement as a table, ordered by total time
+def dump():
+    with _lock:
+        rows = sorted(stats.items(), key=lambda item: item[1][1], reverse=True)
+
+    lines = [f"{'count':>7} {'total':>9} {'mean':>8} {'max':>8}  statement"]
+    for statement, (count, total, max_time) in rows:
+        mean = total / count if count > 0 else 0
+        lines.append(
+            f"{count:>7} {round(total * 1000):>7}ms {round(mean * 1000, 1):>6}ms "
+            f"{round(max_time * 1000, 1):>6}ms  {statement}"
+        )
+
+    return "\n".join(lines)
+
+
+def reset():
+    with _lock:
+        stats.clear()
+    plans.clear()
+
+
+def log_dump():
+    if stats:
+        logger.info(f"Query stats:\n{dump()}")
+
+
+# Registered after logging is set up, so that it runs before the log listener is stopped
+if DUMP_AT_EXIT:
+    atexit.register(log_dump)
@@ -0,0 +1,17 @@
+import os
+import sys
+import shutil
+import tempfile
+
+# The bot's modules are run from src/ and load ../config.json (and log to ../logs) at import, so
+# tests run from a scratch copy of that layout with the example config, never touching the real
+# config, database or logs
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WORK_DIR = tempfile.mkdtemp(prefix="rlis_tests_")
+for directory in ["src", "data", "logs"]:
+    os.makedirs(os.path.join(WORK_DIR, directory))
+shutil.copy(os.path.join(ROOT, "example_config.json"), os.path.join(WORK_DIR, "config.json"))
+
+os.chdir(os.path.join(WORK_DIR, "src"))
+sys.path.insert(0, os.path.join(ROOT, "src"))
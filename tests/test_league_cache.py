@@ -0,0 +1,66 @@
+import sqlite3
+import asyncio
+
+import asqlite
+
+from utils.league_cache import LeagueCache
+from utils.migrations import migrate
+
+
+def create_database(path):
+    con = sqlite3.connect(path)
+    migrate(con)
+    con.close()
+
+
+# Add a fixture (between orgs A and B, with ids 1 and 2) the way load_csv.py --sync does, from
+# another connection (i.e. another process)
+def sync_fixture(path, week, tier):
+    con = sqlite3.connect(path)
+    con.execute("INSERT INTO fixtures VALUES(?, ?, 1, 2)", (week, tier))
+    con.executemany(
+        "INSERT INTO league_changes(timestamp, kind, tier, org, week) VALUES(0, ?, ?, ?, ?)",
+        [("fixtures", tier, "A", week), ("fixtures", tier, "B", week)],
+    )
+    con.commit()
+    con.close()
+
+
+# A sync followed by the bot refreshing the cache itself (as /register_sub does) before the next
+# poll must still have its changes dispatched by that poll, even though the refresh has already
+# taken in the sync's version bump
+def test_changes_dispatched_after_refresh(tmp_path):
+    path = str(tmp_path / "league.db")
+    create_database(path)
+
+    async def run():
+        dispatched = []
+        async with asqlite.create_pool(path, size=2) as pool:
+            cache = LeagueCache(pool, lambda event, *args: dispatched.append((event, *args)))
+
+            # As in start, without the polling loop
+            async with pool.acquire() as con:
+                await cache.get_changes(con)
+            await cache.refresh()
+
+            sync_fixture(path, 3, "A")
+
+            async with pool.acquire() as con:
+                await con.execute(
+                    """INSERT INTO players(id, status, name, platform, platform_id)
+                    VALUES(1, 'sub', 'Sub', 'steam', '1')"""
+                )
+            await cache.refresh()
+
+            await cache.check_version()
+            await cache.check_version()
+
+            return cache, dispatched
+
+    cache, dispatched = asyncio.run(run())
+
+    assert dispatched == [
+        ("league_changed", [("fixtures", "A", "A", 3), ("fixtures", "A", "B", 3)])
+    ]
+    assert cache.subs == ["Sub"]
+    assert cache.fixture_weeks == {("A", frozenset((1, 2))): 3}
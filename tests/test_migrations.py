@@ -0,0 +1,36 @@
+import sqlite3
+
+from utils.migrations import LATEST_VERSION, check_plans, get_version, migrate
+
+
+def test_migrate_from_empty(tmp_path):
+    con = sqlite3.connect(tmp_path / "rlis.db")
+    assert get_version(con) == 0
+
+    applied = migrate(con)
+
+    assert applied == list(range(1, LATEST_VERSION + 1))
+    assert get_version(con) == LATEST_VERSION
+    con.close()
+
+
+def test_migrate_again_is_a_no_op(tmp_path):
+    con = sqlite3.connect(tmp_path / "rlis.db")
+    migrate(con)
+    schema = con.execute("SELECT type, name, sql FROM sqlite_master ORDER BY name").fetchall()
+
+    assert migrate(con) == []
+    assert get_version(con) == LATEST_VERSION
+    assert (
+        con.execute("SELECT type, name, sql FROM sqlite_master ORDER BY name").fetchall() == schema
+    )
+    con.close()
+
+
+# Every hot query must keep using its index on a database built from the migrations
+def test_query_plans_use_indexes(tmp_path):
+    con = sqlite3.connect(tmp_path / "rlis.db")
+    migrate(con)
+
+    assert check_plans(con) == []
+    con.close()